@@ -24,7 +24,12 @@ from wtforms import TextAreaField, SubmitField
 from wtforms.validators import Required
 
 from watson_developer_cloud import WatsonException
-from main import main
+import database
+import rollup_store
+from cost_guard import QueryTooExpensive
+from generateresponsefromrequest import watson_client
+from nlu_client import NLUError
+from main import main, IN_MEMORY_ROLLUPS
 
 
 app = Flask(__name__)
@@ -59,7 +64,14 @@ def search_and_viz():
         on the same page
     '''
     query = str(request.form['user_input'])
-    tl_quadrant, tr_quadrant, bl_quadrant, br_quadrant = main(query)
+    try:
+        tl_quadrant, tr_quadrant, bl_quadrant, br_quadrant = main(query)
+    except QueryTooExpensive as e:
+        # Ask for a cheaper question rather than tie up the worker
+        return render_template('landing.html', error=str(e))
+    except NLUError:
+        return render_template('landing.html',
+                               error='The language service is not answering right now, please try again.')
     return render_template('index.html',
                            bl_plot=bl_quadrant.plot,
                            bl_title=bl_quadrant.title,
@@ -90,10 +102,31 @@ def search_and_viz():
                         #    table_title2=table_title2)
 
 
+@app.route('/pool_status')
+def pool_status():
+    '''
+    Returns:
+        occupancy, checkout waits and connection churn of the database pool
+    '''
+    return jsonify(database.pool_status(database.get_engine()))
+
+
+@app.route('/nlu_status')
+def nlu_status():
+    '''
+    Returns:
+        request counts and latency histogram of the Watson client
+    '''
+    return jsonify(watson_client.stats())
+
+
 @app.errorhandler(404)
 def not_found(error):
     return make_response(jsonify({'error': 'Not found'}), 404)
 
 
 if __name__ == "__main__":
+    # Read the rollups kept in memory before taking requests
+    if IN_MEMORY_ROLLUPS:
+        rollup_store.store.load(database.get_engine())
     app.run(host='0.0.0.0', port=int(port), debug=False)
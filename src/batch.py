@@ -0,0 +1,358 @@
+'''
+Module for answering a batch of questions at once, e.g. to precompute the
+morning reports.
+
+Questions are read from a file, one per line or in the format of "Question
+Types.txt", and their intents and entities are resolved concurrently. Those
+whose SQL is identical are grouped, so each query is run once, on a thread
+pool, and the dashboards of every question are rendered from the results in
+a pool of processes, as plotting is CPU bound. Net win analyses run their own
+queries and are built on the thread pool.
+
+Run with "python batch.py <questions file> [output directory] [--processes n]"
+to write a JSON file and an HTML page per question and an index.html linking
+them. Batches are run from the command line rather than the app, as they
+take far longer than a request should and fork processes.
+'''
+
+import cgi
+import copy
+import json
+import os
+import sys
+import time
+import traceback
+import numpy as np
+from multiprocessing import Pool
+from multiprocessing.pool import ThreadPool
+import main
+import database
+from netwin_analysis import netwin_analysis, close_query_pool
+
+# Queries, and NLU requests, run at once
+QUERY_THREADS = 8
+
+# Processes dashboards are rendered in, None for one per CPU
+RENDER_PROCESSES = None
+
+# Directory the reports are written to by default
+DEFAULT_OUTPUT_DIRECTORY = 'reports'
+
+# Names of the values main.main returns for queries other than net win
+# analyses, in order
+DASHBOARD_FIELDS = ['plot1', 'plot2', 'mainfactors', 'derivedmetrics',
+                    'bottom_left_table', 'metrics', 'table_metrics',
+                    'table_metrics2', 'bottom_left_table_metrics',
+                    'table_title1', 'table_title2']
+
+# Quadrants of a net win analysis, in the order netwin_analysis returns them
+QUADRANTS = ['tl', 'tr', 'bl', 'br']
+
+# Attributes run_query sets on a query parameters object after generating
+# its SQL, copied from the question whose query was run to the questions
+# sharing its SQL
+RUN_ATTRIBUTES = ['sql_string', 'sql_params', 'sql_factors', 'sql_period',
+                  'database_name', 'requested_database_name',
+                  'days_per_interval', 'sample_percent', 'coarsened_from']
+
+
+def read_questions(path):
+    '''
+    Reads the questions of a file. If any line that is not indented holds a
+    question mark the file is read like "Question Types.txt", taking the
+    text up to the question mark of those lines, else every line that is not
+    empty is a question.
+    Input:
+        path (str) -- path of the file
+    Output:
+        list of the questions, in order, without repeats
+    '''
+    with open(path) as question_file:
+        lines = [line.rstrip() for line in question_file
+                 if line.strip() and not line[0].isspace()]
+    if any('?' in line for line in lines):
+        lines = [line[:line.index('?') + 1] for line in lines if '?' in line]
+    questions = []
+    for line in lines:
+        if line.strip() not in questions:
+            questions.append(line.strip())
+    return questions
+
+
+def sql_key(query_params):
+    '''
+    Generates the SQL of a query, for the view the query asks for, which
+    also translates the rest of its parameters to SQL (see
+    query_parameters.translate_to_sql) as rendering needs them
+    Input:
+        query_params -- query parameters object from
+                        main.get_query_params_from_nl_query
+    Output:
+        tuple of the query's SQL and parameters, which questions asking the
+        same are grouped on
+    '''
+    query_params.generate_sql_query()
+    return query_params.sql_string, tuple(sorted(query_params.sql_params.items()))
+
+
+def resolve_question(question):
+    '''
+    Output:
+        tuple of the question's query parameters object and None, or of None
+        and the error it raised
+    '''
+    try:
+        return main.get_query_params_from_nl_query(question), None
+    except Exception:
+        return None, traceback.format_exc()
+
+
+def group_question(query_params):
+    '''
+    Output:
+        tuple of the question's sql_key and None, or of None and the error it
+        raised
+    '''
+    try:
+        return sql_key(query_params), None
+    except Exception:
+        return None, traceback.format_exc()
+
+
+def run_netwin_analysis(query_params):
+    '''
+    Output:
+        tuple of the quadrants of the analysis and None, or of None and the
+        error it raised
+    '''
+    try:
+        return netwin_analysis(query_params, main.run_query), None
+    except Exception:
+        return None, traceback.format_exc()
+
+
+def run_group(query_params):
+    '''
+    Runs the query shared by a group of questions
+    Output:
+        tuple of the query's results and None, or of None and the error it
+        raised
+    '''
+    try:
+        return main.run_query(query_params), None
+    except Exception:
+        return None, traceback.format_exc()
+
+
+def render_question(args):
+    '''
+    Renders the dashboard of a question in a worker process
+    Input:
+        args (tuple) -- query parameters object and DataFrame of its results
+    Output:
+        tuple of the dashboard as a dictionary and None, or of None and the
+        error it raised
+    '''
+    query_params, df = args
+    try:
+        return dashboard_to_dict(main.render_dashboard(query_params, df)), None
+    except Exception:
+        return None, traceback.format_exc()
+
+
+def dashboard_to_dict(dashboard):
+    '''
+    Input:
+        dashboard (tuple) -- values returned by main.main
+    Output:
+        dictionary of the values by name, with the quadrants of net win
+        analyses as dictionaries without their DataFrames
+    '''
+    if hasattr(dashboard[0], 'viz_type'):
+        return dict((name, dict((key, value) for key, value in vars(quadrant).items()
+                                if key != 'df'))
+                    for name, quadrant in zip(QUADRANTS, dashboard))
+    return dict((name, value) for name, value in zip(DASHBOARD_FIELDS, dashboard)
+                if value is not None)
+
+
+def run_batch(questions, query_threads=QUERY_THREADS, processes=RENDER_PROCESSES):
+    '''
+    Answers a batch of questions
+    Input:
+        questions (list) -- list of strings of natural language questions
+        query_threads (int) -- queries and NLU requests run at once
+        processes (int) -- processes dashboards are rendered in
+    Output:
+        list of dictionaries of each question, its dashboard or the error
+        answering it raised, and the number of questions sharing its query
+    '''
+    ts = time.time()
+    thread_pool = ThreadPool(query_threads)
+    try:
+        # Resolve intents and entities
+        resolved = thread_pool.map(resolve_question, questions)
+        results = [{'question': question} for question in questions]
+        netwin = []
+        groups = {}
+        for result, (query_params, error) in zip(results, resolved):
+            if error:
+                result['error'] = error
+            elif query_params.intent == 'netwin_analysis':
+                netwin.append((result, query_params))
+            else:
+                key, error = group_question(query_params)
+                if error:
+                    result['error'] = error
+                else:
+                    groups.setdefault(key, []).append((result, query_params))
+
+        # Run each unique query once, and the net win analyses, at once
+        group_runs = [(group, thread_pool.apply_async(run_group, (group[0][1],)))
+                      for group in groups.values()]
+        netwin_runs = [(result, thread_pool.apply_async(run_netwin_analysis, (query_params,)))
+                       for result, query_params in netwin]
+
+        renders = []
+        for group, run in group_runs:
+            df, error = run.get()
+            leader = group[0][1]
+            for result, query_params in group:
+                result['shared_with'] = len(group)
+                if error:
+                    result['error'] = error
+                    continue
+                for attribute in RUN_ATTRIBUTES:
+                    setattr(query_params, attribute, copy.deepcopy(getattr(leader, attribute)))
+                renders.append((result, (query_params, df)))
+        for result, run in netwin_runs:
+            dashboard, error = run.get()
+            if error:
+                result['error'] = error
+            else:
+                result['dashboard'] = dashboard_to_dict(dashboard)
+    finally:
+        thread_pool.close()
+        thread_pool.join()
+
+    # Render the dashboards
+    if renders:
+        # Forked processes inherit the threads and pooled connections of this
+        # one, which must not be running or shared when they are forked
+        close_query_pool()
+        database.dispose_engines()
+        process_pool = Pool(processes)
+        try:
+            rendered = process_pool.map(render_question, [args for _, args in renders])
+        finally:
+            process_pool.close()
+            process_pool.join()
+        for (result, _), (dashboard, error) in zip(renders, rendered):
+            if error:
+                result['error'] = error
+            else:
+                result['dashboard'] = dashboard
+
+    print 'Answered {} questions with {} queries in {:.2f} sec'.format(
+        len(questions), len(groups) + len(netwin), time.time() - ts)
+    return results
+
+
+def to_json(value):
+    '''
+    json default for the numpy values dashboards hold
+    '''
+    if isinstance(value, np.generic):
+        return value.item()
+    return str(value)
+
+
+def render_html(result):
+    '''
+    Input:
+        result (dict) -- result of a question from run_batch
+    Output:
+        string of an HTML page of the question's dashboard
+    '''
+    parts = ['<html><head><meta charset="utf-8"><title>{}</title></head><body>'.format(
+        cgi.escape(result['question'])),
+        '<h1>{}</h1>'.format(cgi.escape(result['question']))]
+    if 'error' in result:
+        parts.append('<pre>{}</pre>'.format(cgi.escape(result['error'])))
+    dashboard = result.get('dashboard', {})
+    for name in ['plot1', 'plot2'] + QUADRANTS:
+        value = dashboard.get(name)
+        if isinstance(value, dict):
+            if value.get('title'):
+                parts.append('<h2>{}</h2>'.format(cgi.escape(str(value['title']))))
+            value = value.get('plot') or table_html(value.get('column_titles'), value.get('table_data'))
+        if value:
+            parts.append(value)
+    if dashboard.get('metrics'):
+        parts.append(table_html(['Metric', 'Value'], sorted(dashboard['metrics'].items())))
+    if dashboard.get('mainfactors'):
+        parts.append(table_html(dashboard.get('table_metrics'), dashboard['mainfactors']))
+    parts.append('</body></html>')
+    return '\n'.join(parts)
+
+
+def table_html(column_titles, rows):
+    '''
+    Output:
+        string of an HTML table of rows
+    '''
+    if not rows:
+        return ''
+    parts = ['<table>']
+    if column_titles:
+        parts.append('<tr>{}</tr>'.format(''.join('<th>{}</th>'.format(cgi.escape(str(title)))
+                                                  for title in column_titles)))
+    for row in rows:
+        parts.append('<tr>{}</tr>'.format(''.join('<td>{}</td>'.format(cgi.escape(str(value)))
+                                                  for value in row)))
+    parts.append('</table>')
+    return ''.join(parts)
+
+
+def write_reports(results, output_directory=DEFAULT_OUTPUT_DIRECTORY):
+    '''
+    Writes a JSON file and an HTML page per question, and an index.html
+    linking the pages
+    Input:
+        results (list) -- output of run_batch
+        output_directory (str) -- directory to write to
+    Output:
+        list of the paths of the HTML pages
+    '''
+    if not os.path.isdir(output_directory):
+        os.makedirs(output_directory)
+    pages = []
+    for i, result in enumerate(results):
+        name = 'question_{:03d}'.format(i + 1)
+        with open(os.path.join(output_directory, name + '.json'), 'w') as json_file:
+            json.dump(result, json_file, default=to_json, indent=2)
+        with open(os.path.join(output_directory, name + '.html'), 'w') as html_file:
+            html_file.write(render_html(result))
+        pages.append(name + '.html')
+
+    with open(os.path.join(output_directory, 'index.html'), 'w') as index_file:
+        index_file.write('<html><head><meta charset="utf-8"><title>Reports</title></head><body><ul>\n')
+        for page, result in zip(pages, results):
+            index_file.write('<li><a href="{}">{}</a>{}</li>\n'.format(
+                page, cgi.escape(result['question']), ' (failed)' if 'error' in result else ''))
+        index_file.write('</ul></body></html>\n')
+    return [os.path.join(output_directory, page) for page in pages]
+
+
+if __name__ == "__main__":
+    args = sys.argv[1:]
+    processes = RENDER_PROCESSES
+    if '--processes' in args:
+        i = args.index('--processes')
+        processes = int(args[i + 1])
+        del args[i:i + 2]
+    questions = read_questions(args[0] if args else os.path.join('..', 'Question Types.txt'))
+    output_directory = args[1] if len(args) > 1 else DEFAULT_OUTPUT_DIRECTORY
+    results = run_batch(questions, processes=processes)
+    write_reports(results, output_directory)
+    print 'Wrote {} reports to {}'.format(len(results), output_directory)
@@ -0,0 +1,191 @@
+'''
+Module for keeping the latency of every request predictable, by checking
+what a generated query will cost before it is run.
+
+guard_query asks the planner, with EXPLAIN, how many rows a query will scan
+and return. Queries over budget are moved to the next coarser period until
+they fit, and queries that cannot be coarsened enough are rejected with
+QueryTooExpensive, which the app shows the user instead of tying up a worker.
+Queries reading rollups smaller than the budget, according to the view
+catalog, are let through without asking the planner. What was decided for a
+query is kept in planned for PLAN_TTL seconds, so a question asked again is
+not planned again.
+
+The budgets can be overridden with the QUERY_MAX_SCAN_ROWS and
+QUERY_MAX_RESULT_ROWS environment variables.
+'''
+
+import os
+import threading
+import time
+import helper
+from collections import OrderedDict
+from rollup_views import parse_view_name, PERIOD_ORDER
+
+# Rows a query may read from its rollup
+MAX_SCAN_ROWS = int(os.getenv('QUERY_MAX_SCAN_ROWS', 5000000))
+
+# Rows a query may return
+MAX_RESULT_ROWS = int(os.getenv('QUERY_MAX_RESULT_ROWS', 500000))
+
+# Periods a query can be coarsened to, which days_per_interval is known for
+COARSENING_PERIODS = ['minute', 'hour', 'day', 'week', 'month']
+
+# Finest period each time factor can be ranked from
+TIME_FACTOR_PERIODS = {'top minute': 'minute', 'top hour': 'hour',
+                       'top day': 'day', 'worst day': 'day',
+                       'top week': 'week', 'top month': 'month'}
+
+# Decisions kept, and seconds each is kept for
+PLAN_CACHE_ENTRIES = 10000
+PLAN_TTL = 600
+
+
+class QueryTooExpensive(Exception):
+    '''
+    Raised for queries over budget at every period they can be answered at
+    '''
+    pass
+
+
+def estimate_query(query_params, engine):
+    '''
+    Input:
+        query_params -- query parameters object after generate_sql_query
+        engine -- sqlalchemy engine
+    Output:
+        tuple of the number of rows the planner expects the query to scan and
+        to return, and its estimated cost
+    '''
+    plan = helper.explain_query(query_params.sql_string, engine, query_params.sql_params)
+    return helper.estimate_scan_rows(plan), plan['Plan Rows'], plan['Total Cost']
+
+
+def coarser_period(query_params):
+    '''
+    Input:
+        query_params -- query parameters object
+    Output:
+        string of the next coarser period the query can be answered at, or
+        None if there is none
+    '''
+    if query_params.sql_period not in COARSENING_PERIODS:
+        return None
+    coarsest = TIME_FACTOR_PERIODS.get(query_params.time_factor, COARSENING_PERIODS[-1])
+    index = COARSENING_PERIODS.index(query_params.sql_period)
+    if index >= COARSENING_PERIODS.index(coarsest):
+        return None
+    return COARSENING_PERIODS[index + 1]
+
+
+def guard_query(query_params, engine, view_catalog, error_checking=False,
+                max_scan_rows=MAX_SCAN_ROWS, max_result_rows=MAX_RESULT_ROWS):
+    '''
+    Coarsens the period of a generated query until the planner expects it to
+    fit in budget, regenerating its SQL
+    Input:
+        query_params -- query parameters object after generate_sql_query
+        engine -- sqlalchemy engine
+        view_catalog (dict) -- output of rollup_views.get_view_catalog
+        error_checking (bool) -- whether to print to console
+        max_scan_rows (int) -- rows the query may read
+        max_result_rows (int) -- rows the query may return
+    Output:
+        None, query_params is updated in place and its original period kept
+        in coarsened_from if it was changed, in which case it is no longer
+        sampled
+    '''
+    while True:
+        # Rollups smaller than both budgets cannot exceed them
+        view = parse_view_name(query_params.database_name)
+        view_rows = view_catalog.get((view[0], tuple(view[1]))) if view else None
+        # Rollups never analyzed are of unknown size, which the planner is
+        # asked about
+        if view_rows is not None and 0 < view_rows <= min(max_scan_rows, max_result_rows):
+            return
+
+        scan_rows, result_rows, cost = estimate_query(query_params, engine)
+        if error_checking:
+            print "Estimated {:.0f} rows scanned, {:.0f} rows returned, cost {:.0f}".format(
+                scan_rows, result_rows, cost)
+        if scan_rows <= max_scan_rows and result_rows <= max_result_rows:
+            return
+
+        period = coarser_period(query_params)
+        if period is None:
+            raise QueryTooExpensive(
+                'This question would read about {:,.0f} rows by {}, more than we can answer '
+                'quickly. Try a shorter date range or a coarser period.'.format(
+                    scan_rows, query_params.sql_period))
+        if query_params.coarsened_from is None:
+            query_params.coarsened_from = query_params.sql_period
+        query_params.sql_period = period
+        # A sample was sized for the finer rollup, the coarser one is read
+        # whole
+        query_params.sample_percent = None
+        query_params.generate_sql_query(error_checking=error_checking,
+                                        view_catalog=view_catalog)
+
+
+class plan_cache(object):
+    '''
+    Sample percentage and period decided for each query, by the cache key
+    (see result_cache.cache_key) of the query as it was asked, least
+    recently used first
+    '''
+    def __init__(self, max_entries=PLAN_CACHE_ENTRIES, ttl=PLAN_TTL):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        '''
+        Output:
+            (sample_percent, sql_period, coarsened_from) tuple, or None if
+            there is no fresh decision for key
+        '''
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            if entry is None or time.time() - entry[1] > self.ttl:
+                return None
+            self.entries[key] = entry
+        return entry[0]
+
+    def put(self, key, query_params):
+        with self.lock:
+            self.entries.pop(key, None)
+            self.entries[key] = ((query_params.sample_percent, query_params.sql_period,
+                                  query_params.coarsened_from), time.time())
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+
+def apply_plan(query_params, plan, view_catalog, error_checking=False):
+    '''
+    Applies a decision from plan_cache to a generated query, regenerating
+    its SQL if it changes it
+    Input:
+        query_params -- query parameters object after generate_sql_query
+        plan (tuple) -- output of plan_cache.get
+        view_catalog (dict) -- output of rollup_views.get_view_catalog
+        error_checking (bool) -- whether to print to console
+    Output:
+        None, query_params is updated in place
+    '''
+    sample_percent, sql_period, coarsened_from = plan
+    if (query_params.sample_percent, query_params.sql_period) == (sample_percent, sql_period):
+        return
+    query_params.sample_percent = sample_percent
+    query_params.sql_period = sql_period
+    query_params.coarsened_from = coarsened_from
+    query_params.generate_sql_query(error_checking=error_checking,
+                                    view_catalog=view_catalog)
+
+
+# Decisions shared by the app
+planned = plan_cache()
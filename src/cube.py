@@ -0,0 +1,327 @@
+'''
+Module for building the rollups in process, as an OLAP cube, instead of as
+materialized views in postgres.
+
+The playlogs are read once, from the csv or from current_logs, in chunks.
+Every configured period and factor combination (cuboid) is aggregated from
+each chunk with integer group codes and np.bincount, and the partial sums are
+merged at the end. Cuboids are written as one compressed .npz file of columns
+per cuboid, named like the matching rollup view, and query_cube answers
+generate_sql_query shaped requests from them without postgres.
+'''
+
+import os
+import glob
+import numpy as np
+import pandas as pd
+import helper
+import loaddatatosql
+from rollup_views import view_name, parse_view_name
+from translation_dictionaries import *
+
+MEASURES = ['netwins', 'handlepulls', 'amountwon', 'amountbet']
+
+# Pandas equivalents of the SQL aggregate statistics
+STATISTIC_FUNCTIONS = {'AVG': 'mean', 'MIN': 'min', 'MAX': 'max', 'SUM': 'sum'}
+
+# Number of partial results kept per cuboid before they are merged
+MAX_PARTIALS = 20
+
+
+def truncate_period(timestamps, time_period):
+    '''
+    Vectorized date_trunc
+    Input:
+        timestamps (numpy array) -- datetime64 array
+        time_period (string) -- period to truncate to
+    Output:
+        datetime64[ns] array of the start of the period of each timestamp
+    '''
+    timestamps = np.asarray(timestamps, dtype='M8[ns]')
+    if time_period == 'week':
+        # Day 0 of numpy time, 1970-01-01, was a Thursday
+        days = timestamps.astype('M8[D]')
+        weekday = (days.astype(np.int64) + 3) % 7
+        truncated = days - weekday.astype('m8[D]')
+    elif time_period == 'quarter':
+        months = timestamps.astype('M8[M]').astype(np.int64)
+        truncated = (months - months % 3).astype('M8[M]')
+    else:
+        units = {'minute': 'm', 'hour': 'h', 'day': 'D', 'month': 'M', 'year': 'Y'}
+        truncated = timestamps.astype('M8[{}]'.format(units[time_period]))
+    return truncated.astype('M8[ns]')
+
+
+def group_codes(columns):
+    '''
+    Combines integer columns into one dense group code per row
+    Input:
+        columns (list) -- list of equal length integer arrays
+    Output:
+        tuple of the group code of each row, and the index of the first row of
+        each group
+    '''
+    codes = np.zeros(len(columns[0]), dtype=np.int64)
+    for column in columns:
+        _, column_codes = np.unique(column, return_inverse=True)
+        # Re-densify after each column so the codes stay below the number of
+        # rows and cannot overflow
+        _, codes = np.unique(codes * (column_codes.max() + 1) + column_codes,
+                             return_inverse=True)
+    _, first_rows = np.unique(codes, return_index=True)
+    return codes, first_rows
+
+
+class cube_builder(object):
+    '''
+    Aggregates chunks of processed playlogs into a set of cuboids
+    '''
+    def __init__(self, cuboids):
+        self.cuboids = [(time_period, sorted(factors)) for time_period, factors in cuboids]
+        self.factors = sorted(set(factor for _, factors in self.cuboids for factor in factors))
+
+        # Values of each factor, in the order of their codes
+        self.categories = dict((factor, []) for factor in self.factors)
+        self.category_codes = dict((factor, {}) for factor in self.factors)
+
+        # Partial sums per cuboid, merged every MAX_PARTIALS chunks
+        self.partials = dict((view_name(*cuboid), []) for cuboid in self.cuboids)
+        self.n_rows = 0
+
+    def encode(self, factor, values):
+        '''
+        Maps the values of a factor in a chunk to codes that are stable
+        across chunks, only looking up each distinct value once
+        '''
+        chunk_codes, uniques = pd.factorize(values)
+        category_codes = self.category_codes[factor]
+        lookup = np.empty(len(uniques) + 1, dtype=np.int32)
+        for i, value in enumerate(uniques):
+            if value not in category_codes:
+                category_codes[value] = len(self.categories[factor])
+                self.categories[factor].append(value)
+            lookup[i] = category_codes[value]
+        # Missing values have chunk code -1 and map to a shared missing code
+        lookup[-1] = -1
+        return lookup.take(chunk_codes)
+
+    def add_chunk(self, df):
+        '''
+        Input:
+            df (dataframe) -- processed playlogs (see
+                              loaddatatosql.process_playlogs_data)
+        '''
+        # Missing values count as zero, as SUM ignores NULLs
+        measures = {'netwins': (df.amountbet - df.amountwon).values,
+                    'handlepulls': df.gamesplayed.values,
+                    'amountwon': df.amountwon.values,
+                    'amountbet': df.amountbet.values}
+        for measure in MEASURES:
+            measures[measure] = np.nan_to_num(measures[measure].astype(np.float64))
+        codes = dict((factor, self.encode(factor, df[factor].values)) for factor in self.factors)
+        timestamps = df.tmstmp.values
+
+        for time_period, factors in self.cuboids:
+            periods = truncate_period(timestamps, time_period)
+            groups, first_rows = group_codes([periods.astype(np.int64)] +
+                                             [codes[factor] for factor in factors])
+            partial = pd.DataFrame({time_period: periods[first_rows]})
+            for factor in factors:
+                partial[factor] = codes[factor][first_rows]
+            for measure in MEASURES:
+                partial[measure] = np.bincount(groups, weights=measures[measure],
+                                               minlength=len(first_rows))
+            partials = self.partials[view_name(time_period, factors)]
+            partials.append(partial)
+            if len(partials) >= MAX_PARTIALS:
+                partials[:] = [self.merge(partials, time_period, factors)]
+        self.n_rows += len(df)
+
+    def merge(self, partials, time_period, factors):
+        '''
+        Sums partial results of a cuboid into one
+        '''
+        return pd.concat(partials).groupby([time_period] + factors,
+                                           as_index=False).sum()
+
+    def result(self, time_period, factors):
+        '''
+        Output:
+            DataFrame of the cuboid, with the factors as categoricals, in the
+            same layout as the rollup view of the same name
+        '''
+        factors = sorted(factors)
+        partials = self.partials[view_name(time_period, factors)]
+        if not partials:
+            return pd.DataFrame(columns=MEASURES + [time_period] + factors)
+        df = self.merge(partials, time_period, factors)
+        for factor in factors:
+            df[factor] = pd.Categorical.from_codes(df[factor].values,
+                                                   self.categories[factor])
+        return df[MEASURES + [time_period] + factors]
+
+    def write(self, directory):
+        '''
+        Writes every cuboid to directory as <rollup view name>.npz
+        '''
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+        for time_period, factors in self.cuboids:
+            df = self.result(time_period, factors)
+            columns = {time_period: df[time_period].values.astype(np.int64)}
+            for measure in MEASURES:
+                columns[measure] = df[measure].values.astype(np.float64)
+            for factor in factors:
+                columns[factor] = df[factor].cat.codes.values
+                columns[factor + '__categories'] = np.array(df[factor].cat.categories, dtype=object)
+            np.savez_compressed(os.path.join(directory, view_name(time_period, factors) + '.npz'),
+                                **columns)
+
+
+@helper.timeit
+def build_cube_from_csv(csv_path, cuboids, directory, chunksize=loaddatatosql.CHUNKSIZE):
+    '''
+    Builds cuboids from the raw playlogs csv and writes them to directory
+    '''
+    builder = cube_builder(cuboids)
+    timestamp_formats = {}
+    for chunk in pd.read_csv(csv_path, chunksize=chunksize):
+        builder.add_chunk(loaddatatosql.process_playlogs_data(chunk, timestamp_formats))
+    builder.write(directory)
+    return builder
+
+
+@helper.timeit
+def build_cube_from_sql(engine, cuboids, directory, table_name='current_logs',
+                        chunksize=loaddatatosql.CHUNKSIZE):
+    '''
+    Builds cuboids from the raw playlogs table, streamed through a server
+    side cursor, and writes them to directory
+    '''
+    builder = cube_builder(cuboids)
+    columns = ['tmstmp', 'amountbet', 'amountwon', 'gamesplayed'] + builder.factors
+    connection = engine.connect().execution_options(stream_results=True)
+    try:
+        for chunk in pd.read_sql_query("""SELECT {} FROM {};""".format(', '.join(columns), table_name),
+                                       connection, chunksize=chunksize):
+            builder.add_chunk(chunk)
+    finally:
+        connection.close()
+    builder.write(directory)
+    return builder
+
+
+# Cuboids loaded by load_cuboid, by path
+loaded_cuboids = {}
+
+
+def load_cuboid(path):
+    '''
+    Loads a cuboid written by cube_builder.write into a DataFrame, keeping it
+    in memory for later calls
+    '''
+    if path not in loaded_cuboids:
+        time_period, factors = parse_view_name(os.path.basename(path)[:-len('.npz')])
+        columns = np.load(path, allow_pickle=True)
+        df = pd.DataFrame(dict((measure, columns[measure]) for measure in MEASURES))
+        df[time_period] = columns[time_period].astype('M8[ns]')
+        for factor in factors:
+            df[factor] = pd.Categorical.from_codes(columns[factor],
+                                                   columns[factor + '__categories'])
+        loaded_cuboids[path] = df
+    return loaded_cuboids[path]
+
+
+def get_cube_catalog(directory):
+    '''
+    Same as rollup_views.load_view_catalog, for the cuboids in directory, so
+    query_parameters.generate_sql_query can route a query to a cuboid
+    '''
+    catalog = {}
+    for path in glob.glob(os.path.join(directory, '*.npz')):
+        parsed = parse_view_name(os.path.basename(path)[:-len('.npz')])
+        if parsed:
+            catalog[(parsed[0], tuple(parsed[1]))] = len(load_cuboid(path))
+    return catalog
+
+
+def aggregate_frame(df, source_period, query_params):
+    '''
+    Answers a query from a DataFrame laid out like a rollup view, returning
+    the same columns as query_params.sql_string would
+    Input:
+        df (dataframe) -- rollup with measure columns, a source_period column
+                          and factor columns
+        source_period (string) -- period of the rollup
+        query_params -- query parameters object after generate_sql_query
+    Output:
+        DataFrame of metric, tmstmp and factor columns, of the requested
+        statistic of metric, or of the ranked bar chart rows
+    '''
+    # Every requested period the range touches is read whole, as in SQL
+    start, stop = truncate_period([pd.Timestamp(query_params.sql_start),
+                                   pd.Timestamp(query_params.sql_stop)],
+                                  query_params.sql_period)
+    periods = truncate_period(df[source_period].values, query_params.sql_period)
+    mask = (periods >= start) & (periods <= stop)
+    df = df[mask]
+
+    result = pd.DataFrame({'metric': df[query_params.sql_metric].values,
+                           'tmstmp': periods[mask]})
+    for factor in query_params.sql_factors:
+        result[factor] = np.asarray(df[factor])
+
+    # Aggregate up to the requested period and factors
+    result = result.groupby(['tmstmp'] + query_params.sql_factors,
+                            as_index=False).sum()
+    if query_params.latest_period_only and len(result):
+        result = result[result.tmstmp == result.tmstmp.max()]
+
+    if query_params.statistic:
+        function = translation_dictionary.get(query_params.statistic, query_params.statistic)
+        return pd.DataFrame({function.lower(): [result.metric.agg(STATISTIC_FUNCTIONS[function])]})
+    if query_params.sql_top_factor:
+        return rank_factor_frame(result, query_params)
+    return result[['metric', 'tmstmp'] + query_params.sql_factors]
+
+
+def rank_factor_frame(df, query_params):
+    '''
+    Same as the ranking generate_sql_query adds for a bar chart
+    Input:
+        df (dataframe) -- metric and factor columns
+        query_params -- query parameters object with sql_top_factor set
+    Output:
+        DataFrame of the sql_top_factor column and the summed metric, with
+        the top sql_limit rows and the worst row if sql_include_worst is set
+    '''
+    factor = query_params.sql_top_factor
+    ranked = df.groupby(factor, as_index=False)['metric'].sum()
+    result = ranked.sort_values('metric', ascending=False).iloc[:query_params.sql_limit]
+    if query_params.sql_include_worst:
+        result = pd.concat([result, ranked.sort_values('metric').iloc[:1]]).drop_duplicates()
+    return result[[factor, 'metric']]
+
+
+@helper.timeit
+def query_cube(query_params, directory):
+    '''
+    Answers a query from the cuboids in directory
+    Input:
+        query_params -- query parameters object after generate_sql_query was
+                        run with get_cube_catalog(directory) as its catalog
+        directory (string) -- directory of the cuboids
+    Output:
+        DataFrame shaped like the result of query_params.sql_string
+    '''
+    path = os.path.join(directory, query_params.database_name + '.npz')
+    source_period, _ = parse_view_name(query_params.database_name)
+    return aggregate_frame(load_cuboid(path), source_period, query_params)
+
+
+if __name__ == "__main__":
+    import sys
+    from database_building import ROLLUP_TARGETS
+    csv_path = sys.argv[1] if len(sys.argv) > 1 else loaddatatosql.PLAYLOGS_CSV_PATH
+    directory = sys.argv[2] if len(sys.argv) > 2 else '../data/cube'
+    build_cube_from_csv(csv_path, ROLLUP_TARGETS, directory)
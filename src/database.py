@@ -0,0 +1,241 @@
+'''
+Module for connecting to the playlogs database.
+
+Every module gets its engine from get_engine, which creates it on first use
+and shares it afterwards, so the app holds one connection pool. Pools check
+connections that sat idle with a cheap query before handing them out,
+recycle them before the hosted database drops them, and cancel statements
+running longer than statement_timeout. pool_status reports how long
+checkouts waited for a connection, how many connections are in use and how
+many were opened and closed, for sizing the pool to the dashboard's
+concurrency.
+
+Pool settings can be overridden with the DATABASE_POOL_SIZE,
+DATABASE_MAX_OVERFLOW, DATABASE_POOL_TIMEOUT, DATABASE_POOL_RECYCLE and
+DATABASE_STATEMENT_TIMEOUT environment variables.
+'''
+
+import json
+import os
+import threading
+import time
+from sqlalchemy import create_engine, event, exc
+from sqlalchemy.pool import QueuePool
+
+DATABASE_HOST = 'soft-feijoa.db.elephantsql.com'
+DATABASE_PORT = '5432'
+DATABASE_NAME = 'ohdimqey'
+DATABASE_USER = 'ohdimqey'
+
+# File the database password is read from
+PASSWORDS_PATH = 'passwords.json'
+
+# Connections kept open, and opened on top of them under load
+POOL_SIZE = int(os.getenv('DATABASE_POOL_SIZE', 5))
+MAX_OVERFLOW = int(os.getenv('DATABASE_MAX_OVERFLOW', 10))
+
+# Seconds a checkout waits for a connection before failing
+POOL_TIMEOUT = int(os.getenv('DATABASE_POOL_TIMEOUT', 30))
+
+# Seconds after which a connection is replaced
+POOL_RECYCLE = int(os.getenv('DATABASE_POOL_RECYCLE', 1800))
+
+# Milliseconds a statement may run before postgres cancels it, 0 for no limit
+STATEMENT_TIMEOUT = int(os.getenv('DATABASE_STATEMENT_TIMEOUT', 30000))
+
+# Seconds a connection can sit idle in the pool before it is pinged on
+# checkout
+PING_AFTER_IDLE = 10
+
+
+def get_database_string(passwords_path=PASSWORDS_PATH):
+    '''
+    Builds the connection string of the playlogs database
+    Input:
+        passwords_path (string) -- path of the json file holding
+                                   DATABASE_PASSWORD
+    Output:
+        string of the database url
+    '''
+    # Read password from external file
+    with open(passwords_path) as data_file:
+        data = json.load(data_file)
+    return 'postgres://{}:{}@{}:{}/{}'.format(DATABASE_USER,
+                                              data['DATABASE_PASSWORD'],
+                                              DATABASE_HOST,
+                                              DATABASE_PORT,
+                                              DATABASE_NAME)
+
+
+class pool_stats(object):
+    '''
+    Counters of a connection pool
+    '''
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.checkouts = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+        self.connects = 0
+        self.closes = 0
+        self.invalidations = 0
+        self.failed_pings = 0
+
+    def record_wait(self, seconds):
+        with self.lock:
+            self.checkouts += 1
+            self.total_wait += seconds
+            self.max_wait = max(self.max_wait, seconds)
+
+    def increment(self, counter):
+        with self.lock:
+            setattr(self, counter, getattr(self, counter) + 1)
+
+
+class metered_pool(QueuePool):
+    '''
+    QueuePool that records how long each checkout waited for a connection
+    '''
+    def __init__(self, *args, **kw):
+        QueuePool.__init__(self, *args, **kw)
+        self.stats = pool_stats()
+
+    def _do_get(self):
+        ts = time.time()
+        try:
+            return QueuePool._do_get(self)
+        finally:
+            self.stats.record_wait(time.time() - ts)
+
+    def recreate(self):
+        # Keep counting in the same stats when the engine is disposed
+        pool = QueuePool.recreate(self)
+        pool.stats = self.stats
+        return pool
+
+
+def add_pool_listeners(pool):
+    '''
+    Pings idle connections on checkout, replacing dead ones, and counts
+    connection churn in pool.stats
+    '''
+    @event.listens_for(pool, 'checkout')
+    def ping_connection(dbapi_connection, connection_record, connection_proxy):
+        last_checkin = connection_record.info.get('last_checkin')
+        if last_checkin is None or time.time() - last_checkin < PING_AFTER_IDLE:
+            return
+        cursor = dbapi_connection.cursor()
+        try:
+            cursor.execute('SELECT 1')
+        except Exception:
+            pool.stats.increment('failed_pings')
+            # The pool discards the connection and checks out another
+            raise exc.DisconnectionError()
+        finally:
+            cursor.close()
+
+    @event.listens_for(pool, 'checkin')
+    def record_checkin(dbapi_connection, connection_record):
+        if connection_record is not None:
+            connection_record.info['last_checkin'] = time.time()
+
+    @event.listens_for(pool, 'connect')
+    def count_connect(dbapi_connection, connection_record):
+        pool.stats.increment('connects')
+
+    @event.listens_for(pool, 'close')
+    def count_close(dbapi_connection, connection_record):
+        pool.stats.increment('closes')
+
+    @event.listens_for(pool, 'invalidate')
+    def count_invalidate(dbapi_connection, connection_record, exception):
+        pool.stats.increment('invalidations')
+
+
+def create_database_engine(database_string, pool_size=POOL_SIZE,
+                           max_overflow=MAX_OVERFLOW, pool_timeout=POOL_TIMEOUT,
+                           pool_recycle=POOL_RECYCLE,
+                           statement_timeout=STATEMENT_TIMEOUT):
+    '''
+    Creates an engine with a metered, health checked connection pool
+    Input:
+        database_string (string) -- database url
+        pool_size (int) -- connections kept open
+        max_overflow (int) -- connections opened on top of pool_size under
+                              load
+        pool_timeout (int) -- seconds a checkout waits for a connection
+        pool_recycle (int) -- seconds after which a connection is replaced
+        statement_timeout (int) -- milliseconds a statement may run, 0 for
+                                   no limit
+    Output:
+        sqlalchemy engine
+    '''
+    connect_args = {}
+    if statement_timeout:
+        connect_args['options'] = '-c statement_timeout={}'.format(statement_timeout)
+    engine = create_engine(database_string,
+                           poolclass=metered_pool,
+                           pool_size=pool_size,
+                           max_overflow=max_overflow,
+                           pool_timeout=pool_timeout,
+                           pool_recycle=pool_recycle,
+                           connect_args=connect_args)
+    add_pool_listeners(engine.pool)
+    return engine
+
+
+# Engines created by get_engine, by their settings
+engines = {}
+engines_lock = threading.Lock()
+
+
+def get_engine(**settings):
+    '''
+    Returns the engine of the playlogs database, creating it on first use
+    Input:
+        settings -- keyword arguments of create_database_engine other than
+                    database_string; callers asking for the same settings
+                    share an engine
+    Output:
+        sqlalchemy engine
+    '''
+    key = tuple(sorted(settings.items()))
+    with engines_lock:
+        if key not in engines:
+            engines[key] = create_database_engine(get_database_string(), **settings)
+        return engines[key]
+
+
+def dispose_engines():
+    '''
+    Closes the pooled connections of the engines created by get_engine, e.g.
+    before forking, so child processes do not share their sockets. The
+    engines open new connections on their next use.
+    '''
+    with engines_lock:
+        for engine in engines.values():
+            engine.dispose()
+
+
+def pool_status(engine):
+    '''
+    Input:
+        engine -- engine created by create_database_engine
+    Output:
+        dictionary of the pool's occupancy, checkout waits and connection
+        churn
+    '''
+    pool = engine.pool
+    stats = pool.stats
+    with stats.lock:
+        return {'size': pool.size(),
+                'checked_out': pool.checkedout(),
+                'checked_in': pool.checkedin(),
+                'overflow': pool.overflow(),
+                'checkouts': stats.checkouts,
+                'mean_wait': stats.total_wait / stats.checkouts if stats.checkouts else 0.0,
+                'max_wait': stats.max_wait,
+                'connects': stats.connects,
+                'closes': stats.closes,
+                'invalidations': stats.invalidations,
+                'failed_pings': stats.failed_pings}
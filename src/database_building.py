@@ -1,10 +1,16 @@
 import helper
+import database
 import json
-import psycopg2
-from sqlalchemy import create_engine
-from main import get_data_from_nl_query
-from generateresponsefromrequest import get_intent_entity_from_watson
-from query_parameters import translation_dictionary
+import result_cache
+import time
+import Queue
+import hashlib
+import threading
+from datetime import datetime
+from multiprocessing.pool import ThreadPool
+from sqlalchemy import text
+from rollup_views import view_name, parse_view_name, can_roll_up, covers, \
+                         PERIOD_ORDER
 
 # Local database
 # DATABASE_USER = 'test'
@@ -12,23 +18,28 @@ from query_parameters import translation_dictionary
 # DATABASE_DOMAIN = 'tiger@localhost'
 # DATABASE_TABLE = 'logs'
 
-# Read password from external file
-with open('passwords.json') as data_file:
-    data = json.load(data_file)
+# Rollups with these periods get BRIN rather than B-tree indexes on their period
+BRIN_PERIODS = ['minute', 'hour']
 
-DATABASE_HOST = 'soft-feijoa.db.elephantsql.com'
-DATABASE_PORT = '5432'
-DATABASE_NAME = 'ohdimqey'
-DATABASE_USER = 'ohdimqey'
-DATABASE_PASSWORD = data['DATABASE_PASSWORD']
+# Factors that get a composite (factor, period) index on every rollup with them
+INDEXED_FACTORS = ['assetnumber', 'bank', 'clublevel']
 
-# Connect to database
-database_string = 'postgres://{}:{}@{}:{}/{}'.format(DATABASE_USER,
-                                                     DATABASE_PASSWORD,
-                                                     DATABASE_HOST,
-                                                     DATABASE_PORT,
-                                                     DATABASE_NAME)
-engine = create_engine(database_string)
+# File recording the indexes of every rollup
+INDEX_MANIFEST = 'rollup_indexes.json'
+manifest_lock = threading.Lock()
+
+# Serializes creating the refresh log across refresh workers
+refresh_log_lock = threading.Lock()
+
+# Rollups the app reads from, as (time_period, factors)
+ROLLUP_TARGETS = [('month', ['assetnumber', 'assettitle']),
+                  ('day', ['assetnumber', 'assettitle']),
+                  ('week', ['assetnumber', 'assettitle'])]
+for time_period in ['week', 'day', 'hour', 'month']:
+    ROLLUP_TARGETS += [(time_period, ['bank', 'clublevel', 'zone', 'area', 'assettitle', 'stand']),
+                       (time_period, ['bank', 'clublevel', 'zone', 'area', 'stand']),
+                       (time_period, ['bank', 'clublevel', 'zone', 'area', 'assettitle']),
+                       (time_period, ['bank', 'clublevel', 'zone', 'area'])]
 
 def get_database_schema(cur, table):
     '''
@@ -43,6 +54,228 @@ def get_database_schema(cur, table):
     rows = cur.fetchall()
     return [element[0] for element in rows]
 
+def next_month(month):
+    '''
+    First instant of the month following the month of a datetime
+    '''
+    if month.month == 12:
+        return datetime(month.year + 1, 1, 1)
+    return datetime(month.year, month.month + 1, 1)
+
+def month_starts(start, stop):
+    '''
+    Lists the first instant of every month overlapping a time range
+    Input:
+        start (datetime) -- start of the range
+        stop (datetime) -- end of the range
+    Output:
+        list of datetimes of the first instant of each month
+    '''
+    month = datetime(start.year, start.month, 1)
+    months = []
+    while month <= stop:
+        months.append(month)
+        month = next_month(month)
+    return months
+
+def partition_name(table_name, month):
+    '''
+    Name of the monthly partition of table_name starting at month
+    '''
+    return '{}_y{:04d}m{:02d}'.format(table_name, month.year, month.month)
+
+def month_partition_sql(table_name, month):
+    '''
+    Builds the statement creating the monthly partition of a table that is
+    range partitioned on time
+    Input:
+        table_name (string) -- string of the partitioned table
+        month (datetime) -- first instant of the month
+    Output:
+        string of the SQL statement
+    '''
+    return """CREATE TABLE IF NOT EXISTS {} PARTITION OF {}
+              FOR VALUES FROM ('{}') TO ('{}');""".format(partition_name(table_name, month),
+                                                         table_name,
+                                                         month,
+                                                         next_month(month))
+
+def is_partitioned(connection, table_name):
+    '''
+    Checks whether table_name is a partitioned table
+    Input:
+        connection -- sqlalchemy connection
+        table_name (string) -- string of table to check
+    Output:
+        boolean
+    '''
+    row = connection.execute("""SELECT count(*) FROM pg_partitioned_table
+                                WHERE partrelid = to_regclass('{}');""".format(table_name)).fetchone()
+    return row[0] > 0
+
+def create_month_partitions(engine, start, stop, table_name='current_logs'):
+    '''
+    Creates any missing monthly partitions of table_name covering a time range,
+    e.g. the upcoming months before their data arrives
+    Input:
+        engine -- sqlalchemy engine
+        start (datetime) -- start of the range
+        stop (datetime) -- end of the range
+        table_name (string) -- string of the partitioned table
+    Output:
+        None
+    '''
+    connection = engine.connect()
+    for month in month_starts(start, stop):
+        connection.execute(month_partition_sql(table_name, month))
+
+def detach_old_partitions(engine, before, table_name='current_logs'):
+    '''
+    Detaches the monthly partitions of table_name that end on or before a
+    given time. Detached partitions keep their data as standalone tables, so
+    they can be archived or dropped separately.
+    Input:
+        engine -- sqlalchemy engine
+        before (datetime) -- partitions ending on or before this are detached
+        table_name (string) -- string of the partitioned table
+    Output:
+        list of strings of the detached partitions
+    '''
+    connection = engine.connect()
+    rows = connection.execute("""SELECT child.relname FROM pg_inherits
+                                 JOIN pg_class child ON child.oid = pg_inherits.inhrelid
+                                 WHERE pg_inherits.inhparent = to_regclass('{}');""".format(table_name)).fetchall()
+    detached = []
+    for row in rows:
+        name = row[0]
+        try:
+            month = datetime.strptime(name[len(table_name):], '_y%Ym%m')
+        except ValueError:
+            continue
+        if next_month(month) <= before:
+            print "Detaching partition {}".format(name)
+            connection.execute("""ALTER TABLE {} DETACH PARTITION {};""".format(table_name, name))
+            detached.append(name)
+    return detached
+
+def source_time_column(table_name):
+    '''
+    Name of the time column of a table rollups can be built from: tmstmp for
+    the raw playlogs, or the period column of another rollup
+    '''
+    parsed = parse_view_name(table_name)
+    if parsed:
+        return parsed[0]
+    return 'tmstmp'
+
+def rollup_select_sql(time_period, factors, table_name, since=None):
+    '''
+    Builds the SELECT statement that aggregates the raw playlogs, or a finer
+    rollup, into a rollup
+    Input:
+        time_period (string) -- string of time period we want to aggregate on
+        factors (list) -- sorted list of strings of factors to group by
+        table_name (string) -- string of table or rollup we are aggregating
+                               from
+        since (datetime) -- if given, only the time buckets containing or
+                            following this time are aggregated
+    Output:
+        string of the SQL statement
+    '''
+    factor_string = ''
+    for factor in factors:
+        factor_string += ', '
+        factor_string += factor
+
+    time_column = source_time_column(table_name)
+    if since is not None:
+        where_string = """WHERE {}.{} >= date_trunc('{}', TIMESTAMP '{}')""".format(
+            table_name, time_column, time_period, since)
+    else:
+        where_string = ''
+
+    if parse_view_name(table_name):
+        # Rolling up a rollup, whose metrics are already sums
+        metrics_string = """SUM(netwins) AS netwins,
+                     SUM(handlepulls) AS handlepulls,"""
+    else:
+        metrics_string = """SUM(amountbet - amountwon) AS netwins,
+                     SUM(gamesplayed) AS handlepulls,"""
+
+    return """SELECT {}
+                     SUM(amountwon) AS amountwon,
+                     SUM(amountbet) AS amountbet,
+                     date_trunc('{}', {}.{}) AS {}{}
+              FROM {}
+              {}
+              GROUP BY date_trunc('{}', {}.{}){}""".format(metrics_string,
+                                                           time_period,
+                                                           table_name,
+                                                           time_column,
+                                                           time_period,
+                                                           factor_string,
+                                                           table_name,
+                                                           where_string,
+                                                           time_period,
+                                                           table_name,
+                                                           time_column,
+                                                           factor_string)
+
+def plan_rollup_lattice(targets, add_base=True):
+    '''
+    Plans how to build a set of rollups as a lattice, each rollup being built
+    from the smallest finer rollup that covers it rather than from the raw
+    playlogs. Month and week rollups come from day rollups, day from hour, and
+    a rollup from the rollup of the same period with a superset of its
+    factors.
+    Input:
+        targets (list) -- list of (time_period, factors) tuples to build
+        add_base (bool) -- whether to add a base rollup covering every target,
+                           so the raw playlogs are scanned only once. Its
+                           factors are capped so its name fits in the 63
+                           characters postgres allows, leaving targets with
+                           the other factors to be built from the playlogs
+    Output:
+        list of (time_period, factors, parent) tuples in build order, where
+        parent is the (time_period, factors) tuple of the rollup to build from,
+        or None to build from the raw playlogs
+    '''
+    nodes = []
+    for time_period, factors in targets:
+        node = (time_period, sorted(set(factors)))
+        if node not in nodes:
+            nodes.append(node)
+
+    if add_base and nodes:
+        for base_period in reversed(PERIOD_ORDER):
+            if all(can_roll_up(base_period, node[0]) for node in nodes):
+                break
+        # Cover the targets with the most factors first, as far as the name
+        # of the base allows
+        base_factors = []
+        for node in sorted(nodes, key=lambda node: -len(node[1])):
+            factors = sorted(set(base_factors + node[1]))
+            if len(view_name(base_period, factors)) <= 63:
+                base_factors = factors
+        if base_factors and (base_period, base_factors) not in nodes:
+            nodes.append((base_period, base_factors))
+
+    # Finest period first, then most factors first, so every rollup comes
+    # after any rollup that covers it
+    nodes.sort(key=lambda node: (PERIOD_ORDER.index(node[0]), -len(node[1])))
+
+    plan = []
+    for i, node in enumerate(nodes):
+        parents = [other for other in nodes[:i] if covers(other, node)]
+        if parents:
+            # Prefer the coarsest period, then the fewest factors
+            parent = min(parents, key=lambda other: (-PERIOD_ORDER.index(other[0]),
+                                                     len(other[1])))
+        else:
+            parent = None
+        plan.append((node[0], node[1], parent))
+    return plan
+
 @helper.timeit
 def make_materialized_view(engine, time_period, factors, table_name):
     '''
@@ -52,7 +285,8 @@ def make_materialized_view(engine, time_period, factors, table_name):
         factors (list) -- list of strings of factors we want to group by in our
                    materialized view
         time_period (string) -- string of time period we want to aggregate on
-        table_name (string) -- string of table we are building views from
+        table_name (string) -- string of table or finer view we are building
+                               the view from
     Output:
         None
     '''
@@ -61,61 +295,420 @@ def make_materialized_view(engine, time_period, factors, table_name):
 
     # Alphabetize factors
     factors.sort()
+    title_string = view_name(time_period, factors)
 
-    factor_string = ''
-    title_string = time_period + '_factored_by'
-    for factor in factors:
-        factor_string += ', '
-        factor_string += factor
-        title_string += '_'
-        title_string += factor
-
-    # Drop materialized view if exists
-    SQL_string = """DROP MATERIALIZED VIEW IF EXISTS {};""".format(title_string)
+    # Drop materialized view if exists, along with the views built from it,
+    # which build_rollup_lattice rebuilds afterwards
+    SQL_string = """DROP MATERIALIZED VIEW IF EXISTS {} CASCADE;""".format(title_string)
     connection.execute(SQL_string)
 
     # Build materialized view
     print "Creating materialized view: {}".format(title_string)
-    SQL_string =  """CREATE MATERIALIZED VIEW IF NOT EXISTS {} AS
-                      SELECT SUM(amountbet - amountwon) AS netwins,
-                             SUM(gamesplayed) AS handlepulls,
-                             SUM(amountwon) AS amountwon,
-                             SUM(amountbet) AS amountbet,
-                             date_trunc('{}', {}.tmstmp) AS {}{}
-                      FROM {}
-                      GROUP BY date_trunc('{}', {}.tmstmp){};""".format(title_string,
-                                                                        time_period,
-                                                                        table_name,
-                                                                        time_period,
-                                                                        factor_string,
-                                                                        table_name,
-                                                                        time_period,
-                                                                        table_name,
-                                                                        factor_string)
+    SQL_string = """CREATE MATERIALIZED VIEW IF NOT EXISTS {} AS
+                    {};""".format(title_string,
+                                  rollup_select_sql(time_period, factors, table_name))
     print "SQL command to build materialized view: {}".format(SQL_string)
     result = connection.execute(SQL_string)
+    create_view_indexes(connection, time_period, factors)
+    record_rollup_refresh(connection, title_string)
+
+def index_name(title_string, suffix):
+    '''
+    Name of an index of a rollup, shortened with a hash to fit in the 63
+    characters postgres allows
+    '''
+    name = '{}_{}'.format(title_string, suffix)
+    if len(name) > 63:
+        name = '{}_{}'.format(name[:54], hashlib.md5(name).hexdigest()[:8])
+    return name
+
+def view_index_specs(time_period, factors, materialized=True):
+    '''
+    Lists the indexes a rollup should have:
+    1. materialized views get a unique index on their period and factor
+       columns, which REFRESH MATERIALIZED VIEW CONCURRENTLY requires and which
+       also serves range predicates on the period
+    2. minute and hour rollups, which are large and written in time order,
+       get a BRIN index on their period; other rollup tables get a B-tree
+    3. composite (factor, period) indexes for the factors in
+       INDEXED_FACTORS, for queries filtering on one value of them
+    Input:
+        time_period (string) -- period the rollup is aggregated on
+        factors (list) -- sorted list of strings of factors of the rollup
+        materialized (bool) -- whether the rollup is a materialized view
+    Output:
+        list of dictionaries with the name, method, columns and uniqueness of
+        each index
+    '''
+    title_string = view_name(time_period, factors)
+    specs = []
+    if materialized:
+        specs.append({'name': index_name(title_string, 'key'), 'method': 'btree',
+                      'columns': [time_period] + factors, 'unique': True})
+    if time_period in BRIN_PERIODS:
+        specs.append({'name': index_name(title_string, time_period + '_idx'), 'method': 'brin',
+                      'columns': [time_period], 'unique': False})
+    elif not materialized:
+        specs.append({'name': index_name(title_string, time_period + '_idx'), 'method': 'btree',
+                      'columns': [time_period], 'unique': False})
+    for factor in INDEXED_FACTORS:
+        if factor in factors:
+            specs.append({'name': index_name(title_string, factor + '_' + time_period + '_idx'),
+                          'method': 'btree', 'columns': [factor, time_period],
+                          'unique': False})
+    return specs
+
+def record_index_manifest(title_string, specs, manifest_path=INDEX_MANIFEST):
+    '''
+    Records the indexes of a rollup in the index manifest, a JSON file
+    mapping each rollup name to its list of index specs
+    '''
+    with manifest_lock:
+        try:
+            with open(manifest_path) as manifest_file:
+                manifest = json.load(manifest_file)
+        except IOError:
+            manifest = {}
+        manifest[title_string] = specs
+        with open(manifest_path, 'w') as manifest_file:
+            json.dump(manifest, manifest_file, indent=2, sort_keys=True)
+
+def create_view_indexes(connection, time_period, factors, materialized=True):
+    '''
+    Creates any missing indexes of a rollup (see view_index_specs) and
+    records them in the index manifest
+    Input:
+        connection -- sqlalchemy connection
+        time_period (string) -- period the rollup is aggregated on
+        factors (list) -- sorted list of strings of factors of the rollup
+        materialized (bool) -- whether the rollup is a materialized view
+    Output:
+        list of the index specs
+    '''
+    title_string = view_name(time_period, factors)
+    specs = view_index_specs(time_period, factors, materialized)
+    for spec in specs:
+        SQL_string = """CREATE {}INDEX IF NOT EXISTS {}
+                        ON {} USING {} ({});""".format('UNIQUE ' if spec['unique'] else '',
+                                                       spec['name'],
+                                                       title_string,
+                                                       spec['method'],
+                                                       ', '.join(spec['columns']))
+        connection.execute(SQL_string)
+    record_index_manifest(title_string, specs)
+    return specs
+
+def refresh_materialized_view(connection, name):
+    '''
+    Refreshes a materialized view, concurrently if it is populated so that
+    it can still be read while it rebuilds
+    Input:
+        connection -- sqlalchemy connection
+        name (string) -- name of the materialized view
+    Output:
+        None
+    '''
+    row = connection.execute("""SELECT relispopulated FROM pg_class
+                                WHERE relname = '{}' AND relkind = 'm';""".format(name)).fetchone()
+    if row and row[0]:
+        SQL_string = """REFRESH MATERIALIZED VIEW CONCURRENTLY {};""".format(name)
+    else:
+        SQL_string = """REFRESH MATERIALIZED VIEW {};""".format(name)
+    connection.execute(text(SQL_string).execution_options(autocommit=True))
+    record_rollup_refresh(connection, name)
+
+def record_rollup_refresh(connection, name):
+    '''
+    Records that a rollup was rebuilt in the rollup_refreshes table, which
+    the app's result cache polls to drop results read from it (see
+    result_cache.sync_refreshes), and drops them from this process's cache
+    Input:
+        connection -- sqlalchemy connection
+        name (string) -- name of the rollup
+    Output:
+        None
+    '''
+    with refresh_log_lock:
+        connection.execute("""CREATE TABLE IF NOT EXISTS {} (
+                                  view_name text PRIMARY KEY,
+                                  refreshed_at timestamptz NOT NULL);""".format(result_cache.REFRESH_LOG_TABLE))
+    connection.execute("""INSERT INTO {} VALUES ('{}', clock_timestamp())
+                          ON CONFLICT (view_name)
+                          DO UPDATE SET refreshed_at = EXCLUDED.refreshed_at;""".format(
+                              result_cache.REFRESH_LOG_TABLE, name))
+    result_cache.invalidate_view(name)
+
+def rollup_columns_sql(connection, time_period, factors, table_name):
+    '''
+    Builds the column definitions of a rollup table, taking the types of the
+    factor columns from the table the rollup is built from
+    Input:
+        connection -- sqlalchemy connection
+        time_period (string) -- period the rollup is aggregated on
+        factors (list) -- sorted list of strings of factors of the rollup
+        table_name (string) -- string of table the rollup is built from
+    Output:
+        string of the column definitions
+    '''
+    rows = connection.execute("""SELECT attname, format_type(atttypid, atttypmod)
+                                 FROM pg_attribute
+                                 WHERE attrelid = to_regclass('{}')
+                                 AND attnum > 0;""".format(table_name)).fetchall()
+    column_types = dict((row[0], row[1]) for row in rows)
+    columns = ['netwins double precision',
+               'handlepulls bigint',
+               'amountwon double precision',
+               'amountbet double precision',
+               '{} timestamp'.format(time_period)]
+    for factor in factors:
+        columns.append('{} {}'.format(factor, column_types[factor]))
+    return ',\n'.join(columns)
+
+@helper.timeit
+def make_rollup_table(engine, time_period, factors, table_name, partitioned=False):
+    '''
+    Same as make_materialized_view, but stores the rollup as a plain table so
+    that update_rollup_buckets can maintain it incrementally
+    Input:
+        engine -- sqlalchemy cursor
+        factors (list) -- list of strings of factors we want to group by
+        time_period (string) -- string of time period we want to aggregate on
+        table_name (string) -- string of table we are building the rollup from
+        partitioned (bool) -- whether to range partition the rollup by month
+                              on its period column, worthwhile for the large
+                              hour and minute rollups
+    Output:
+        None
+    '''
+    # Connect to engine
+    connection = engine.connect()
+
+    # Alphabetize factors
+    factors.sort()
+    title_string = view_name(time_period, factors)
+
+    # Replace any view or table of the same name
+    print "Creating rollup table: {}".format(title_string)
+    with connection.begin():
+        connection.execute("""DROP MATERIALIZED VIEW IF EXISTS {} CASCADE;""".format(title_string))
+        connection.execute("""DROP TABLE IF EXISTS {} CASCADE;""".format(title_string))
+        if partitioned:
+            connection.execute("""CREATE TABLE {} ({})
+                                  PARTITION BY RANGE ({});""".format(
+                                      title_string,
+                                      rollup_columns_sql(connection, time_period,
+                                                         factors, table_name),
+                                      time_period))
+            time_column = source_time_column(table_name)
+            start, stop = connection.execute("""SELECT min({}), max({})
+                                                FROM {};""".format(time_column,
+                                                                   time_column,
+                                                                   table_name)).fetchone()
+            if start is not None:
+                for month in month_starts(start, stop):
+                    connection.execute(month_partition_sql(title_string, month))
+            connection.execute("""INSERT INTO {}
+                                  {};""".format(title_string,
+                                                rollup_select_sql(time_period, factors, table_name)))
+        else:
+            connection.execute("""CREATE TABLE {} AS
+                                  {};""".format(title_string,
+                                                rollup_select_sql(time_period, factors, table_name)))
+        create_view_indexes(connection, time_period, factors, materialized=False)
+        record_rollup_refresh(connection, title_string)
+
+def get_rollups(connection):
+    '''
+    Finds the rollups that currently exist in the database
+    Input:
+        connection -- sqlalchemy connection
+    Output:
+        list of (name, relkind) tuples, where relkind is 'r' for rollup tables,
+        'p' for partitioned rollup tables and 'm' for materialized views
+    '''
+    # Monthly partitions are updated through their parent
+    rows = connection.execute("""SELECT relname, relkind FROM pg_class
+                                 WHERE relkind IN ('r', 'm', 'p')
+                                 AND NOT relispartition
+                                 AND relname LIKE '%%factored_by%%';""").fetchall()
+    return [(row[0], row[1]) for row in rows if parse_view_name(row[0])]
+
+def update_rollup_buckets(connection, time_period, factors, table_name, since):
+    '''
+    Recomputes only the time buckets of a rollup table that contain or follow
+    since, leaving older buckets untouched
+    Input:
+        connection -- sqlalchemy connection
+        time_period (string) -- period the rollup is aggregated on
+        factors (list) -- sorted list of strings of factors of the rollup
+        table_name (string) -- string of table the rollup is built from
+        since (datetime) -- time of the earliest newly loaded row, or None to
+                            recompute every bucket
+    Output:
+        None
+    '''
+    title_string = view_name(time_period, factors)
+    with connection.begin():
+        if since is None:
+            # Recompute the whole table in place rather than rebuild it, which
+            # would drop the materialized views built from it
+            time_column = source_time_column(table_name)
+            connection.execute("""DELETE FROM {};""".format(title_string))
+            start = connection.execute("""SELECT min({}) FROM {};""".format(time_column,
+                                                                          table_name)).scalar()
+        else:
+            connection.execute("""DELETE FROM {}
+                                  WHERE {} >= date_trunc('{}', TIMESTAMP '{}');""".format(
+                                      title_string, time_period, time_period, since))
+            start = since
+        if start is not None and is_partitioned(connection, title_string):
+            for month in month_starts(start, datetime.now()):
+                connection.execute(month_partition_sql(title_string, month))
+        connection.execute("""INSERT INTO {}
+                              {};""".format(title_string,
+                                            rollup_select_sql(time_period, factors,
+                                                              table_name, since)))
+        record_rollup_refresh(connection, title_string)
+
+@helper.timeit
+def update_rollups_since(engine, since, table_name='current_logs'):
+    '''
+    Brings every rollup up to date after rows newer than since have been
+    appended to table_name. Rollups are updated in lattice order, each rollup
+    table having only its affected time buckets recomputed from the finer
+    rollup covering it; materialized views can only be refreshed in full.
+    Input:
+        engine -- sqlalchemy engine
+        since (datetime) -- high water mark before the rows were appended, or
+                            None if the table was empty
+        table_name (string) -- string of table the rollups are built from
+    Output:
+        None
+    '''
+    connection = engine.connect()
+    relkinds = dict(get_rollups(connection))
+    targets = [parse_view_name(name) for name in relkinds]
+    for time_period, factors, parent in plan_rollup_lattice(targets, add_base=False):
+        name = view_name(time_period, factors)
+        if relkinds[name] in ('r', 'p'):
+            source = view_name(*parent) if parent else table_name
+            print "Updating rollup table {} from {} since {}".format(name, source, since)
+            update_rollup_buckets(connection, time_period, factors, source, since)
+        else:
+            print "Refreshing materialized view {}".format(name)
+            refresh_materialized_view(connection, name)
+
+@helper.timeit
+def build_rollup_lattice(engine, targets, table_name='current_logs', materialized=True):
+    '''
+    Builds a set of rollups in lattice order (see plan_rollup_lattice), so the
+    raw playlogs are scanned once and every other rollup is aggregated from a
+    smaller finer one
+    Input:
+        engine -- sqlalchemy engine
+        targets (list) -- list of (time_period, factors) tuples to build
+        table_name (string) -- string of the raw playlogs table
+        materialized (bool) -- whether to build materialized views or rollup
+                               tables that can be maintained incrementally
+    Output:
+        the plan that was built
+    '''
+    plan = plan_rollup_lattice(targets)
+    for time_period, factors, parent in plan:
+        source = view_name(*parent) if parent else table_name
+        if materialized:
+            make_materialized_view(engine, time_period, factors, source)
+        else:
+            make_rollup_table(engine, time_period, factors, source)
+    return plan
+
+def refresh_rollup(engine, time_period, factors, table_name):
+    '''
+    Creates a materialized view rollup if it does not exist, or refreshes it
+    concurrently if it does
+    Input:
+        engine -- sqlalchemy engine
+        time_period (string) -- period the view is aggregated on
+        factors (list) -- sorted list of strings of factors of the view
+        table_name (string) -- string of table or finer view it is built from
+    Output:
+        dictionary of the view name, seconds taken and number of rows
+    '''
+    title_string = view_name(time_period, factors)
+    ts = time.time()
+    connection = engine.connect()
+    try:
+        SQL_string = """CREATE MATERIALIZED VIEW IF NOT EXISTS {} AS
+                        {} WITH NO DATA;""".format(title_string,
+                                                   rollup_select_sql(time_period, factors, table_name))
+        connection.execute(SQL_string)
+        create_view_indexes(connection, time_period, factors)
+        refresh_materialized_view(connection, title_string)
+        rows = connection.execute("""SELECT count(*) FROM {};""".format(title_string)).scalar()
+    finally:
+        connection.close()
+    return {'view': title_string, 'seconds': time.time() - ts, 'rows': rows}
+
+def refresh_rollup_worker(args):
+    '''
+    Runs refresh_rollup in a worker thread, returning the exception instead
+    of raising it so the scheduler always hears back
+    '''
+    try:
+        return refresh_rollup(*args)
+    except Exception as e:
+        return {'view': view_name(args[1], args[2]), 'error': e}
+
+@helper.timeit
+def refresh_rollup_lattice(engine, targets, table_name='current_logs', n_workers=4,
+                           add_base=True):
+    '''
+    Refreshes a set of materialized view rollups, creating any that are
+    missing. Views are refreshed concurrently on up to n_workers connections,
+    each one starting as soon as the view it is built from (see
+    plan_rollup_lattice) has finished. Views are refreshed with REFRESH
+    MATERIALIZED VIEW CONCURRENTLY, so they can be read throughout.
+    Input:
+        engine -- sqlalchemy engine, whose pool should allow n_workers
+                  connections
+        targets (list) -- list of (time_period, factors) tuples to refresh
+        table_name (string) -- string of the raw playlogs table
+        n_workers (int) -- number of views refreshed at once
+        add_base (bool) -- whether to also build a base rollup covering every
+                           target, see plan_rollup_lattice
+    Output:
+        list of dictionaries of the view name, seconds taken and number of
+        rows for each view, in the order they finished
+    '''
+    pending = plan_rollup_lattice(targets, add_base=add_base)
+    finished = set()
+    results = Queue.Queue()
+    stats = []
+    running = 0
+    pool = ThreadPool(n_workers)
+    try:
+        while pending or running:
+            for node in list(pending):
+                time_period, factors, parent = node
+                if parent is None or view_name(*parent) in finished:
+                    pending.remove(node)
+                    source = view_name(*parent) if parent else table_name
+                    pool.apply_async(refresh_rollup_worker,
+                                     ((engine, time_period, factors, source),),
+                                     callback=results.put)
+                    running += 1
+            result = results.get()
+            running -= 1
+            if 'error' in result:
+                raise result['error']
+            print "Refreshed {view} in {seconds:.1f} sec ({rows} rows)".format(**result)
+            finished.add(result['view'])
+            stats.append(result)
+    finally:
+        pool.terminate()
+    return stats
 
 if __name__ == "__main__":
-    make_materialized_view(engine, 'month', ['assetnumber', 'assettitle'], 'current_logs')
-    make_materialized_view(engine, 'day', ['assetnumber', 'assettitle'], 'current_logs')
-    make_materialized_view(engine, 'week', ['assetnumber', 'assettitle'], 'current_logs')
-    #
-    # make_materialized_view(engine, 'week', ['bank', 'clublevel', 'zone', 'area', 'assettitle', 'stand'], 'current_logs')
-    # make_materialized_view(engine, 'week', ['bank', 'clublevel', 'zone', 'area', 'stand'], 'current_logs')
-    # make_materialized_view(engine, 'week', ['bank', 'clublevel', 'zone', 'area', 'assettitle'], 'current_logs')
-    # make_materialized_view(engine, 'week', ['bank', 'clublevel', 'zone', 'area'], 'current_logs')
-    #
-    # make_materialized_view(engine, 'day', ['bank', 'clublevel', 'zone', 'area', 'assettitle', 'stand'], 'current_logs')
-    # make_materialized_view(engine, 'day', ['bank', 'clublevel', 'zone', 'area', 'stand'], 'current_logs')
-    # make_materialized_view(engine, 'day', ['bank', 'clublevel', 'zone', 'area', 'assettitle'], 'current_logs')
-    # make_materialized_view(engine, 'day', ['bank', 'clublevel', 'zone', 'area'], 'current_logs')
-    #
-    # make_materialized_view(engine, 'hour', ['bank', 'clublevel', 'zone', 'area', 'assettitle', 'stand'], 'current_logs')
-    # make_materialized_view(engine, 'hour', ['bank', 'clublevel', 'zone', 'area', 'stand'], 'current_logs')
-    # make_materialized_view(engine, 'hour', ['bank', 'clublevel', 'zone', 'area', 'assettitle'], 'current_logs')
-    # make_materialized_view(engine, 'hour', ['bank', 'clublevel', 'zone', 'area'], 'current_logs')
-    #
-    # make_materialized_view(engine, 'month', ['bank', 'clublevel', 'zone', 'area', 'assettitle', 'stand'], 'current_logs')
-    # make_materialized_view(engine, 'month', ['bank', 'clublevel', 'zone', 'area', 'stand'], 'current_logs')
-    # make_materialized_view(engine, 'month', ['bank', 'clublevel', 'zone', 'area', 'assettitle'], 'current_logs')
-    # make_materialized_view(engine, 'month', ['bank', 'clublevel', 'zone', 'area'], 'current_logs')
+    # Refreshes run far longer than dashboard queries
+    engine = database.get_engine(statement_timeout=0)
+    refresh_rollup_lattice(engine, ROLLUP_TARGETS, 'current_logs')
@@ -28,8 +28,11 @@ def create_factor_comparison_df(first_half, second_half, factor):
         if the metric is payout rate, the aggregator is going to be
         an average
     '''
-    first_group = first_half.groupby(factor).sum().metric.reset_index()
-    second_group = second_half.groupby(factor).sum().metric.reset_index()
+    # Group by the values of categorical factors (see helper.copy_sql_data),
+    # as grouping by a categorical also returns its categories missing from
+    # the half
+    first_group = first_half.groupby(first_half[factor].astype(object)).sum().metric.reset_index()
+    second_group = second_half.groupby(second_half[factor].astype(object)).sum().metric.reset_index()
     factor_comparison_df = first_group.merge(second_group, on=factor).fillna(0)
     factor_comparison_df.columns = ['factor', 'first_half', 'second_half']
     return factor_comparison_df
@@ -19,7 +19,25 @@ to the nlpapi, and get a response back in the form of
 '''
 
 import helper
-import requests
+import local_nlu
+import nlu_cache
+import os
+import urllib
+from nlu_client import nlu_client, NLUError
+
+# Where intents and entities come from: 'watson', 'local' for local_nlu, or
+# 'auto' for Watson, falling back to local_nlu when it is slow or fails
+NLU_BACKEND = os.getenv('NLU_BACKEND', 'watson')
+
+# Seconds Watson is given to answer before falling back in 'auto' mode
+WATSON_FALLBACK_TIMEOUT = 2.0
+
+# Client of the Watson host, keeping its connections open between requests
+watson_client = nlu_client('https://gaminganalyticsai-host.mybluemix.net')
+
+# Characters kept by normalize_query besides letters, digits and spaces, as
+# they are part of dates and amounts
+KEPT_PUNCTUATION = "/-:.$%'"
 
 def spell_check_word(word):
     '''
@@ -43,6 +61,22 @@ def spell_check_query(query):
     spell_checked_query = query
     return spell_checked_query
 
+def normalize_query(query):
+    '''
+    Args:
+        query (str): this is the natural language string input that the user
+        is going to put into the front end of the application
+    Returns:
+        normalized_query (str): the query lower cased, with punctuation other
+        than KEPT_PUNCTUATION dropped, trailing full stops dropped and
+        whitespace collapsed, so questions asked differently only in those
+        ways get the same NLU response
+    '''
+    normalized_query = ''.join(c if c.isalnum() or c in KEPT_PUNCTUATION else ' '
+                               for c in query.lower())
+    words = [word.rstrip('.') for word in normalized_query.split()]
+    return ' '.join(word for word in words if word)
+
 def tokenize_query(query):
     '''
     Inputs:
@@ -52,39 +86,73 @@ def tokenize_query(query):
         tokenized_query (str): this is the query that has going through the
         following text processing functions:
         a) spell checking
-        b) replacement of spaces with "+" signs
+        b) normalization (see normalize_query)
+        c) URL quoting of each word, as the query is sent as a URL path
+        d) replacement of spaces with "+" signs
     '''
 
     if len(query) < 1:
         return 'a valid string needs to be put in'
-    spell_checked_query = query
-    tokenized_query = spell_checked_query.replace(' ', '+')
+    spell_checked_query = normalize_query(spell_check_query(query))
+    tokenized_query = '+'.join(urllib.quote(word, safe = '')
+                               for word in spell_checked_query.split(' '))
     return tokenized_query
 
 @helper.timeit
-def get_intent_entity_from_watson(query, error_checking = False):
+def get_intent_entity_from_watson(query, error_checking = False, timeout = None):
     '''
     Inputs:
         query (str): this is the natural language string input that the user
         is going to put into the front end of the application
+        timeout (float): seconds Watson is given to answer, retries
+        included, or None to only be bound by the client's timeouts
     Outputs:
-        sqlquery (str): this is the output string that is going to be produced
-        by the application
+        the Watson response, raises nlu_client.NLUError if Watson does not
+        answer
     '''
     tokenized_query = tokenize_query(query)
-    watson_string = 'https://gaminganalyticsai-host.mybluemix.net/{}'.format(tokenized_query)
-    response = requests.get(watson_string)
-
     if error_checking:
-        print 'Query being sent to Watson: {}'.format(watson_string)
+        print 'Query being sent to Watson: {}/{}'.format(watson_client.base_url, tokenized_query)
+
+    return watson_client.get(tokenized_query, budget = timeout)
+
+
+def get_intent_entity(query, error_checking = False):
+    '''
+    Same as get_intent_entity_from_watson, but answers questions asked
+    before from nlu_cache without calling Watson, and uses local_nlu instead
+    of Watson as NLU_BACKEND says
+    Inputs:
+        query (str): this is the natural language string input that the user
+        is going to put into the front end of the application
+    Outputs:
+        the Watson response, or the local_nlu one in 'auto' mode if Watson
+        does not answer
+    '''
+    key = normalize_query(spell_check_query(query))
+    if NLU_BACKEND == 'local':
+        return local_nlu.parse_query(key)
 
-    if response.status_code != 200:
-        print 'WARNING', response.status_code
+    response = nlu_cache.cache.get(key)
+    if response is not None:
+        if error_checking:
+            print 'NLU response for "{}" read from cache'.format(key)
+        return response
+    if NLU_BACKEND == 'auto':
+        try:
+            response = get_intent_entity_from_watson(query, error_checking = error_checking,
+                                                     timeout = WATSON_FALLBACK_TIMEOUT)
+        except NLUError as e:
+            print 'WARNING', e
+            # Local answers are not cached, so Watson is asked again next time
+            return local_nlu.parse_query(key)
     else:
-        return response.json()
+        response = get_intent_entity_from_watson(query, error_checking = error_checking)
+    nlu_cache.cache.put(key, response, nlu_cache.expiry_for(key))
+    return response
 
 
 if __name__ == "__main__":
     query = 'what is my daily revenue by club level, game title, manufacturer, zone, bank, stand, wager, club level'
-    response = get_intent_entity_from_watson(query)
+    response = get_intent_entity(query)
     print response
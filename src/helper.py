@@ -1,7 +1,23 @@
-from sqlalchemy import create_engine
 from datetime import timedelta, datetime
+import csv
+import database
+import hashlib
+import json
+import numpy as np
 import pandas as pd
+import psycopg2
+import psycopg2.errorcodes
+import re
 import time
+import uuid
+import view_advisor
+from cStringIO import StringIO
+
+# Rows per chunk read by iter_sql_data
+FETCH_CHUNKSIZE = 100000
+
+# z score of the confidence intervals of approximate answers, for 95%
+CONFIDENCE_Z = 1.96
 
 # Timing function
 def timeit(method):
@@ -19,34 +35,366 @@ def timeit(method):
 
 @timeit
 def connect_to_database(user, domain, name):
-    engine = create_engine('postgresql://{}:{}/{}'.format(user, domain, name))
+    engine = database.create_database_engine('postgresql://{}:{}/{}'.format(user, domain, name))
     return engine
 
+# Matches the %(name)s placeholders of a query
+PLACEHOLDER_PATTERN = re.compile(r'%\((\w+)\)s')
+
+# Errors of a prepared statement that is out of date ("cached plan must not
+# change result type") or no longer exists, after which it is prepared again
+STALE_STATEMENT_ERRORS = [psycopg2.errorcodes.FEATURE_NOT_SUPPORTED,
+                          psycopg2.errorcodes.INVALID_SQL_STATEMENT_NAME]
+
+def prepare_query(query):
+    '''
+    Turns a query with %(name)s placeholders into the body of a PREPARE
+    statement, with $1, $2... placeholders
+    Input:
+        query (str) -- SQL query
+    Output:
+        tuple of the name of the prepared statement, the PREPARE body, and
+        the list of parameter names in the order of their $n placeholders
+    '''
+    names = []
+    def number(match):
+        if match.group(1) not in names:
+            names.append(match.group(1))
+        return '${}'.format(names.index(match.group(1)) + 1)
+    body = PLACEHOLDER_PATTERN.sub(number, query)
+    # The query text only depends on the view and columns queried, so it
+    # names the statement
+    name = 'query_' + hashlib.md5(body).hexdigest()[:16]
+    return name, body, names
+
+def execute_prepared(connection, query, params):
+    '''
+    Runs a query as a prepared statement of the connection, preparing it the
+    first time the connection sees it. Statements are kept for the life of
+    the database session, which outlives checkouts from the pool, so repeated
+    queries skip parsing and planning.
+    Input:
+        connection -- raw pooled connection (engine.raw_connection())
+        query (str) -- SQL query with %(name)s placeholders
+        params (dict) -- values of the placeholders
+    Output:
+        DataFrame of the query results
+    '''
+    name, body, names = prepare_query(query)
+    # The info dictionary lives as long as the database session
+    prepared = connection.info.setdefault('prepared_statements', set())
+    execute_string = 'EXECUTE {}'.format(name)
+    if names:
+        execute_string += ' ({})'.format(', '.join('%({})s'.format(x) for x in names))
+
+    cursor = connection.cursor()
+    try:
+        for attempt in xrange(2):
+            try:
+                if name not in prepared:
+                    cursor.execute('PREPARE {} AS {}'.format(name, body))
+                    prepared.add(name)
+                cursor.execute(execute_string, params)
+                break
+            except psycopg2.Error as e:
+                connection.rollback()
+                # Only a stale statement is prepared again, once: the view
+                # may have been rebuilt with different columns since it was
+                # prepared, or the session may have lost it. Anything else,
+                # like a statement timeout, would only fail again.
+                if attempt or name not in prepared or e.pgcode not in STALE_STATEMENT_ERRORS:
+                    raise
+                prepared.discard(name)
+                if e.pgcode == psycopg2.errorcodes.FEATURE_NOT_SUPPORTED:
+                    cursor.execute('DEALLOCATE {}'.format(name))
+        columns = [column[0] for column in cursor.description]
+        return pd.DataFrame.from_records(cursor.fetchall(), columns = columns)
+    finally:
+        cursor.close()
+
+def result_dtypes(query_params):
+    '''
+    Input:
+        query_params -- query parameters object after generate_sql_query
+    Output:
+        tuple of a dictionary of the dtypes of the columns the query returns,
+        metrics as float64 and factors as categoricals, and the list of its
+        time columns
+    '''
+    dtypes = {'metric': np.float64, 'metric_variance': np.float64}
+    for factor in query_params.sql_factors + [query_params.sql_top_factor]:
+        if factor:
+            dtypes[factor] = 'category'
+    return dtypes, ['tmstmp']
+
+def copy_sql_data(query, engine, params = None, query_params = None):
+    '''
+    Reads the results of a query with COPY ... TO STDOUT in csv format, which
+    postgres streams far faster than it sends rows over the text protocol,
+    and parses them straight into typed columns: metrics as float64, tmstmp
+    as datetime64 and factors as categoricals, as query_params knows them
+    (see result_dtypes). Other columns are typed by pandas.
+    Input:
+        query (str) -- SQL query
+        engine -- sqlalchemy engine
+        params (dict) -- values of the %(name)s placeholders of query, which
+                         are inlined as COPY takes no parameters
+        query_params -- query parameters object the query was generated from
+    Output:
+        DataFrame of the query results
+    '''
+    buffer = StringIO()
+    connection = engine.raw_connection()
+    try:
+        cursor = connection.cursor()
+        try:
+            if params:
+                query = cursor.mogrify(query, params)
+            cursor.copy_expert('COPY ({}) TO STDOUT WITH (FORMAT csv, HEADER true)'.format(query),
+                               buffer)
+        finally:
+            cursor.close()
+    finally:
+        connection.close()
+
+    buffer.seek(0)
+    columns = next(csv.reader([buffer.readline()]))
+    buffer.seek(0)
+    dtypes, time_columns = result_dtypes(query_params) if query_params else ({}, ['tmstmp'])
+    dtypes = dict((column, dtypes[column]) for column in columns if column in dtypes)
+    parse_dates = [column for column in time_columns if column in columns]
+    return pd.read_csv(buffer, dtype = dtypes, parse_dates = parse_dates or False,
+                       infer_datetime_format = True)
+
 @timeit
-def get_sql_data(query, engine, in_memory = False):
+def get_sql_data(query, engine, in_memory = False, database_name = None,
+                 params = None, prepared = True, query_params = None,
+                 copy = False):
+    '''
+    Input:
+        query (str) -- SQL query
+        engine -- sqlalchemy engine
+        in_memory (bool) -- whether to answer the query from the rollups
+                            kept resident by rollup_store, falling back to
+                            the database if none covers it. Needs
+                            query_params.
+        database_name (str) -- name of the view the query reads, which is
+                               recorded with the query's latency for
+                               view_advisor
+        params (dict) -- values of the %(name)s placeholders of query
+        prepared (bool) -- whether to run the query as a prepared statement
+                           that is reused by later calls with the same query
+        query_params -- query parameters object the query was generated from
+        copy (bool) -- whether to read the results with COPY (see
+                       copy_sql_data), worthwhile for large results
+    Output:
+        DataFrame of the query results
     '''
-    Add in memory capability
+    ts = time.time()
+    found = False
+    try:
+        df = None
+        if in_memory and query_params is not None:
+            # Imported here as rollup_store answers queries with the cube
+            # module, which depends on this one
+            import rollup_store
+            df = rollup_store.store.query(query_params, engine)
+        if df is None and copy:
+            df = copy_sql_data(query, engine, params, query_params)
+        elif df is None and prepared:
+            connection = engine.raw_connection()
+            try:
+                df = execute_prepared(connection, query, params or {})
+            finally:
+                connection.close()
+        elif df is None:
+            df = pd.read_sql_query(query, con = engine, params = params)
+        found = True
+    finally:
+        if database_name:
+            view_advisor.record_view_request(database_name, time.time() - ts, found)
+    return df
+
+def benchmark_fetch(query, engine, params = None, repeat = 3):
     '''
-    if in_memory:
-        pass
-    else:
-        return pd.read_sql_query(query, con = engine)
+    Times the ways get_sql_data can fetch the results of a query
+    Input:
+        query (str) -- SQL query
+        engine -- sqlalchemy engine
+        params (dict) -- values of the %(name)s placeholders of query
+        repeat (int) -- number of runs of each fetch, the fastest is kept
+    Output:
+        dictionary mapping each fetch to its fastest time in seconds
+    '''
+    def prepared():
+        connection = engine.raw_connection()
+        try:
+            return execute_prepared(connection, query, params or {})
+        finally:
+            connection.close()
+
+    fetches = {'read_sql_query': lambda: pd.read_sql_query(query, con = engine, params = params),
+               'prepared': prepared,
+               'copy': lambda: copy_sql_data(query, engine, params)}
+    timings = {}
+    for name, fetch in fetches.items():
+        times = []
+        for _ in xrange(repeat):
+            ts = time.time()
+            df = fetch()
+            times.append(time.time() - ts)
+        timings[name] = min(times)
+        print '{}: {:.4f} sec for {} rows'.format(name, timings[name], len(df))
+    return timings
+
+def explain_query(query, engine, params = None):
+    '''
+    Asks the planner how it would run a query, without running it
+    Input:
+        query (str) -- SQL query
+        engine -- sqlalchemy engine
+        params (dict) -- values of the %(name)s placeholders of query
+    Output:
+        dictionary of the root node of the plan, as returned by EXPLAIN
+        (FORMAT JSON)
+    '''
+    connection = engine.raw_connection()
+    try:
+        cursor = connection.cursor()
+        try:
+            cursor.execute('EXPLAIN (FORMAT JSON) ' + query, params)
+            plan = cursor.fetchone()[0]
+        finally:
+            cursor.close()
+    finally:
+        connection.close()
+    # EXPLAIN returns the plan as text rather than json
+    if isinstance(plan, basestring):
+        plan = json.loads(plan)
+    return plan[0]['Plan']
+
+def estimate_scan_rows(plan):
+    '''
+    Input:
+        plan (dict) -- plan node from explain_query
+    Output:
+        float of the number of rows the planner expects the plan's scans to
+        return, which is how much of the tables the query reads
+    '''
+    # Only scans of tables name a relation
+    rows = plan['Plan Rows'] if 'Relation Name' in plan else 0
+    return rows + sum(estimate_scan_rows(child) for child in plan.get('Plans', []))
+
+def confidence_interval(variance, z = CONFIDENCE_Z):
+    '''
+    Input:
+        variance -- float or Series of the variance of an approximate answer,
+                    from its metric_variance column
+        z (float) -- z score of the interval
+    Output:
+        half width of the confidence interval around the answer
+    '''
+    return z * np.sqrt(variance)
+
+def iter_sql_data(query, engine, params = None, chunksize = FETCH_CHUNKSIZE,
+                  database_name = None):
+    '''
+    Same as get_sql_data, but reads the results through a server side cursor
+    and yields them in chunks, so only chunksize rows are held at a time
+    Input:
+        query (str) -- SQL query
+        engine -- sqlalchemy engine
+        params (dict) -- values of the %(name)s placeholders of query
+        chunksize (int) -- number of rows per chunk
+        database_name (str) -- name of the view the query reads, recorded
+                               for view_advisor
+    Output:
+        generator of DataFrames of the query results
+    '''
+    ts = time.time()
+    found = False
+    connection = engine.raw_connection()
+    try:
+        # Named cursors are declared as server side cursors
+        cursor = connection.cursor(name = 'stream_{}'.format(uuid.uuid4().hex))
+        cursor.itersize = chunksize
+        cursor.execute(query, params)
+        columns = None
+        while True:
+            rows = cursor.fetchmany(chunksize)
+            if columns is None:
+                columns = [column[0] for column in cursor.description]
+            if not rows:
+                break
+            yield pd.DataFrame.from_records(rows, columns = columns)
+        cursor.close()
+        found = True
+    finally:
+        connection.close()
+        if database_name:
+            view_advisor.record_view_request(database_name, time.time() - ts, found)
+
+def iter_chunks(df):
+    '''
+    Lets functions take either a DataFrame or chunks of one from
+    iter_sql_data
+    '''
+    if isinstance(df, pd.DataFrame):
+        return [df]
+    return df
+
+def fold_sum(chunks, keys):
+    '''
+    Sums chunks of a result by keys as they arrive, keeping only the running
+    sums, so memory is bounded by the chunk size and the size of the answer
+    Input:
+        chunks -- DataFrame or iterable of DataFrames
+        keys (list) -- list of strings of columns to group by
+    Output:
+        DataFrame of the sums of the numeric columns by keys
+    '''
+    total = None
+    for chunk in iter_chunks(chunks):
+        # Group by the values of categorical factors (see copy_sql_data), as
+        # grouping by several keys including a categorical returns every
+        # combination of their categories
+        categorical = [key for key in keys if str(chunk[key].dtype) == 'category']
+        if categorical:
+            chunk = chunk.astype(dict((key, object) for key in categorical))
+        partial = chunk.groupby(keys, as_index = False).sum()
+        if total is None:
+            total = partial
+        else:
+            total = pd.concat([total, partial]).groupby(keys, as_index = False).sum()
+    if total is None:
+        return pd.DataFrame(columns = keys + ['metric'])
+    return total
 
 @timeit
 def sum_by_time(df, factor, pupd = True):
+    '''
+    Input:
+        df -- DataFrame, or chunks of one from iter_sql_data
+        factor (str) -- factor to sum by along with time, or None
+    '''
     if factor:
-        return df.groupby(['tmstmp', factor], as_index = False).sum().rename(columns = {factor: 'factor'})
+        return fold_sum(df, ['tmstmp', factor]).rename(columns = {factor: 'factor'})
     else:
-        return df.groupby(['tmstmp'], as_index = False).sum()
+        return fold_sum(df, ['tmstmp'])
 
 @timeit
 def find_top_specific_factors(df, factor, query_params):
     '''
     Clean this god awful function up when you get the chance
+    Input:
+        df -- DataFrame, or chunks of one from iter_sql_data
+        factor (str) -- factor, or time factor, to rank
+        query_params -- query parameters object
     '''
     if factor[:3] == 'top' or factor[:5] == 'worst':
         # Our factor is a time factor
-        df_1 = df.set_index(pd.DatetimeIndex(df['tmstmp']))
+        df_1 = fold_sum(df, ['tmstmp'])
+        df_1 = df_1.set_index(pd.DatetimeIndex(df_1['tmstmp']))
         if factor == 'top month':
             resample_string = 'M'
             # Make more exact
@@ -71,9 +419,11 @@ def find_top_specific_factors(df, factor, query_params):
 
         # Adjust metric for PUPD calculation
         df_1['metric'] = (df_1['metric'] * query_params.days_per_interval) / float(adjustment)
+        if 'metric_variance' in df_1:
+            df_1['metric_variance'] *= (query_params.days_per_interval / float(adjustment)) ** 2
 
         return df_1
-    return df.groupby([factor], as_index = False).sum().sort_values('metric', ascending = True).rename(columns = {factor: 'factor'})
+    return fold_sum(df, [factor]).sort_values('metric', ascending = True).rename(columns = {factor: 'factor'})
 
 def round_timedelta(td, period):
     """
@@ -104,13 +454,19 @@ def get_number_days(query_params):
 def calculate_pupd(df, query_params):
     '''
     Calculates the PUPD (per unit per day) value for column 'metric' in df,
-    replacing the column 'metric' with this calculated value.
+    replacing the column 'metric' with this calculated value, and scales
+    'metric_variance' along with it for approximate answers.
     Input:
         df -- DataFrame
         query_params -- query_parameters object
     '''
     df['total'] = df.metric
     df['metric'] = df.metric / (query_params.days_per_interval * query_params.num_machines)
+    if 'metric_variance' in df:
+        # The estimate of an approximate answer is scaled, and its variance
+        # with the square of the scale
+        df['total_variance'] = df.metric_variance
+        df['metric_variance'] = df.metric_variance / (query_params.days_per_interval * query_params.num_machines) ** 2
     return df
 
 def convert_money_to_string(f):
@@ -33,98 +33,105 @@ sister directory named src
 >>src
 5. a database named "playlogs" has been created in postgres with the command
 CREATE DATABASE playlogs;
+
+The csv is streamed into the database in bounded chunks, each chunk being
+cleaned with process_playlogs_data and pushed through COPY ... FROM STDIN, so
+memory use does not grow with the size of the file. A different csv can be
+loaded with "python src/loaddatatosql.py path/to/playlogs.csv".
+
+Every load records the latest tmstmp it loaded as the high water mark of the
+table. Running with --incremental appends only the rows of the csv newer than
+that mark to the existing table and then updates the time buckets of the
+rollups that the new rows fall in, so a nightly refresh costs time
+proportional to the new data rather than the full history.
 '''
 
 import os
-import json
+import time
+import argparse
+import database
+import database_building
+import numpy as np
 import pandas as pd
-from sqlalchemy import create_engine
-import multiprocessing as mp
-
-# Read password from external file
-with open('passwords.json') as data_file:
-    data = json.load(data_file)
-
-DATABASE_HOST = 'soft-feijoa.db.elephantsql.com'
-DATABASE_PORT = '5432'
-DATABASE_NAME = 'ohdimqey'
-DATABASE_USER = 'ohdimqey'
-DATABASE_PASSWORD = data['DATABASE_PASSWORD']
-
-# Connect to database
-database_string = 'postgres://{}:{}@{}:{}/{}'.format(DATABASE_USER,
-                                                     DATABASE_PASSWORD,
-                                                     DATABASE_HOST,
-                                                     DATABASE_PORT,
-                                                     DATABASE_NAME)
-engine = create_engine(database_string)
-
-def split_list(doc_list, n_groups):
-    """
-    Args:
-        doc_list (list): is a list of documents to be split up
-        n_groups (int): is the number of groups to split the doc_list into
-    Returns:
-        split_lists (list): a list of n_groups which are approximately equal
-        in length, as a necessary step prior to multiprocessing
-    """
-    avg = len(doc_list) / float(n_groups)
-    split_lists = []
-    last = 0.0
-    while last < len(doc_list):
-        split_lists.append(doc_list[int(last):int(last + avg)])
-        last += avg
-    return split_lists
-
-
-def convert_datestring_list(split_docs):
-    """
-    Args:
-        split_docs (list): list of datestrings to be converted
-    Returns:
-        converted datestrings (list): a list of converted datestrings
-    """
-    return [convert_datestring_to_pydatetime(text) for text in split_docs]
+from cStringIO import StringIO
+from datetime import datetime
+
+# Default location of the playlogs csv and number of rows read per chunk
+PLAYLOGS_CSV_PATH = '../data/playlogs.csv'
+CHUNKSIZE = 250000
+
+# Columns of current_logs in table order, used for COPY
+PLAYLOGS_COLUMNS = ['assetnumber', 'assettitle', 'manufacturer', 'zone',
+                    'area', 'bank', 'stand', 'assetcost', 'installed',
+                    'denom', 'accountnumber', 'clublevel', 'playtype',
+                    'gamesplayed', 'gameswon', 'amountbet', 'amountwon',
+                    'tmstmp']
 
+# Formats tried, in order, when detecting the format of a time column
+TIMESTAMP_FORMATS = ['%Y-%m-%dT%H:%M:%S.%fZ',
+                     '%Y-%m-%dT%H:%M:%SZ',
+                     '%Y-%m-%d %H:%M:%S.%f',
+                     '%Y-%m-%d %H:%M:%S',
+                     '%Y-%m-%d',
+                     '%m/%d/%Y %H:%M:%S',
+                     '%m/%d/%Y %H:%M',
+                     '%m/%d/%Y %I:%M:%S %p',
+                     '%m/%d/%Y']
 
-def convert_datestring_to_pydatetime(datestring):
+def detect_timestamp_format(datestrings, n_samples=100):
     '''
     Args:
-        datestring (str): this is a string for a date with the format
-        MM/DD/YYY
+        datestrings (array like): this is a column of timestamp strings
+        n_samples (int): this is the number of non null strings checked
     Returns:
-        pydt (python datetime): this is the string converted into the python
-        date time
+        fmt (str): the first format in TIMESTAMP_FORMATS that parses every
+        sampled string, or None if none of them do
     '''
-    pydt = pd.to_datetime(datestring).to_pydatetime()
-    return pydt
+    samples = pd.Series(datestrings).dropna().head(n_samples)
+    for fmt in TIMESTAMP_FORMATS:
+        try:
+            for datestring in samples:
+                datetime.strptime(datestring, fmt)
+        except (TypeError, ValueError):
+            continue
+        return fmt
+    return None
 
 
-def multiprocess_convert_datestrings(datestrings):
-    """
+def parse_timestamp_column(datestrings, fmt=None):
+    '''
     Args:
-        datestrings (list): this is a list of the datestring string items
+        datestrings (array like): this is a column of timestamp strings
+        fmt (str): this is the strptime format of the strings, detected from
+        the column if not given
     Returns:
-        converted_datestrings (list): a list of converted datestring string
-        items done with multiprocessing
-    """
-    n_processes = mp.cpu_count()
-    p = mp.Pool(n_processes)
-    split_docs = split_list(datestrings, n_processes)
-    converted_datestrings = p.map(convert_datestring_list, split_docs)
-    return [item for row in converted_datestrings for item in row]
+        timestamps (numpy array): the column parsed as datetime64[ns], with
+        missing strings as NaT
+    Each distinct string is parsed only once, so repeated values such as the
+    installed dates of a machine cost a single parse.
+    '''
+    codes, uniques = pd.factorize(datestrings)
+    if fmt is None:
+        fmt = detect_timestamp_format(uniques)
+    parsed = pd.to_datetime(uniques, format=fmt).values
+    # Missing strings have code -1, which takes the trailing NaT
+    parsed = np.append(parsed, np.datetime64('NaT', 'ns'))
+    return parsed.take(codes)
 
 
-def process_playlogs_data(df):
+def process_playlogs_data(df, timestamp_formats=None):
     '''
     Args:
         df (dataframe): this is the raw playlogs data
+        timestamp_formats (dict): this maps the time columns to their strptime
+        format, and is filled in with any format detected here so later chunks
+        of the same file skip detection
     Returns:
         df (dataframe): this is the playlogs data where the ff procedures
         have been run:
         1. timeStamp dropped, renamed to tmstmp
         2. column names lowered
-        3. timestamp strings converted into py datetime objects for the
+        3. timestamp strings converted into datetime64 columns for the
         columns [tmstmp and installed]
     '''
     df = df.rename_axis({"timeStamp": "tmstmp"}, axis="columns")
@@ -138,12 +145,28 @@ def process_playlogs_data(df):
         df.drop('__v', axis = 1, inplace = True)
 
     # Turn time columns into readable format
-    df.tmstmp = pd.to_datetime(df.tmstmp, infer_datetime_format = True)
-    df.installed = pd.to_datetime(df.installed, infer_datetime_format = True)
+    if timestamp_formats is None:
+        timestamp_formats = {}
+    for column in ['tmstmp', 'installed']:
+        if column not in timestamp_formats:
+            timestamp_formats[column] = detect_timestamp_format(df[column])
+        df[column] = parse_timestamp_column(df[column],
+                                            timestamp_formats[column])
 
     return df
 
-def create_table(engine):
+def create_table(engine, partitioned=False):
+    '''
+    Args:
+        engine (sqlalchemy engine): this is the engine for the database
+        partitioned (bool): whether to range partition current_logs by month
+        on tmstmp, so that queries on a range of time only scan the months in
+        the range. The loader creates the monthly partitions it needs, and
+        database_building.create_month_partitions and detach_old_partitions
+        manage them afterwards.
+    Returns:
+        None
+    '''
     # Connect to engine
     connection = engine.connect()
 
@@ -167,25 +190,226 @@ def create_table(engine):
                     amountBet double precision,
                     amountWon double precision,
                     tmstmp timestamp
-                    );"""
+                    ){};""".format(' PARTITION BY RANGE (tmstmp)' if partitioned else '')
     result = connection.execute(SQL_string)
 
-def load_data_to_sql(engine):
-    # Connect to engine
+    # Playlogs arrive in time order, so a BRIN index keeps the range scans of
+    # incremental rollup updates proportional to the new data
+    SQL_string = """CREATE INDEX current_logs_tmstmp_idx ON current_logs
+                    USING brin (tmstmp);"""
+    result = connection.execute(SQL_string)
+
+def create_watermark_table(cursor):
+    '''
+    Args:
+        cursor (psycopg2 cursor): this is the cursor the table is created on
+    Returns:
+        None
+    '''
+    cursor.execute("""CREATE TABLE IF NOT EXISTS load_watermarks (
+                      table_name varchar(60) PRIMARY KEY,
+                      high_water_mark timestamp
+                      );""")
+
+def set_high_water_mark(cursor, table_name, high_water_mark):
+    '''
+    Args:
+        cursor (psycopg2 cursor): this is the cursor of the load transaction
+        table_name (str): this is the table the rows were loaded into
+        high_water_mark (datetime): this is the latest tmstmp loaded
+    Returns:
+        None
+    '''
+    cursor.execute("""INSERT INTO load_watermarks (table_name, high_water_mark)
+                      VALUES (%s, %s)
+                      ON CONFLICT (table_name) DO UPDATE
+                      SET high_water_mark = EXCLUDED.high_water_mark;""",
+                   (table_name, high_water_mark))
+
+def get_high_water_mark(engine, table_name='current_logs'):
+    '''
+    Args:
+        engine (sqlalchemy engine): this is the engine for the database
+        table_name (str): this is the table rows are loaded into
+    Returns:
+        high_water_mark (datetime): the latest tmstmp loaded into the table,
+        falling back to the latest tmstmp in the table for tables loaded before
+        watermarks were recorded, or None for an empty table
+    '''
+    connection = engine.raw_connection()
+    cursor = connection.cursor()
+    try:
+        create_watermark_table(cursor)
+        cursor.execute("""SELECT high_water_mark FROM load_watermarks
+                          WHERE table_name = %s;""", (table_name,))
+        row = cursor.fetchone()
+        if row is None:
+            cursor.execute("""SELECT max(tmstmp) FROM {};""".format(table_name))
+            row = cursor.fetchone()
+        connection.commit()
+    finally:
+        cursor.close()
+        connection.close()
+    return row[0]
+
+def copy_dataframe_to_sql(df, cursor, table_name):
+    '''
+    Args:
+        df (dataframe): this is processed playlogs data
+        cursor (psycopg2 cursor): this is the cursor the COPY is issued on
+        table_name (str): this is the table the rows are appended to
+    Returns:
+        n_rows (int): the number of rows copied into the table
+    '''
+    df = df.reindex(columns=PLAYLOGS_COLUMNS)
+    buf = StringIO()
+    df.to_csv(buf, index=False, header=False, encoding='utf-8',
+              date_format='%Y-%m-%d %H:%M:%S.%f')
+    buf.seek(0)
+    SQL_string = """COPY {} ({}) FROM STDIN WITH CSV""".format(
+        table_name, ', '.join(PLAYLOGS_COLUMNS))
+    cursor.copy_expert(SQL_string, buf)
+    return len(df)
+
+
+def insert_new_boundary_rows(cursor, table_name, boundary_table, since):
+    '''
+    Args:
+        cursor (psycopg2 cursor): this is the cursor of the load transaction
+        table_name (str): this is the table the rows are appended to
+        boundary_table (str): this is the temporary table holding the rows of
+        the csv with a tmstmp equal to the high water mark
+        since (datetime): this is the high water mark
+    Returns:
+        n_rows (int): the number of rows appended
+    Rows at the high water mark may have been loaded already, if the last
+    load ended part way through that tmstmp, so only those not already in
+    the table, counting repeats, are appended.
+    '''
+    columns = ', '.join(PLAYLOGS_COLUMNS)
+    cursor.execute("""INSERT INTO {} ({})
+                      SELECT {} FROM {}
+                      EXCEPT ALL
+                      SELECT {} FROM {} WHERE tmstmp = %s;""".format(
+                          table_name, columns, columns, boundary_table,
+                          columns, table_name),
+                   (since,))
+    return cursor.rowcount
+
+
+def stream_playlogs_to_sql(engine, csv_path, table_name='current_logs',
+                           chunksize=CHUNKSIZE, since=None):
+    '''
+    Args:
+        engine (sqlalchemy engine): this is the engine for the database
+        csv_path (str): this is the path to the raw playlogs csv
+        table_name (str): this is the table the rows are appended to
+        chunksize (int): this is the number of csv rows held in memory at once
+        since (datetime): if given, only rows with a tmstmp from this on are
+        loaded, leaving out those at since that are already in the table
+    Returns:
+        n_rows (int): the number of rows loaded into the table
+    The whole file is loaded in a single transaction, together with the new
+    high water mark, so a failure part way through leaves the table as it was.
+    '''
     connection = engine.connect()
+    try:
+        partitioned = database_building.is_partitioned(connection, table_name)
+    finally:
+        connection.close()
+    connection = engine.raw_connection()
+    cursor = connection.cursor()
+    n_rows = 0
+    high_water_mark = None
+    timestamp_formats = {}
+    ts = time.time()
+    boundary_table = 'load_boundary_rows'
+    try:
+        create_watermark_table(cursor)
+        if since is not None:
+            cursor.execute("""CREATE TEMPORARY TABLE {} ON COMMIT DROP AS
+                              SELECT {} FROM {} LIMIT 0;""".format(
+                                  boundary_table, ', '.join(PLAYLOGS_COLUMNS),
+                                  table_name))
+        for chunk in pd.read_csv(csv_path, chunksize=chunksize):
+            chunk = process_playlogs_data(chunk, timestamp_formats)
+            if since is not None:
+                at_since = chunk.tmstmp == pd.Timestamp(since)
+                if at_since.any():
+                    copy_dataframe_to_sql(chunk[at_since], cursor, boundary_table)
+                chunk = chunk[chunk.tmstmp > pd.Timestamp(since)]
+            if chunk.empty:
+                continue
+            chunk_max = chunk.tmstmp.max()
+            if high_water_mark is None or chunk_max > high_water_mark:
+                high_water_mark = chunk_max
+            if partitioned:
+                for month in database_building.month_starts(chunk.tmstmp.min(),
+                                                            chunk_max):
+                    cursor.execute(database_building.month_partition_sql(
+                        table_name, month))
+            n_rows += copy_dataframe_to_sql(chunk, cursor, table_name)
+            print 'Copied {} rows into {} ({:.0f} rows/sec)'.format(
+                n_rows, table_name, n_rows / (time.time() - ts))
+        if since is not None:
+            n_rows += insert_new_boundary_rows(cursor, table_name,
+                                               boundary_table, since)
+        if high_water_mark is not None:
+            set_high_water_mark(cursor, table_name,
+                                high_water_mark.to_pydatetime())
+        connection.commit()
+    except:
+        connection.rollback()
+        raise
+    finally:
+        cursor.close()
+        connection.close()
+    return n_rows
+
+
+def load_data_to_sql(engine, csv_path=PLAYLOGS_CSV_PATH):
+    return stream_playlogs_to_sql(engine, csv_path)
 
-    SQL_string = """COPY films FROM '/Users/kruegg/Desktop/refactored_casino_analytics/data/playlogs.csv' DELIMITERS ',' CSV;"""
-    result = connection.execute(SQL_string)
+
+def append_new_playlogs(engine, csv_path=PLAYLOGS_CSV_PATH,
+                        table_name='current_logs'):
+    '''
+    Args:
+        engine (sqlalchemy engine): this is the engine for the database
+        csv_path (str): this is the path to a playlogs csv, which may overlap
+        with rows that have already been loaded
+        table_name (str): this is the table the rows are appended to
+    Returns:
+        n_rows (int): the number of new rows appended
+    Only rows from the high water mark on that are not in the table yet are
+    appended, after which the rollups are updated from the old high water
+    mark onwards.
+    '''
+    since = get_high_water_mark(engine, table_name)
+    print 'High water mark of {} is {}'.format(table_name, since)
+    n_rows = stream_playlogs_to_sql(engine, csv_path, table_name, since=since)
+    if n_rows:
+        database_building.update_rollups_since(engine, since, table_name)
+    return n_rows
 
 if __name__ == "__main__":
-    # Connect to database
-    database_string = 'postgres://{}:{}@{}:{}/{}'.format(DATABASE_USER,
-                                                         DATABASE_PASSWORD,
-                                                         DATABASE_HOST,
-                                                         DATABASE_PORT,
-                                                         DATABASE_NAME)
-    engine = create_engine(database_string)
-    create_table(engine)
+    # Connect to database, loads run far longer than dashboard queries
+    engine = database.get_engine(statement_timeout=0)
+
+    parser = argparse.ArgumentParser(description='Load playlogs into postgres')
+    parser.add_argument('csv_path', nargs='?', default=PLAYLOGS_CSV_PATH)
+    parser.add_argument('--incremental', action='store_true',
+                        help='append only rows newer than the high water mark '
+                             'and update the affected rollup buckets')
+    parser.add_argument('--partitioned', action='store_true',
+                        help='create current_logs partitioned by month')
+    args = parser.parse_args()
+
+    if args.incremental:
+        append_new_playlogs(engine, args.csv_path)
+    else:
+        create_table(engine, partitioned=args.partitioned)
+        load_data_to_sql(engine, args.csv_path)
 
     # dataset_name = 'playlogs0318_01.csv'
     # df = pd.read_csv('../data/{}'.format(dataset_name))
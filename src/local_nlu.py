@@ -0,0 +1,398 @@
+'''
+Module for finding the intent and entities of a question locally, without
+calling Watson.
+
+parse_query returns a response shaped like Watson's intent_entity_mapping,
+with the entities query_parameters.generate_query_params_from_response reads.
+Entity phrases, the values translation_dictionary translates and their
+synonyms, are compiled into a trie of words and matched longest first, and
+dates are read by a small grammar of absolute ("january 2 2015",
+"2015-01-02", "1/2/2015") and relative ("today", "last month", "past 7
+days") dates, resolved in the same time zone as Watson.
+
+generateresponsefromrequest.get_intent_entity uses it in place of Watson, or
+when Watson fails, depending on the NLU_BACKEND environment variable.
+'''
+
+import re
+import calendar
+from datetime import datetime, timedelta
+from pytz import timezone
+from translation_dictionaries import translation_dictionary
+
+# Time zone relative dates are resolved in
+TIME_ZONE = timezone('US/Pacific')
+
+# Intent of questions no intent phrase matches, and its confidence
+DEFAULT_INTENT = 'metric_by_factor_by_time_period'
+DEFAULT_CONFIDENCE = 0.5
+
+# Pseudo entity of intent phrases in the trie
+INTENT_ENTITY = '#intent'
+
+# Metrics the rollups hold, which metric values must name
+MEASURES = ['netwins', 'handlepulls', 'amountbet', 'amountwon']
+
+# Translations of the club levels and statistics, which are otherwise alike
+CLUB_LEVELS = ['BRONZE', 'SILVER', 'GOLD', 'PLATINUM']
+
+# Values of each entity that translate to themselves, so are not keys of
+# translation_dictionary
+UNTRANSLATED_VALUES = {'both_metrics': ['handlepulls', 'amountbet', 'amountwon'],
+                       'machine_factors': ['bank', 'zone', 'area', 'stand', 'manufacturer'],
+                       'time_factors': ['worst day']}
+
+# Phrases that name a value besides the value itself
+SYNONYMS = {'netwins': ['net win', 'net wins', 'netwin', 'revenue', 'winnings'],
+            'handlepulls': ['handle pulls', 'games played', 'plays', 'popularity', 'popular'],
+            'amountbet': ['amount bet', 'coin in', 'wagered', 'bets'],
+            'amountwon': ['amount won', 'coin out', 'payout', 'payouts'],
+            'club level': ['club levels'],
+            'game title': ['game titles', 'title', 'titles'],
+            'wager': ['wagers', 'denomination', 'denom'],
+            'bank': ['banks'],
+            'zone': ['zones'],
+            'area': ['areas'],
+            'stand': ['stands'],
+            'manufacturer': ['manufacturers', 'maker'],
+            'by_minute': ['by minute', 'per minute', 'minute by minute', 'every minute'],
+            'hourly': ['by hour', 'per hour', 'hour by hour', 'every hour'],
+            'daily': ['by day', 'per day', 'day by day', 'each day', 'every day'],
+            'weekly': ['by week', 'per week', 'each week', 'every week'],
+            'monthly': ['by month', 'per month', 'each month', 'every month'],
+            'yearly': ['by year', 'per year', 'annually'],
+            'best': ['top', 'highest', 'most', 'biggest', 'largest'],
+            'worst': ['lowest', 'least', 'bottom', 'smallest'],
+            'average': ['mean', 'avg'],
+            'top day': ['best day', 'busiest day', 'highest day'],
+            'top hour': ['best hour', 'busiest hour', 'highest hour'],
+            'top minute': ['best minute', 'busiest minute'],
+            'top week': ['best week', 'busiest week'],
+            'top month': ['best month', 'busiest month'],
+            'worst day': ['slowest day', 'lowest day']}
+
+# Intents by the phrases that name them
+INTENT_PHRASES = {'netwin_analysis': ['analysis', 'analyze', 'analyse'],
+                  'machine_performance': ['machines doing', 'machines performing',
+                                          'machine performance', 'machines perform']}
+
+
+def translation_entity(value, translation):
+    '''
+    Input:
+        value (str) -- key of translation_dictionary
+        translation (str) -- what translation_dictionary translates it to
+    Output:
+        name of the entity whose value it is, or None for values no entity
+        takes, such as the 'date' ordering and metrics the rollups lack
+    '''
+    if translation in ['minute', 'hour', 'day', 'week', 'month', 'year']:
+        return 'time_period'
+    if translation.startswith('ORDER BY 1'):
+        return 'top'
+    if translation.startswith('date_trunc'):
+        return 'time_factors'
+    if translation in CLUB_LEVELS:
+        return 'club_level'
+    if translation.isupper() and translation.isalpha():
+        return 'statistics'
+    if '(' in translation:
+        return 'both_metrics' if value in MEASURES else None
+    if translation == 'clublevel':
+        return 'player_factors'
+    if translation.isalpha():
+        return 'machine_factors'
+    return None
+
+
+def entity_phrases(translations=translation_dictionary):
+    '''
+    Input:
+        translations (dict) -- dictionary of value to translation, as
+                               translation_dictionary
+    Output:
+        dictionary of entity to dictionary of value to the phrases that name
+        it besides the value itself, intents under INTENT_ENTITY
+    '''
+    phrases = dict((entity, dict((value, SYNONYMS.get(value, [])) for value in values))
+                   for entity, values in UNTRANSLATED_VALUES.items())
+    for value, translation in translations.items():
+        entity = translation_entity(value, translation)
+        if entity:
+            phrases.setdefault(entity, {})[value] = SYNONYMS.get(value, [])
+    phrases[INTENT_ENTITY] = INTENT_PHRASES
+    return phrases
+
+
+# Values of each entity by their phrases, read from translation_dictionary
+ENTITY_PHRASES = entity_phrases()
+
+# Month names and abbreviations to month numbers
+MONTHS = dict((name.lower(), number) for number, name in enumerate(calendar.month_name) if name)
+MONTHS.update((name.lower(), number) for number, name in enumerate(calendar.month_abbr) if name)
+MONTHS['sept'] = 9
+
+# Words before "may" that make it the month
+MONTH_PREPOSITIONS = ['in', 'for', 'during', 'of', 'since', 'from', 'to', 'until', 'through']
+
+# Words that are single tokens: ISO and slashed dates, then words and numbers
+TOKEN_PATTERN = re.compile(r'\d{4}-\d{1,2}-\d{1,2}|\d{1,2}/\d{1,2}/\d{2,4}|[a-z]+|\d+(?:st|nd|rd|th)?')
+DAY_PATTERN = re.compile(r'^(\d{1,2})(?:st|nd|rd|th)?$')
+YEAR_PATTERN = re.compile(r'^(19|20)\d\d$')
+
+# Lengths of the periods of relative dates
+PERIOD_UNITS = {'day': 'day', 'days': 'day', 'week': 'week', 'weeks': 'week',
+                'month': 'month', 'months': 'month', 'quarter': 'quarter',
+                'quarters': 'quarter', 'year': 'year', 'years': 'year'}
+
+
+def tokenize(query):
+    '''
+    Input:
+        query (str) -- natural language question
+    Output:
+        list of the lower cased words, numbers and dates of the question
+    '''
+    return TOKEN_PATTERN.findall(query.lower())
+
+
+def build_trie(entity_phrases=ENTITY_PHRASES):
+    '''
+    Compiles entity phrases into a trie of words
+    Input:
+        entity_phrases (dict) -- dictionary of entity to dictionary of value
+                                 to list of phrases
+    Output:
+        nested dictionaries keyed on words, where the (entity, value) tuple
+        of a phrase is stored under None at the node of its last word
+    '''
+    trie = {}
+    for entity, values in entity_phrases.items():
+        for value, phrases in values.items():
+            for phrase in [value] + phrases:
+                node = trie
+                for word in tokenize(phrase):
+                    node = node.setdefault(word, {})
+                node[None] = (entity, value)
+    return trie
+
+
+# Trie of the entity phrases
+PHRASE_TRIE = build_trie()
+
+
+def match_phrases(tokens, skip=(), trie=PHRASE_TRIE):
+    '''
+    Finds the longest entity phrase starting at each word, left to right
+    Input:
+        tokens (list) -- output of tokenize
+        skip (set) -- indices of tokens already read as dates, which phrases
+                      cannot include
+        trie (dict) -- output of build_trie
+    Output:
+        list of (start, end, entity, value) tuples of the phrases found
+    '''
+    matches = []
+    i = 0
+    while i < len(tokens):
+        node = trie
+        match = None
+        j = i
+        while j < len(tokens) and j not in skip and tokens[j] in node:
+            node = node[tokens[j]]
+            j += 1
+            if None in node:
+                match = (i, j) + node[None]
+        if match:
+            matches.append(match)
+            i = match[1]
+        else:
+            i += 1
+    return matches
+
+
+def add_months(date, months):
+    '''
+    Input:
+        date (datetime) -- first day of a month
+        months (int) -- number of months to add, may be negative
+    Output:
+        datetime of the first day of the month months later
+    '''
+    month = date.month - 1 + months
+    return date.replace(year=date.year + month // 12, month=month % 12 + 1, day=1)
+
+
+def period_range(unit, today, offset):
+    '''
+    Input:
+        unit (str) -- 'day', 'week', 'month', 'quarter' or 'year'
+        today (datetime) -- current date
+        offset (int) -- 0 for the current period, -1 for the previous one
+    Output:
+        tuple of the first and last dates of the period, the current period
+        ending today
+    '''
+    if unit == 'day':
+        start = today + timedelta(days=offset)
+        return start, start
+    if unit == 'week':
+        start = today - timedelta(days=today.weekday()) + timedelta(weeks=offset)
+        stop = start + timedelta(days=6)
+    elif unit == 'month':
+        start = add_months(today.replace(day=1), offset)
+        stop = add_months(start, 1) - timedelta(days=1)
+    elif unit == 'quarter':
+        start = add_months(today.replace(day=1), -((today.month - 1) % 3) + 3 * offset)
+        stop = add_months(start, 3) - timedelta(days=1)
+    else:
+        start = today.replace(year=today.year + offset, month=1, day=1)
+        stop = start.replace(month=12, day=31)
+    return start, min(stop, today)
+
+
+def month_range(month, year, today):
+    '''
+    Input:
+        month (int) -- month number
+        year (int) -- year, or None for the latest such month up to today
+        today (datetime) -- current date
+    Output:
+        tuple of the first and last dates of the month
+    '''
+    if year is None:
+        year = today.year if month <= today.month else today.year - 1
+    start = datetime(year, month, 1)
+    return start, add_months(start, 1) - timedelta(days=1)
+
+
+def parse_dates(tokens, today):
+    '''
+    Reads the dates of a question
+    Input:
+        tokens (list) -- output of tokenize
+        today (datetime) -- current date, relative dates are resolved from
+    Output:
+        tuple of the list of (start, end, date) tuples of the dates found,
+        where start and end are the token indices they were read from, and
+        the set of indices of the tokens read
+    '''
+    dates = []
+    i = 0
+    while i < len(tokens):
+        token = tokens[i]
+        following = tokens[i + 1] if i + 1 < len(tokens) else ''
+        after = tokens[i + 2] if i + 2 < len(tokens) else ''
+        found = None
+
+        if token == 'today':
+            found = (1, [today])
+        elif token == 'yesterday':
+            found = (1, [today - timedelta(days=1)])
+        elif token in ['this', 'current'] and following in PERIOD_UNITS:
+            found = (2, period_range(PERIOD_UNITS[following], today, 0))
+        elif token in ['last', 'past', 'previous'] and following in PERIOD_UNITS:
+            found = (2, period_range(PERIOD_UNITS[following], today, -1))
+        elif token in ['last', 'past'] and following.isdigit() and after in PERIOD_UNITS:
+            # The last n days, weeks... up to today
+            n = int(following)
+            unit = PERIOD_UNITS[after]
+            if unit in ['day', 'week']:
+                start = today - timedelta(days=n * (7 if unit == 'week' else 1))
+            else:
+                start = add_months(today.replace(day=1),
+                                   -n * {'month': 1, 'quarter': 3, 'year': 12}[unit])
+                start = start.replace(day=min(today.day, calendar.monthrange(start.year, start.month)[1]))
+            found = (3, [start, today])
+        elif re.match(r'^\d{4}-\d{1,2}-\d{1,2}$', token):
+            try:
+                found = (1, [datetime.strptime(token, '%Y-%m-%d')])
+            except ValueError:
+                # Well formed but impossible, as 2017-02-30
+                pass
+        elif re.match(r'^\d{1,2}/\d{1,2}/\d{2,4}$', token):
+            month, day, year = [int(x) for x in token.split('/')]
+            try:
+                found = (1, [datetime(year if year > 99 else 2000 + year, month, day)])
+            except ValueError:
+                pass
+        elif token in MONTHS and (token != 'may' or DAY_PATTERN.match(following) or
+                                  YEAR_PATTERN.match(following) or
+                                  (i and tokens[i - 1] in MONTH_PREPOSITIONS)):
+            # Month, then an optional day and year
+            month = MONTHS[token]
+            length = 1
+            day = year = None
+            if DAY_PATTERN.match(following) and not YEAR_PATTERN.match(following):
+                day = int(DAY_PATTERN.match(following).group(1))
+                length = 2
+                following = after
+            if YEAR_PATTERN.match(following):
+                year = int(following)
+                length += 1
+            if day:
+                start, stop = month_range(month, year, today)
+                found = (length, [start.replace(day=min(day, stop.day))])
+            else:
+                found = (length, month_range(month, year, today))
+        elif YEAR_PATTERN.match(token):
+            found = (1, [datetime(int(token), 1, 1), datetime(int(token), 12, 31)])
+
+        if found:
+            for date in found[1]:
+                dates.append((i, i + found[0], date))
+            i += found[0]
+        else:
+            i += 1
+    used = set()
+    for start, end, _ in dates:
+        used.update(xrange(start, end))
+    return dates, used
+
+
+def parse_query(query, now=None):
+    '''
+    Finds the intent and entities of a question
+    Input:
+        query (str) -- natural language question
+        now (datetime) -- current time, relative dates are resolved from
+    Output:
+        dictionary shaped like the response of Watson, with the intent and
+        entities under intent_entity_mapping
+    '''
+    if now is None:
+        now = datetime.now(TIME_ZONE)
+    today = datetime(now.year, now.month, now.day)
+    tokens = tokenize(query)
+
+    dates, used = parse_dates(tokens, today)
+    entities = [{'entity': 'sys-date', 'value': date.strftime('%Y-%m-%d'), 'confidence': 1}
+                for _, _, date in dates]
+
+    intent, confidence = DEFAULT_INTENT, DEFAULT_CONFIDENCE
+    for _, _, entity, value in match_phrases(tokens, used):
+        if entity == INTENT_ENTITY:
+            intent, confidence = value, 1.0
+        else:
+            entities.append({'entity': entity, 'value': value, 'confidence': 1})
+
+    return {'intent_entity_mapping': {'input': {'text': query},
+                                      'intents': [{'intent': intent,
+                                                   'confidence': confidence}],
+                                      'entities': entities}}
+
+
+if __name__ == "__main__":
+    queries = ['What is revenue today?',
+               'What is revenue by club level today?',
+               'What is the revenue for January daily?',
+               'What is the revenue for gold-members in January?',
+               'What is the highest revenue bank in January?',
+               'Best day last month?',
+               'What is the average daily revenue by bank in January 2015?',
+               'games played by area january 2nd 2015 to 2015-01-05',
+               'how are my machines doing january',
+               'net win analysis']
+    for query in queries:
+        print query
+        print parse_query(query)['intent_entity_mapping']
@@ -1,5 +1,12 @@
+import os
+import copy
 import helper
-import json
+import database
+import cube
+import cost_guard
+import rollup_views
+import result_cache
+import rollup_store
 import pandas as pd
 import mpld3
 import numpy as np
@@ -8,28 +15,38 @@ import factor_analysis
 import visualizations
 from datetime import timedelta, datetime
 from netwin_analysis import netwin_analysis
-from sqlalchemy import create_engine
-from generateresponsefromrequest import get_intent_entity_from_watson
+from generateresponsefromrequest import get_intent_entity
 from query_parameters import query_parameters
 from translation_dictionaries import *
 
-# Read password from external file
-with open('passwords.json') as data_file:
-    data = json.load(data_file)
-
-DATABASE_HOST = 'soft-feijoa.db.elephantsql.com'
-DATABASE_PORT = '5432'
-DATABASE_NAME = 'ohdimqey'
-DATABASE_USER = 'ohdimqey'
-DATABASE_PASSWORD = data['DATABASE_PASSWORD']
-
-# Connect to database
-database_string = 'postgres://{}:{}@{}:{}/{}'.format(DATABASE_USER,
-                                                     DATABASE_PASSWORD,
-                                                     DATABASE_HOST,
-                                                     DATABASE_PORT,
-                                                     DATABASE_NAME)
-engine = create_engine(database_string)
+# Directory of cuboids built by the cube module, to answer queries from
+# instead of postgres
+CUBE_DIRECTORY = os.getenv('CUBE_DIRECTORY')
+
+# Whether to answer queries from rollups kept in memory by rollup_store
+# where they cover them
+IN_MEMORY_ROLLUPS = os.getenv('IN_MEMORY_ROLLUPS') == '1'
+
+# Periods whose bar chart results are streamed rather than read whole
+STREAMED_PERIODS = ['minute', 'hour']
+
+# Periods whose results are read whole with COPY rather than row by row
+COPY_PERIODS = ['minute', 'hour']
+
+# Number of bars shown in a bar chart
+BAR_CHART_ROWS = 15
+
+# Whether queries expected to read more than APPROXIMATE_ROW_THRESHOLD rows
+# are answered approximately, from a sample of about APPROXIMATE_SAMPLE_ROWS
+# of them
+APPROXIMATE_QUERIES = os.getenv('APPROXIMATE_QUERIES') == '1'
+APPROXIMATE_ROW_THRESHOLD = int(os.getenv('APPROXIMATE_ROW_THRESHOLD', 2000000))
+APPROXIMATE_SAMPLE_ROWS = 200000
+
+# Periods whose queries are checked for approximation, as the coarser
+# rollups are small enough to read whole
+APPROXIMATE_PERIODS = ['minute', 'hour']
+
 main_factors = ['bank', 'zone', 'clublevel', 'area']
 specific_factors = ['club_level', 'area', 'game_title', 'manufacturer',
                     'stand', 'zone', 'bank']
@@ -101,50 +118,242 @@ def impute_period(query_params, error_checking = False):
 
     return query_params
 
-def get_data_from_nl_query(nl_query, error_checking = False):
+def bar_chart_factor(query_params):
+    '''
+    Finds the factor, or time factor, a query's bar chart ranks
+    Input:
+        query_params -- query parameters object
+    Output:
+        string of the factor, or None if the query gets a line chart or a
+        net win analysis instead
+    '''
+    if query_params.intent == 'netwin_analysis':
+        return None
+    if query_params.ordering == 'date' and query_params.intent != 'machine_performance':
+        return None
+
+    # Find factor (currently supports one factor)
+    if query_params.factors:
+        factor = translation_dictionary.get(query_params.factors[0], query_params.factors[0])
+    else:
+        # Defaults to clublevel
+        factor = 'clublevel'
+
+    if query_params.time_factor:
+        factor = query_params.time_factor
+    return factor
+
+def get_query_params_from_nl_query(nl_query, error_checking = False):
     '''
     Input:
         nl_query (str) -- this is a natural language query
                           i.e. what is my revenue today
     Returns
-        df (dataframe) -- this is a pandas dataframe that contains a table
-                          which will be used for visualization
         query_params (query_parameters object) -- this is an object holding
                                                   everything we need to know
-                                                  about the query
+                                                  about the query, including
+                                                  the columns to fetch for
+                                                  its chart
     '''
 
     # Get JSON Watson conversations response to natual language query
-    response = get_intent_entity_from_watson(nl_query, error_checking = False)
+    response = get_intent_entity(nl_query, error_checking = False)
 
     # Transform JSON Watson conversations response to query parameters object
     query_params = query_parameters()
     query_params.generate_query_params_from_response(nl_query, response, error_checking = error_checking)
 
-    # Add main factors
-    if query_params.intent == 'machine_performance':
-        pass
-    else:
-        query_params.sql_factors += main_factors
-
     # Impute period if needed
     query_params = impute_period(query_params)
 
-    # Generate SQL query
-    query_params.generate_sql_query(error_checking = error_checking)
+    factor = bar_chart_factor(query_params)
+    if factor is None:
+        # Line charts and the net win analysis break the metric down by the
+        # main factors
+        query_params.sql_factors += main_factors
+    elif factor[:3] == 'top' or factor[:5] == 'worst':
+        # Time factor bar charts only need the metric over time
+        pass
+    else:
+        # Bar charts of a factor only need that factor, and are ranked in
+        # SQL, returning only the bars and the worst row
+        query_params.sql_factors += [factor]
+        if not query_params.statistic:
+            query_params.sql_top_factor = factor
+            query_params.sql_limit = BAR_CHART_ROWS
+            query_params.sql_include_worst = query_params.ordering != 'best' and \
+                                             query_params.intent != 'machine_performance'
+
+    return query_params
 
-    # Get SQL query string from query parameters object
-    sql_query = query_params.sql_string
+def fetch_chart_data(query_params, error_checking = False):
+    '''
+    Input:
+        query_params -- query parameters object from
+                        get_query_params_from_nl_query
+        error_checking (bool) -- whether to print to console
+    Returns
+        df (dataframe) -- this is a pandas dataframe that contains a table
+                          which will be used for visualization, or a
+                          generator of chunks of one for streamed bar chart
+                          queries
+    '''
+    # Time factor bar charts only need the results summed over time, so fine
+    # grained results for them are streamed in chunks and folded as they
+    # arrive rather than read whole
+    chunksize = None
+    factor = bar_chart_factor(query_params)
+    if factor and not query_params.sql_top_factor and \
+       query_params.sql_period in STREAMED_PERIODS:
+        chunksize = helper.FETCH_CHUNKSIZE
+
+    # Place query results into DataFrame
+    df = run_query(query_params, error_checking = error_checking, chunksize = chunksize)
     if error_checking:
         print query_params
+        if chunksize is None:
+            print df.head()
 
-    # Place SQL results into DataFrame
-    df = helper.get_sql_data(sql_query, engine)
-    if error_checking:
-        print df.head()
+    return df
 
+def get_data_from_nl_query(nl_query, error_checking = False):
+    '''
+    Input:
+        nl_query (str) -- this is a natural language query
+                          i.e. what is my revenue today
+    Returns
+        df (dataframe) -- see fetch_chart_data
+        query_params (query_parameters object) -- this is an object holding
+                                                  everything we need to know
+                                                  about the query
+    '''
+    query_params = get_query_params_from_nl_query(nl_query, error_checking = error_checking)
+    df = fetch_chart_data(query_params, error_checking = error_checking)
     return df, query_params
 
+def run_query(query_params, error_checking = False, chunksize = None):
+    '''
+    Generates the query for a query parameters object against the smallest
+    rollup that can answer it, and runs it unless its result is cached. If
+    APPROXIMATE_QUERIES is set, fine grained queries the planner expects to
+    read more than APPROXIMATE_ROW_THRESHOLD rows read a sample instead.
+    Queries still over the budget of cost_guard are moved to a coarser
+    period, or rejected with cost_guard.QueryTooExpensive. Both checks are
+    skipped for queries answered from the result cache or from memory, and
+    queries asked again reuse what was decided for them. If CUBE_DIRECTORY
+    is set the query is answered from the cuboids built by the cube module
+    instead of from postgres, and if IN_MEMORY_ROLLUPS is set from the
+    rollups rollup_store keeps in memory where they cover it.
+    Input:
+        query_params -- query parameters object
+        error_checking (bool) -- whether to print to console
+        chunksize (int) -- if given, results that are not cached or held in
+                           memory are streamed from postgres in chunks of
+                           this many rows instead of read whole
+    Output:
+        DataFrame of the query results, or a generator of chunks of it
+    '''
+    if CUBE_DIRECTORY:
+        query_params.generate_sql_query(error_checking = error_checking,
+                                        view_catalog = cube.get_cube_catalog(CUBE_DIRECTORY))
+        return cube.query_cube(query_params, CUBE_DIRECTORY)
+
+    engine = database.get_engine()
+    view_catalog = rollup_views.get_view_catalog(engine)
+    query_params.generate_sql_query(error_checking = error_checking,
+                                    view_catalog = view_catalog)
+
+    # Answer repeated queries from the result cache, once results read from
+    # rollups refreshed since they were cached are dropped
+    for view in result_cache.cache.sync_refreshes(engine):
+        rollup_store.store.invalidate_view(view)
+
+    # Only queries that will reach postgres are checked with the planner,
+    # and queries asked before reuse what was decided for them
+    key = result_cache.cache_key(query_params)
+    plan = cost_guard.planned.get(key)
+    if plan is not None:
+        cost_guard.apply_plan(query_params, plan, view_catalog,
+                              error_checking = error_checking)
+    elif key not in result_cache.cache and \
+         not (IN_MEMORY_ROLLUPS and rollup_store.store.route(query_params, engine)):
+        # Answer queries that would scan too much of a fine grained rollup
+        # from a sample of it instead
+        if APPROXIMATE_QUERIES and not query_params.sample_percent and \
+           query_params.sql_period in APPROXIMATE_PERIODS and query_params.can_sample():
+            explained = helper.explain_query(query_params.sql_string, engine,
+                                             query_params.sql_params)
+            rows = helper.estimate_scan_rows(explained)
+            if rows > APPROXIMATE_ROW_THRESHOLD:
+                # Rounded so similar queries share cached results
+                query_params.sample_percent = float('{:.1g}'.format(100.0 * APPROXIMATE_SAMPLE_ROWS / rows))
+                query_params.generate_sql_query(error_checking = error_checking,
+                                                view_catalog = view_catalog)
+
+        # Coarsen queries the planner expects to be too slow, or reject them
+        cost_guard.guard_query(query_params, engine, view_catalog,
+                               error_checking = error_checking)
+        cost_guard.planned.put(key, query_params)
+
+    if chunksize and result_cache.cache_key(query_params) not in result_cache.cache and \
+       not (IN_MEMORY_ROLLUPS and query_params.sql_period in rollup_store.store.periods):
+        return helper.iter_sql_data(query_params.sql_string, engine,
+                                    params = query_params.sql_params,
+                                    chunksize = chunksize,
+                                    database_name = query_params.requested_database_name)
+
+    # Periods that have ended are answered from the closed period cache, and
+    # only the open ones are queried
+    if result_cache.uses_closed_periods(query_params):
+        def fetch_from(start):
+            live_params = copy.deepcopy(query_params)
+            live_params.sql_start = start
+            live_params.generate_sql_query(view_catalog = view_catalog)
+            return fetch_query(live_params, engine)
+        return result_cache.fetch_with_closed_periods(query_params, fetch_from)
+
+    return fetch_query(query_params, engine)
+
+def fetch_query(query_params, engine):
+    '''
+    Runs a generated query unless its result is cached
+    Input:
+        query_params -- query parameters object after generate_sql_query
+        engine -- sqlalchemy engine
+    Output:
+        DataFrame of the query results
+    '''
+    key = result_cache.cache_key(query_params)
+    df = result_cache.cache.get(key)
+    if df is None:
+        df = helper.get_sql_data(query_params.sql_string, engine,
+                                 in_memory = IN_MEMORY_ROLLUPS,
+                                 database_name = query_params.requested_database_name,
+                                 params = query_params.sql_params,
+                                 query_params = query_params,
+                                 copy = query_params.sql_period in COPY_PERIODS)
+        result_cache.cache.put(key, df, query_params.database_name)
+    return df
+
+def label_approximate_answer(df, query_params, metrics):
+    '''
+    Marks an answer read from a sample as approximate, adding the half width
+    of the confidence interval of each row in the metric_error column, for
+    the plot to draw, and a note to the metrics shown on the dashboard
+    Input:
+        df -- DataFrame of chart data, with a metric_variance column if the
+              answer is approximate
+        query_params -- query parameters object
+        metrics (dict) -- dictionary of metrics to display on dashboard
+    Output:
+        None
+    '''
+    if 'metric_variance' not in df:
+        return
+    df['metric_error'] = helper.confidence_interval(df.metric_variance)
+    metrics['Approximate answer'] = 'from a {:g}% sample, with 95% confidence intervals (+/-)'.format(
+        query_params.sample_percent)
+
 def main(query, error_checking = False):
     '''
     Args:
@@ -161,9 +370,29 @@ def main(query, error_checking = False):
         aggregate_statistics (dict) -- dictionary of aggregate statistics to
                                        display on dashboard
     '''
+    # Work out what to pull down from the database
+    query_params = get_query_params_from_nl_query(query, error_checking = error_checking)
+
+    # Check if we want to do net win analysis, which runs its own queries
+    # concurrently
+    if query_params.intent == 'netwin_analysis':
+        return netwin_analysis(query_params, run_query)
+
     # Pull down data from database
-    df, query_params = get_data_from_nl_query(query, error_checking = error_checking)
+    df = fetch_chart_data(query_params, error_checking = error_checking)
+
+    return render_dashboard(query_params, df, error_checking = error_checking)
 
+def render_dashboard(query_params, df, error_checking = False):
+    '''
+    Builds the dashboard of a query from its data
+    Args:
+        query_params (query_parameters object): query parameters from
+        get_query_params_from_nl_query, after its query was run
+        df (dataframe): data from fetch_chart_data
+    Returns:
+        see main
+    '''
     # Decide what to do based on query parameters
     """
     # Metric
@@ -206,12 +435,11 @@ def main(query, error_checking = False):
 
     # Dictionary to hold calculated metrics
     metrics = {}
+    if query_params.coarsened_from:
+        metrics['Period'] = 'by {} rather than by {}, which would take too long'.format(
+            query_params.sql_period, query_params.coarsened_from)
     print query_params
 
-    # Check if we want to do net win analysis
-    if query_params.intent == 'netwin_analysis':
-        return netwin_analysis(df, query_params, engine)
-
     # Determine metrics and graph type to build
     if query_params.ordering == 'date' and query_params.intent != 'machine_performance':
         # Line graph
@@ -235,6 +463,9 @@ def main(query, error_checking = False):
                 metric_per_day_name = "{} for {}".format(human_readable_translation[query_params.sql_metric],
                                                          human_readable_translation[row['factor']])
                 metrics[metric_per_day_name] = round(row.metric / (query_params.num_days * query_params.num_machines), 3)
+                if 'metric_variance' in row:
+                    metrics[metric_per_day_name + ' (+/-)'] = round(helper.confidence_interval(row.metric_variance) /
+                                                                    (query_params.num_days * query_params.num_machines), 3)
         else:
             # Single total
             total_metric = df_1['metric'].sum()
@@ -242,9 +473,13 @@ def main(query, error_checking = False):
             # Calculate metric PUPD
             metric_per_day_name = "{}".format(human_readable_translation[query_params.sql_metric])
             metrics[metric_per_day_name] = round(total_metric / (query_params.num_days * query_params.num_machines), 3)
+            if 'metric_variance' in df_1:
+                metrics[metric_per_day_name + ' (+/-)'] = round(helper.confidence_interval(df_1['metric_variance'].sum()) /
+                                                                (query_params.num_days * query_params.num_machines), 3)
 
         # Calculate PUPD for each metric
         df_1 = helper.calculate_pupd(df_1, query_params)
+        label_approximate_answer(df_1, query_params, metrics)
 
         # Round to 3 decimal places
         df_1 = df_1.round(3)
@@ -254,16 +489,7 @@ def main(query, error_checking = False):
         plot1 = visualizations.makeplot('line', df_1, query_params, metrics)
     else:
         # Bar plot
-
-        # Find factor (currently supports one factor)
-        if query_params.factors:
-            factor = translation_dictionary.get(query_params.factors[0], query_params.factors[0])
-        else:
-            # Defaults to clublevel
-            factor = 'clublevel'
-
-        if query_params.time_factor:
-            factor = query_params.time_factor
+        factor = bar_chart_factor(query_params)
 
         # Find top specific factors for given factor
         df_1 = helper.find_top_specific_factors(df, factor, query_params)
@@ -280,6 +506,8 @@ def main(query, error_checking = False):
                                                            human_readable_translation.get(best, best),
                                                            human_readable_translation.get(query_params.sql_metric, query_params.sql_metric))
             metrics[metric_string] = round(metric_for_best, 3)
+            if 'metric_variance' in df_1:
+                metrics[metric_string + ' (+/-)'] = round(helper.confidence_interval(df_1.iloc[-1]['metric_variance']), 3)
         else:
             worst = df_1.iloc[0]['factor']
             metric_for_worst = df_1.iloc[0]['metric']
@@ -287,12 +515,15 @@ def main(query, error_checking = False):
                                                             human_readable_translation.get(worst, worst),
                                                             human_readable_translation.get(query_params.sql_metric, query_params.sql_metric))
             metrics[metric_string] = round(metric_for_worst, 3)
+            if 'metric_variance' in df_1:
+                metrics[metric_string + ' (+/-)'] = round(helper.confidence_interval(df_1.iloc[0]['metric_variance']), 3)
+        label_approximate_answer(df_1, query_params, metrics)
 
         # Round decimals to 3 places
         df_1 = df_1.round(3)
 
         # Filter most important
-        df_1 = df_1.iloc[-15:,:]
+        df_1 = df_1.iloc[-BAR_CHART_ROWS:,:]
         df_1 = df_1.reset_index(drop = True)
 
         # Make plot
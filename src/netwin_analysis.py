@@ -4,10 +4,56 @@ from query_parameters import query_parameters
 import visualizations
 import helper
 import pandas as pd
+import threading
+from multiprocessing.pool import ThreadPool
 
 main_factors = ['bank', 'zone', 'clublevel', 'area']
 
-def netwin_analysis(df, query_params, engine):
+# Number of queries run at once across requests
+QUERY_THREADS = 8
+
+# Thread pool the dashboard queries run on, created on first use
+query_pool = []
+query_pool_lock = threading.Lock()
+
+def get_query_pool():
+    '''
+    Returns the thread pool shared by dashboard queries
+    '''
+    with query_pool_lock:
+        if not query_pool:
+            query_pool.append(ThreadPool(QUERY_THREADS))
+        return query_pool[0]
+
+def close_query_pool():
+    '''
+    Stops the thread pool shared by dashboard queries, e.g. before forking,
+    once its queries have finished. It is created again on next use.
+    '''
+    with query_pool_lock:
+        if query_pool:
+            pool = query_pool.pop()
+            pool.close()
+            pool.join()
+
+def netwin_analysis(query_params, run_query):
+    '''
+    Input:
+        query_params -- query parameters object of the net win query
+        run_query (function) -- runs the query of a query parameters object
+                                and returns its results (see main.run_query)
+    Output:
+        the four quadrant objects of the dashboard
+    '''
+    # The three queries of the dashboard run at the same time, the bottom
+    # tables being built in the worker threads as their data arrives
+    pool = get_query_pool()
+    bl_result = pool.apply_async(bank_table, (query_params, run_query))
+    br_result = pool.apply_async(machine_table, (query_params, run_query))
+
+    # Pull down the net win over time
+    df = run_query(query_params)
+
     # Metrics holder
     metrics = {}
 
@@ -43,7 +89,8 @@ def netwin_analysis(df, query_params, engine):
     metrics['Total Net Win for this {}'.format(readable_period)] = total
     metrics['Net Win PUPD for this {}'.format(readable_period)] = pupd
 
-    # Make plot
+    # Make plot, on this thread rather than a worker thread as matplotlib is
+    # not thread safe
     tl_quadrant.plot = visualizations.makeplot('line', df_pupd, query_params, metrics)
 
     '''
@@ -67,11 +114,19 @@ def netwin_analysis(df, query_params, engine):
     tr_quadrant.column_titles = column_titles
     tr_quadrant.table_data = table_data
 
+    return tl_quadrant, tr_quadrant, bl_result.get(), br_result.get()
+
+def bank_table(query_params, run_query):
     '''
     Bottom left table:
-    Net win by bank analysis. There is opportunity to speed this up by only
-    SQL querying data from the most recent period.
+    Net win by bank analysis, of the most recent period only.
+    Input:
+        query_params -- query parameters object of the net win query
+        run_query (function) -- see netwin_analysis
+    Output:
+        quadrant object of the table
     '''
+    readable_period = human_readable_translation[query_params.period]
     factor = 'bank'
     machines_per_bank = 4
 
@@ -84,12 +139,10 @@ def netwin_analysis(df, query_params, engine):
     query_params_bl.stop = query_params.stop
     query_params_bl.period = query_params.period
     query_params_bl.factors = main_factors
+    query_params_bl.latest_period_only = True
 
-    # Generate new SQL query
-    query_params_bl.generate_sql_query()
-
-    # Pull data down
-    df = helper.get_sql_data(query_params_bl.sql_string, engine)
+    # Generate new SQL query and pull data down
+    df = run_query(query_params_bl)
 
     # Get data from most recent period
     most_recent_period = df.iloc[-1].tmstmp
@@ -127,9 +180,19 @@ def netwin_analysis(df, query_params, engine):
     bl_quadrant.column_titles = column_titles
     bl_quadrant.table_data = table_data
 
+    return bl_quadrant
+
+def machine_table(query_params, run_query):
     '''
-    Bottom right table
+    Bottom right table:
+    Best and worst machines this period.
+    Input:
+        query_params -- query parameters object of the net win query
+        run_query (function) -- see netwin_analysis
+    Output:
+        quadrant object of the table
     '''
+    readable_period = human_readable_translation[query_params.period]
     # Create quadrant object
     br_quadrant = quadrant(viz_type = 'table')
 
@@ -139,12 +202,10 @@ def netwin_analysis(df, query_params, engine):
     query_params_br.stop = query_params.stop
     query_params_br.period = query_params.period
     query_params_br.factors = ['assetnumber', 'assettitle']
+    query_params_br.latest_period_only = True
 
-    # Generate SQL query
-    query_params_br.generate_sql_query(error_checking = False)
-
-    # Pull data down
-    df = helper.get_sql_data(query_params_br.sql_string, engine)
+    # Generate SQL query and pull data down
+    df = run_query(query_params_br)
 
     # Select only current month data
     current_month = df.iloc[-1].tmstmp
@@ -157,7 +218,7 @@ def netwin_analysis(df, query_params, engine):
     # 3.034935 2017-03-01  AST-000096  Wheel Of Fortune               94.0830
     # 3.081771 2017-03-01  AST-000124  Lucky Larry's Lobstermania     95.5349
     # 3.125777 2017-03-01  AST-000170  Playboy Dont Stop The Party    96.8991
-    df_pupd = helper.calculate_pupd(df_current, query_params)
+    df_pupd = helper.calculate_pupd(df_current, query_params_br)
     df_pupd['metric'] = df_pupd.metric * 192
 
     # Get column titles
@@ -176,4 +237,4 @@ def netwin_analysis(df, query_params, engine):
     br_quadrant.title = title
     br_quadrant.table_data = table_data
 
-    return tl_quadrant, tr_quadrant, bl_quadrant, br_quadrant
+    return br_quadrant
@@ -0,0 +1,200 @@
+'''
+Module for caching the intent and entity responses of the NLU service, so a
+question asked before is answered without going over the network.
+
+Responses are kept in a SQLite file, which outlives the process and is
+shared by the app's workers, with the most recently used ones also held in
+memory. They are keyed on the normalized text of the question (see
+generateresponsefromrequest.normalize_query). Questions with relative dates,
+like "today", "last week" or "in january", resolve to different dates from
+one day to the next, so their responses expire at midnight.
+'''
+
+import calendar
+import json
+import os
+import re
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime, timedelta
+from pytz import timezone
+
+# File the responses are kept in
+NLU_CACHE_PATH = os.getenv('NLU_CACHE_PATH', 'nlu_cache.sqlite')
+
+# Responses also held in memory
+MEMORY_ENTRIES = 1024
+
+# Seconds a response without relative dates is kept, in case the NLU
+# service's model changes
+DEFAULT_TTL = 30 * 86400
+
+# Time zone the NLU service resolves relative dates in, whose midnight
+# responses to questions with relative dates expire at
+TIME_ZONE = timezone('US/Pacific')
+
+# Words of questions whose dates depend on the day they are asked
+RELATIVE_DATE_WORDS = set(['today', 'tonight', 'yesterday', 'tomorrow', 'now',
+                           'current', 'currently', 'this', 'last', 'past',
+                           'previous', 'ago', 'recent', 'recently', 'latest',
+                           'ytd', 'mtd', 'wtd', 'so far', 'to date'])
+
+# Month and weekday names, which are relative dates unless a year follows
+DATE_NAME_WORDS = set(name.lower() for name in list(calendar.month_name) +
+                      list(calendar.month_abbr) + list(calendar.day_name) +
+                      list(calendar.day_abbr) if name)
+DATE_NAME_WORDS.add('sept')
+
+# Matches the year of a date, e.g. 2015 or '15
+YEAR_PATTERN = re.compile(r"^(\d{4}|'\d{2})$")
+
+# Words after a month or weekday name searched for its year, e.g. in
+# "monday january 5th 2015"
+YEAR_WORDS = 3
+
+
+def has_relative_date(normalized_query):
+    '''
+    Input:
+        normalized_query (str) -- output of normalize_query
+    Output:
+        boolean of whether the question's dates depend on the day it is asked,
+        which month and weekday names without a year do, e.g. "in january"
+    '''
+    words = normalized_query.split()
+    pairs = [' '.join(words[i:i + 2]) for i in xrange(len(words) - 1)]
+    if RELATIVE_DATE_WORDS.intersection(words + pairs):
+        return True
+    for i, word in enumerate(words):
+        following = words[i + 1:i + 1 + YEAR_WORDS]
+        if word in DATE_NAME_WORDS and not any(YEAR_PATTERN.match(w) for w in following):
+            return True
+    return False
+
+
+def next_midnight(now=None):
+    '''
+    Input:
+        now (float) -- current time since the epoch
+    Output:
+        float of the time since the epoch of the next midnight in TIME_ZONE
+    '''
+    if now is None:
+        now = time.time()
+    local = datetime.fromtimestamp(now, TIME_ZONE)
+    midnight = TIME_ZONE.localize(datetime(local.year, local.month, local.day) + timedelta(days=1))
+    return now + (midnight - local).total_seconds()
+
+
+def expiry_for(normalized_query, now=None, ttl=DEFAULT_TTL):
+    '''
+    Input:
+        normalized_query (str) -- output of normalize_query
+        now (float) -- current time since the epoch
+        ttl (float) -- seconds a response without relative dates is kept
+    Output:
+        float of the time since the epoch the question's response expires at
+    '''
+    if now is None:
+        now = time.time()
+    if has_relative_date(normalized_query):
+        return next_midnight(now)
+    return now + ttl
+
+
+class nlu_cache(object):
+    '''
+    NLU responses by normalized question, in a SQLite file with an LRU
+    cache in memory in front of it
+    '''
+    def __init__(self, path=NLU_CACHE_PATH, max_entries=MEMORY_ENTRIES):
+        self.path = path
+        self.max_entries = max_entries
+
+        # Normalized question to (response, expiry), least recently used first
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.connection = None
+
+        self.hits = 0
+        self.misses = 0
+
+    def connect(self):
+        '''
+        Opens the SQLite file, creating its table, the lock must be held
+        '''
+        if self.connection is None:
+            # The connection is shared by the app's threads under the lock
+            self.connection = sqlite3.connect(self.path, check_same_thread=False)
+            self.connection.execute("""CREATE TABLE IF NOT EXISTS nlu_responses (
+                                           query TEXT PRIMARY KEY,
+                                           response TEXT NOT NULL,
+                                           expires REAL NOT NULL)""")
+            self.connection.commit()
+        return self.connection
+
+    def remember(self, key, entry):
+        '''
+        Holds an entry in memory, the lock must be held
+        '''
+        self.entries.pop(key, None)
+        self.entries[key] = entry
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    def get(self, key):
+        '''
+        Output:
+            the cached response, or None if there is no fresh one
+        '''
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                row = self.connect().execute("""SELECT response, expires FROM nlu_responses
+                                                WHERE query = ?""", (key,)).fetchone()
+                if row is not None:
+                    entry = (json.loads(row[0]), row[1])
+            if entry is None or entry[1] <= time.time():
+                self.entries.pop(key, None)
+                self.misses += 1
+                return None
+            self.remember(key, entry)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key, response, expires):
+        '''
+        Caches a response until expires, in seconds since the epoch
+        '''
+        with self.lock:
+            self.remember(key, (response, expires))
+            connection = self.connect()
+            connection.execute("""INSERT OR REPLACE INTO nlu_responses (query, response, expires)
+                                  VALUES (?, ?, ?)""", (key, json.dumps(response), expires))
+            connection.commit()
+
+    def purge(self):
+        '''
+        Deletes expired responses from the file
+        Output:
+            number of responses deleted
+        '''
+        with self.lock:
+            connection = self.connect()
+            deleted = connection.execute("""DELETE FROM nlu_responses WHERE expires <= ?""",
+                                         (time.time(),)).rowcount
+            connection.commit()
+        return deleted
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            connection = self.connect()
+            connection.execute("""DELETE FROM nlu_responses""")
+            connection.commit()
+
+
+# Cache shared by the app
+cache = nlu_cache()
@@ -0,0 +1,291 @@
+'''
+Module for calling the NLU service over HTTP.
+
+nlu_client keeps connections to the service open in a pooled session, so
+only the first request pays for the TCP and TLS handshakes, and bounds every
+request with connect and read timeouts. Failed requests are retried a few
+times with jittered exponential backoff, and requests slower than
+HEDGE_PERCENTILE of recent ones are hedged with a second request, the first
+answer winning. Latencies are kept in a histogram, reported by stats along
+with the number of retries, hedges and failures. Requests that still fail
+raise NLUError rather than returning None.
+
+Run with "python nlu_client.py" to exercise the client against a local
+stand-in of the service.
+'''
+
+import bisect
+import random
+import threading
+import time
+import Queue
+import requests
+from requests.adapters import HTTPAdapter
+
+# Seconds to wait for a connection, and then for the response
+CONNECT_TIMEOUT = 1.0
+READ_TIMEOUT = 5.0
+
+# Retries of a failed request, and seconds of backoff before the first one,
+# doubled for each later one
+RETRIES = 2
+BACKOFF = 0.1
+
+# Statuses worth retrying
+RETRY_STATUSES = [429, 500, 502, 503, 504]
+
+# Percentile of latency after which a second request is sent, and number of
+# latencies recorded before requests are hedged
+HEDGE_PERCENTILE = 95
+HEDGE_MIN_SAMPLES = 50
+
+# Connections kept open to the service
+POOL_SIZE = 10
+
+# Upper bounds in seconds of the buckets of the latency histogram
+LATENCY_BUCKETS = [0.025, 0.05, 0.1, 0.2, 0.4, 0.8, 1.6, 3.2, 6.4, float('inf')]
+
+
+class NLUError(Exception):
+    '''
+    Raised when the NLU service does not answer a request
+    '''
+    def __init__(self, message, status_code=None):
+        Exception.__init__(self, message)
+        self.status_code = status_code
+
+
+class latency_histogram(object):
+    '''
+    Counts of request latencies in LATENCY_BUCKETS
+    '''
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.total = 0
+        self.lock = threading.Lock()
+
+    def record(self, seconds):
+        with self.lock:
+            self.counts[bisect.bisect_left(self.buckets, seconds)] += 1
+            self.total += 1
+
+    def percentile(self, p):
+        '''
+        Input:
+            p (float) -- percentile, between 0 and 100
+        Output:
+            upper bound in seconds of the bucket the percentile falls in, or
+            None if no latency was recorded
+        '''
+        with self.lock:
+            if not self.total:
+                return None
+            rank = self.total * p / 100.0
+            seen = 0
+            for bound, count in zip(self.buckets, self.counts):
+                seen += count
+                if seen >= rank:
+                    return bound
+            return self.buckets[-1]
+
+    def snapshot(self):
+        '''
+        Output:
+            dictionary of the count of latencies up to each bucket bound
+        '''
+        with self.lock:
+            return dict(('le_{}'.format(bound), count)
+                        for bound, count in zip(self.buckets, self.counts))
+
+
+class nlu_client(object):
+    '''
+    Client of the NLU service at base_url, safe to share between threads
+    '''
+    def __init__(self, base_url, connect_timeout=CONNECT_TIMEOUT,
+                 read_timeout=READ_TIMEOUT, retries=RETRIES, backoff=BACKOFF,
+                 hedge_percentile=HEDGE_PERCENTILE, pool_size=POOL_SIZE):
+        self.base_url = base_url.rstrip('/')
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.hedge_percentile = hedge_percentile
+
+        # Retries are done here, with backoff, rather than by urllib3
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, max_retries=0)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+        self.histogram = latency_histogram()
+        self.lock = threading.Lock()
+        self.counters = {'requests': 0, 'retries': 0, 'hedges': 0,
+                         'hedge_wins': 0, 'failures': 0}
+
+    def increment(self, counter):
+        with self.lock:
+            self.counters[counter] += 1
+
+    def fetch(self, url, timeout):
+        '''
+        Sends one request, recording its latency
+        Output:
+            decoded json of the response
+        '''
+        ts = time.time()
+        response = self.session.get(url, timeout=timeout)
+        self.histogram.record(time.time() - ts)
+        if response.status_code != 200:
+            raise NLUError('NLU service returned status {}'.format(response.status_code),
+                           response.status_code)
+        return response.json()
+
+    def hedged_fetch(self, url, timeout):
+        '''
+        Same as fetch, but sends a second request if the first is slower
+        than hedge_percentile of recent requests, returning whichever
+        answers first
+        '''
+        delay = None
+        if self.histogram.total >= HEDGE_MIN_SAMPLES:
+            delay = self.histogram.percentile(self.hedge_percentile)
+        if delay is None or delay == float('inf'):
+            return self.fetch(url, timeout)
+
+        results = Queue.Queue()
+
+        def run(attempt):
+            try:
+                results.put((attempt, True, self.fetch(url, timeout)))
+            except Exception as e:
+                results.put((attempt, False, e))
+
+        def start(attempt):
+            thread = threading.Thread(target=run, args=(attempt,))
+            thread.daemon = True
+            thread.start()
+
+        start(0)
+        try:
+            attempt, ok, value = results.get(timeout=delay)
+        except Queue.Empty:
+            self.increment('hedges')
+            start(1)
+            attempt, ok, value = results.get()
+            if not ok:
+                # Wait for the other request
+                attempt, ok, value = results.get()
+            if ok and attempt == 1:
+                self.increment('hedge_wins')
+        if not ok:
+            raise value
+        return value
+
+    def get(self, path, budget=None):
+        '''
+        Requests a path of the service, retrying failures
+        Input:
+            path (str) -- path of the request, without a leading slash
+            budget (float) -- seconds the request and its retries may take in
+                              all, or None to only be bound by the timeouts
+        Output:
+            decoded json of the response
+        '''
+        self.increment('requests')
+        url = '{}/{}'.format(self.base_url, path)
+        ts = time.time()
+        error = None
+        for attempt in xrange(self.retries + 1):
+            timeout = (self.connect_timeout, self.read_timeout)
+            if budget is not None:
+                remaining = budget - (time.time() - ts)
+                if remaining <= 0:
+                    break
+                timeout = (min(self.connect_timeout, remaining), min(self.read_timeout, remaining))
+            try:
+                return self.hedged_fetch(url, timeout)
+            except NLUError as e:
+                error = e
+                if e.status_code not in RETRY_STATUSES:
+                    break
+            except (requests.RequestException, ValueError) as e:
+                error = e
+            if attempt == self.retries:
+                break
+            # Full jitter, so clients that failed together do not retry
+            # together
+            sleep = random.uniform(0, self.backoff * 2 ** attempt)
+            if budget is not None:
+                sleep = min(sleep, max(0, budget - (time.time() - ts)))
+            time.sleep(sleep)
+            self.increment('retries')
+        self.increment('failures')
+        raise NLUError('NLU request for {} failed: {}'.format(path, error),
+                       getattr(error, 'status_code', None))
+
+    def stats(self):
+        '''
+        Output:
+            dictionary of the request counters, latency percentiles in seconds
+            and latency histogram
+        '''
+        with self.lock:
+            stats = dict(self.counters)
+        for p in [50, 90, 99]:
+            stats['p{}'.format(p)] = self.histogram.percentile(p)
+        stats['histogram'] = self.histogram.snapshot()
+        return stats
+
+
+if __name__ == "__main__":
+    import BaseHTTPServer
+    import json
+    from SocketServer import ThreadingMixIn
+
+    class stand_in_handler(BaseHTTPServer.BaseHTTPRequestHandler):
+        '''
+        Answers every question the same, slowly or with an error now and
+        then like the real service
+        '''
+        protocol_version = 'HTTP/1.1'
+
+        def do_GET(self):
+            if random.random() < 0.03:
+                time.sleep(1.0)
+            else:
+                time.sleep(random.expovariate(1 / 0.03))
+            if random.random() < 0.05:
+                status, body = 503, ''
+            else:
+                status, body = 200, json.dumps({'intent_entity_mapping': {
+                    'intents': [{'intent': 'metric_by_factor_by_time_period', 'confidence': 1}],
+                    'entities': [{'entity': 'both_metrics', 'value': 'netwins', 'confidence': 1}]}})
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    class stand_in_server(ThreadingMixIn, BaseHTTPServer.HTTPServer):
+        daemon_threads = True
+
+    server = stand_in_server(('127.0.0.1', 0), stand_in_handler)
+    server_thread = threading.Thread(target=server.serve_forever)
+    server_thread.daemon = True
+    server_thread.start()
+
+    client = nlu_client('http://127.0.0.1:{}'.format(server.server_port))
+    ts = time.time()
+    for _ in xrange(300):
+        try:
+            client.get('what+is+my+revenue+today')
+        except NLUError as e:
+            print e
+    print 'Took {:.2f} sec'.format(time.time() - ts)
+    print json.dumps(client.stats(), indent=2, sort_keys=True)
+    server.shutdown()
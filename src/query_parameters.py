@@ -13,13 +13,14 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-from generateresponsefromrequest import get_intent_entity_from_watson
+from generateresponsefromrequest import get_intent_entity
 from datetime import datetime, timedelta
 import json
 import pandas as pd
 import psycopg2
 from pytz import timezone
 import helper
+from rollup_views import view_name, route_view, PERIOD_INTERVALS
 from translation_dictionaries import *
 
 TIME_ZONE = timezone('US/Pacific')
@@ -80,6 +81,25 @@ class query_parameters(object):
         # SQL string
         self.sql_string = None
 
+        # Values bound to the %(name)s placeholders of sql_string
+        self.sql_params = {}
+
+        # Factor a bar chart ranks, if the ranking is done in SQL, along with
+        # the number of top rows to return and whether to add the worst row
+        self.sql_top_factor = None
+        self.sql_limit = None
+        self.sql_include_worst = False
+
+        # Whether only the last period of the range is needed
+        self.latest_period_only = False
+
+        # Percent of the rollup's rows an approximate query reads, None to
+        # read them all
+        self.sample_percent = None
+
+        # Period the query asked for, if cost_guard moved it to a coarser one
+        self.coarsened_from = None
+
         # SQL parameters
         self.sql_metric = None
         self.sql_factors = []
@@ -95,6 +115,10 @@ class query_parameters(object):
         # Database name is name of database we get data from to get answer query
         self.database_name = None
 
+        # Name of the rollup exactly matching the query, which database_name
+        # differs from when a finer rollup is aggregated up instead
+        self.requested_database_name = None
+
         # Integer period is the number of days per time period we are segmenting
         # on (if we want hourly then days_per_interval is 1/24)
         self.days_per_interval = None
@@ -111,7 +135,13 @@ class query_parameters(object):
                "Ordering: {}\n".format(self.ordering) + \
                "Club Level: {}\n".format(self.club_level) + \
                "Statistic: {}\n".format(self.statistic) + \
-               "SQL Query: {}\n\n".format(self.sql_string) + \
+               "SQL Query: {}\n".format(self.sql_string) + \
+               "SQL params: {}\n\n".format(self.sql_params) + \
+               "SQL top factor: {}\n".format(self.sql_top_factor) + \
+               "SQL limit: {}\n".format(self.sql_limit) + \
+               "Latest period only: {}\n".format(self.latest_period_only) + \
+               "Sample percent: {}\n".format(self.sample_percent) + \
+               "Coarsened from: {}\n".format(self.coarsened_from) + \
                "SQL metric: {}\n".format(self.sql_metric) + \
                "SQL factors: {}\n".format(self.sql_factors) + \
                "SQL period: {}\n".format(self.sql_period) + \
@@ -121,6 +151,7 @@ class query_parameters(object):
                "Num days: {}\n".format(self.num_days) + \
                "Num Machines {}\n".format(self.num_machines) + \
                "Database name: {}\n".format(self.database_name) + \
+               "Requested database name: {}\n".format(self.requested_database_name) + \
                "Days per Interval: {}\n".format(self.days_per_interval)
 
     def translate_to_sql(self):
@@ -145,15 +176,15 @@ class query_parameters(object):
         if not self.sql_start:
             if not self.start:
                 self.sql_start = DEFAULT_START.strftime(
-                    "%Y-%m-%d-00-00-00-000")
+                    "%Y-%m-%d 00:00:00.000")
             else:
-                self.sql_start = self.start.strftime("%Y-%m-%d-00-00-00-000")
+                self.sql_start = self.start.strftime("%Y-%m-%d 00:00:00.000")
 
         if not self.sql_stop:
             if not self.stop:
-                self.sql_stop = DEFAULT_STOP.strftime("%Y-%m-%d-00-00-00-000")
+                self.sql_stop = DEFAULT_STOP.strftime("%Y-%m-%d 00:00:00.000")
             else:
-                self.sql_stop = self.stop.strftime("%Y-%m-%d-23-59-59-999")
+                self.sql_stop = self.stop.strftime("%Y-%m-%d 23:59:59.999")
 
         if self.club_level:
             self.sql_club_level = """AND clublevel = '{}'""".format(
@@ -313,7 +344,35 @@ class query_parameters(object):
     #
     #     self.sql_string = SQL_string
 
-    def generate_sql_query(self, error_checking=False):
+    def can_sample(self):
+        '''
+        Checks whether the query sums the metric over the rows it reads, so it
+        can be answered approximately from a sample of them (see
+        generate_sql_query). Statistics and rankings of a sample cannot be
+        scaled back up.
+        Output:
+            boolean
+        '''
+        return not self.statistic and not self.sql_top_factor and \
+            not self.latest_period_only
+
+    def generate_sql_query(self, error_checking=False, view_catalog=None):
+        '''
+        Input:
+            error_checking (bool) -- whether to print to console
+            view_catalog (dict) -- rollups that exist and their sizes, from
+                                   rollup_views.get_view_catalog. If given,
+                                   the query reads the smallest rollup that
+                                   covers it and aggregates it up to the
+                                   requested period and factors.
+                                   If sample_percent is set, the query reads
+                                   a random sample of that percent of the
+                                   rollup's rows instead and scales the
+                                   metric back up, returning the variance of
+                                   the estimate in metric_variance.
+        Output:
+            None, the query is put into the sql_string attribute
+        '''
         # Translate entities to SQL
         self.translate_to_sql()
 
@@ -328,10 +387,14 @@ class query_parameters(object):
             ctr += 1
 
         # Find correct table to get data from
-        title_string = self.sql_period + '_factored_by'
-        for factor in self.sql_factors:
-            title_string += '_'
-            title_string += factor
+        title_string = view_name(self.sql_period, self.sql_factors)
+        self.requested_database_name = title_string
+        source_period = self.sql_period
+        if view_catalog is not None:
+            routed_view = route_view(self.sql_period, self.sql_factors, view_catalog)
+            if routed_view:
+                source_period = routed_view[0]
+                title_string = view_name(*routed_view)
         if error_checking:
             print "Database table name: {}".format(title_string)
         self.database_name = title_string
@@ -342,45 +405,103 @@ class query_parameters(object):
         else:
             suffix = ''
 
-        # Dispatch based on intent
-        if self.intent == 'machine_performance':
-            # Create SQL query
-            SQL_string = \
-                """{}SELECT {} AS metric, {} AS tmstmp{}
-                   FROM {}
-                   WHERE {} >= to_timestamp('{}', 'YYYY-MM-DD-HH24-MI-SS-MS')
-                   AND {} <= to_timestamp('{}', 'YYYY-MM-DD-HH24-MI-SS-MS')
-                   {}""".format(self.sql_statistic,
-                                self.sql_metric,
-                                self.sql_period,
-                                factors_string,
-                                title_string,
-                                self.sql_period,
-                                self.sql_start,
-                                self.sql_period,
-                                self.sql_stop,
-                                suffix)
+        # Approximate queries read each row with probability q and divide the
+        # metric of the rows read by q, which estimates the metric of all of
+        # them. The variance of the estimate of a row is metric^2 (1 - q) / q^2,
+        # and rows are sampled independently, so the variances of estimates
+        # add up like the metric does.
+        sampled = self.sample_percent and self.can_sample()
+        if sampled:
+            metric_string = """{} / %(sample_fraction)s::float8""".format(self.sql_metric)
+            variance_string = """, {0} * {0} * (1 - %(sample_fraction)s::float8)
+                                   / (%(sample_fraction)s::float8 * %(sample_fraction)s::float8)""".format(
+                                       self.sql_metric)
+            table_string = """{} TABLESAMPLE BERNOULLI (%(sample_fraction)s::float8 * 100)""".format(
+                title_string)
+        else:
+            metric_string = self.sql_metric
+            variance_string = ''
+            table_string = title_string
+
+        # Re-aggregate if we are reading a finer rollup than requested
+        if title_string == self.requested_database_name:
+            select_string = """{} AS metric, {} AS tmstmp{}""".format(
+                metric_string, self.sql_period, factors_string)
+            if variance_string:
+                select_string += variance_string + ' AS metric_variance'
+            group_by_string = ''
         else:
-            # Create SQL query
+            select_string = """SUM({}) AS metric, date_trunc('{}', {}) AS tmstmp{}""".format(
+                metric_string, self.sql_period, source_period, factors_string)
+            if variance_string:
+                select_string += ', SUM({}) AS metric_variance'.format(variance_string[2:])
+            group_by_string = """GROUP BY 2{}""".format(additional_group_by)
+
+        # The range is bound as parameters rather than pasted into the
+        # string, so the text of the query only depends on the view and
+        # columns and its plan can be prepared once and reused (see
+        # helper.get_sql_data). It is cast to timestamp rather than passed
+        # through to_timestamp, which returns a timestamptz and is only
+        # stable, so the planner can prune the partitions of time partitioned
+        # tables
+
+        # The range covers every requested period it touches, whole, so the
+        # answer is the same whichever rollup it is read from
+        stop_string = """date_trunc('{}', %(stop)s::timestamp) + interval '{}'""".format(
+            self.sql_period, PERIOD_INTERVALS[self.sql_period])
+
+        # Create SQL query
+        # Only read the last period in the range if that is all we need,
+        # found through the index on the period column
+        if self.latest_period_only:
+            latest_string = """AND {} >= (SELECT date_trunc('{}', max({}))
+                                     FROM {}
+                                     WHERE {} < {})""".format(
+                                         source_period, self.sql_period, source_period,
+                                         title_string, source_period, stop_string)
+        else:
+            latest_string = ''
+
+        SQL_string = \
+            """{}SELECT {}
+               FROM {}
+               WHERE {} >= date_trunc('{}', %(start)s::timestamp)
+               AND {} < {}
+               {}
+               {}{}""".format(self.sql_statistic,
+                              select_string,
+                              table_string,
+                              source_period,
+                              self.sql_period,
+                              source_period,
+                              stop_string,
+                              latest_string,
+                              group_by_string,
+                              suffix)
+
+        # Rank the factor of a bar chart in SQL, so only the rows the chart
+        # shows are returned: the top sql_limit rows, and the worst row if
+        # the chart names it
+        if self.sql_top_factor and not self.sql_statistic:
             SQL_string = \
-                """{}SELECT {} AS metric, {} AS tmstmp{}
-                   FROM {}
-                   WHERE {} >= to_timestamp('{}', 'YYYY-MM-DD-HH24-MI-SS-MS')
-                   AND {} <= to_timestamp('{}', 'YYYY-MM-DD-HH24-MI-SS-MS')
-                   {}""".format(self.sql_statistic,
-                                  self.sql_metric,
-                                  self.sql_period,
-                                  factors_string,
-                                  title_string,
-                                  self.sql_period,
-                                  self.sql_start,
-                                  self.sql_period,
-                                  self.sql_stop,
-                                  suffix)
-            if error_checking:
-                print "SQL string: {}".format(SQL_string)
+                """WITH ranked AS (
+                       SELECT {}, SUM(metric) AS metric
+                       FROM ({}) AS t
+                       GROUP BY 1)
+                   (SELECT * FROM ranked ORDER BY metric DESC LIMIT {})""".format(
+                       self.sql_top_factor, SQL_string, self.sql_limit)
+            if self.sql_include_worst:
+                SQL_string += """
+                   UNION
+                   (SELECT * FROM ranked ORDER BY metric ASC LIMIT 1)"""
+
+        if error_checking:
+            print "SQL string: {}".format(SQL_string)
 
         self.sql_string = SQL_string
+        self.sql_params = {'start': self.sql_start, 'stop': self.sql_stop}
+        if sampled:
+            self.sql_params['sample_fraction'] = self.sample_percent / 100.0
 
 
 if __name__ == "__main__":
@@ -388,7 +509,7 @@ if __name__ == "__main__":
     query = 'what is my hourly netwins by club level, area, zone, stand, wager, manufacturer, game title'
     query = 'what is the payout rate for january 2 2015'
     query = 'by minute january 2015 revenue by club level, bank, zone'
-    response = get_intent_entity_from_watson(query)
+    response = get_intent_entity(query)
 
     # Create query parameters object
     query_params = query_parameters()
@@ -400,6 +521,11 @@ if __name__ == "__main__":
         DATABASE_USER, DATABASE_DOMAIN, DATABASE_NAME)
     df = helper.get_sql_data("""SELECT * FROM logs LIMIT 10;""", engine)
     print df.head()
-    df = helper.get_sql_data(query_params.sql_string, engine)
+    df = helper.get_sql_data(query_params.sql_string, engine,
+                             params=query_params.sql_params)
     print df.head(10)
     print len(df)
+
+    # Compare the ways of fetching the results
+    helper.benchmark_fetch(query_params.sql_string, engine,
+                           params=query_params.sql_params)
@@ -0,0 +1,340 @@
+'''
+Module for caching query results in process, so the same question asked
+again soon after is answered without going back to postgres.
+
+Results are keyed on the fields of a query parameters object that decide its
+SQL (see cache_key), evicted least recently used first once they take more
+than max_bytes, and expire after ttl seconds. database_building records every
+rollup it rebuilds in the rollup_refreshes table, and sync_refreshes drops the
+results read from those rollups, closed periods included, so a refresh is
+never hidden by the cache.
+
+Rows of time series queries for periods that have ended cannot change, so
+fetch_with_closed_periods keeps them in closed_cache for good and only
+queries the periods still open.
+'''
+
+import threading
+import time
+import pandas as pd
+from collections import OrderedDict
+from datetime import datetime, timedelta
+from rollup_views import period_start, next_period_start
+
+# Memory we are willing to spend on cached results
+DEFAULT_MAX_BYTES = 256 * 1024 * 1024
+
+# Seconds a result is served from the cache
+DEFAULT_TTL = 600
+
+# Seconds between checks of the rollup_refreshes table
+REFRESH_POLL_INTERVAL = 30
+
+# Table database_building records rollup refreshes in
+REFRESH_LOG_TABLE = 'rollup_refreshes'
+
+# Periods whose results are kept in the closed period cache once they end
+CLOSED_PERIODS = ['day', 'week', 'month', 'quarter', 'year']
+
+# Seconds after a period ends before its results are treated as final
+CLOSED_PERIOD_GRACE = 86400
+
+
+def cache_key(query_params):
+    '''
+    Input:
+        query_params -- query parameters object after generate_sql_query
+    Output:
+        tuple of the fields that decide the query's SQL
+    '''
+    return (query_params.database_name,
+            query_params.sql_metric,
+            tuple(query_params.sql_factors),
+            query_params.sql_period,
+            query_params.sql_start,
+            query_params.sql_stop,
+            query_params.sql_club_level,
+            query_params.sql_statistic,
+            query_params.sql_top_factor,
+            query_params.sql_limit,
+            query_params.sql_include_worst,
+            query_params.latest_period_only,
+            query_params.sample_percent)
+
+
+def frame_size(df):
+    '''
+    Number of bytes a DataFrame takes, including the strings it holds
+    '''
+    return int(df.memory_usage(index=True, deep=True).sum())
+
+
+class result_cache(object):
+    '''
+    LRU cache of query results bounded by bytes, with a time to live
+    '''
+    def __init__(self, max_bytes=DEFAULT_MAX_BYTES, ttl=DEFAULT_TTL):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+
+        # Key to (DataFrame, view name, size, time stored), least recently
+        # used first
+        self.entries = OrderedDict()
+        self.n_bytes = 0
+        self.lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+
+        # Latest refresh seen in the refresh log, and when it was last read
+        self.last_refresh = None
+        self.last_poll = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            return entry is not None and time.time() - entry[3] <= self.ttl
+
+    def get(self, key):
+        '''
+        Output:
+            copy of the cached DataFrame, or None if there is no fresh entry
+        '''
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and time.time() - entry[3] > self.ttl:
+                self.remove(key)
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            # Move to the most recently used end
+            del self.entries[key]
+            self.entries[key] = entry
+            self.hits += 1
+        # Callers add columns to the results they get back
+        return entry[0].copy()
+
+    def put(self, key, df, view):
+        '''
+        Caches a result read from view, unless it is larger than the cache
+        '''
+        size = frame_size(df)
+        if size > self.max_bytes:
+            return
+        with self.lock:
+            if key in self.entries:
+                self.remove(key)
+            self.entries[key] = (df.copy(), view, size, time.time())
+            self.n_bytes += size
+            while self.n_bytes > self.max_bytes:
+                self.remove(next(iter(self.entries)))
+
+    def remove(self, key):
+        '''
+        Drops an entry, the lock must be held
+        '''
+        entry = self.entries.pop(key)
+        self.n_bytes -= entry[2]
+
+    def invalidate_view(self, view):
+        '''
+        Drops every result read from view
+        Output:
+            number of results dropped
+        '''
+        with self.lock:
+            keys = [key for key, entry in self.entries.items() if entry[1] == view]
+            for key in keys:
+                self.remove(key)
+        return len(keys)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.n_bytes = 0
+
+    def sync_refreshes(self, engine, interval=REFRESH_POLL_INTERVAL):
+        '''
+        Drops the results read from rollups refreshed since the last check of
+        the refresh log, checking it at most every interval seconds
+        Input:
+            engine -- sqlalchemy engine
+            interval (float) -- seconds between checks
+        Output:
+            list of the names of the rollups refreshed since the last check
+        '''
+        if time.time() - self.last_poll < interval:
+            return []
+        self.last_poll = time.time()
+        connection = engine.connect()
+        try:
+            if connection.execute("""SELECT to_regclass('{}');""".format(REFRESH_LOG_TABLE)).scalar() is None:
+                return []
+            if self.last_refresh is None:
+                # Results cached before the log is first read may predate
+                # any refresh in it
+                self.clear()
+                closed_cache.clear()
+                self.last_refresh = connection.execute(
+                    """SELECT coalesce(max(refreshed_at), TIMESTAMPTZ 'epoch')
+                       FROM {};""".format(REFRESH_LOG_TABLE)).scalar()
+                return []
+            rows = connection.execute("""SELECT view_name, refreshed_at FROM {}
+                                         WHERE refreshed_at > %(since)s;""".format(REFRESH_LOG_TABLE),
+                                      {'since': self.last_refresh}).fetchall()
+        finally:
+            connection.close()
+        for view, refreshed_at in rows:
+            # A refresh can change periods that have ended, e.g. when late
+            # playlogs are appended, so closed periods are dropped too
+            self.invalidate_view(view)
+            closed_cache.invalidate_view(view)
+            self.last_refresh = max(self.last_refresh, refreshed_at)
+        return [row[0] for row in rows]
+
+
+class closed_period_cache(object):
+    '''
+    Results of time series queries for periods that have ended, which only
+    change when their rollup is refreshed, so they are kept without a time
+    to live until then (see invalidate_view). Each entry holds the
+    rows of one query with tmstmp in [lo, hi), and is evicted least recently
+    used first once the entries take more than max_bytes.
+    '''
+    def __init__(self, max_bytes=DEFAULT_MAX_BYTES):
+        self.max_bytes = max_bytes
+
+        # Key to (lo, hi, DataFrame, size), least recently used first
+        self.entries = OrderedDict()
+        self.n_bytes = 0
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        '''
+        Output:
+            (lo, hi, DataFrame) tuple, or None if key is not cached
+        '''
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            if entry is None:
+                return None
+            self.entries[key] = entry
+        return entry[:3]
+
+    def put(self, key, lo, hi, df):
+        size = frame_size(df)
+        if size > self.max_bytes:
+            return
+        with self.lock:
+            old = self.entries.pop(key, None)
+            if old is not None:
+                self.n_bytes -= old[3]
+            self.entries[key] = (lo, hi, df, size)
+            self.n_bytes += size
+            while self.n_bytes > self.max_bytes:
+                self.n_bytes -= self.entries.popitem(last=False)[1][3]
+
+    def invalidate_view(self, view):
+        '''
+        Drops every entry read from view
+        Output:
+            number of entries dropped
+        '''
+        with self.lock:
+            keys = [key for key in self.entries if key[0] == view]
+            for key in keys:
+                self.n_bytes -= self.entries.pop(key)[3]
+        return len(keys)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.n_bytes = 0
+
+
+def uses_closed_periods(query_params):
+    '''
+    Checks whether a query returns one row per period and factor values,
+    read straight from the rollup of its period, so its rows for periods
+    that have ended can be cached for good. Approximate answers are not
+    worth keeping.
+    Input:
+        query_params -- query parameters object after generate_sql_query
+    Output:
+        boolean
+    '''
+    return query_params.sql_period in CLOSED_PERIODS and \
+        query_params.database_name == query_params.requested_database_name and \
+        not query_params.sql_statistic and \
+        not query_params.sql_top_factor and \
+        not query_params.latest_period_only and \
+        not query_params.sample_percent
+
+
+def fetch_with_closed_periods(query_params, fetch, now=None):
+    '''
+    Answers a time series query from closed_cache for the periods that have
+    ended, only running the query live from the first period not cached
+    Input:
+        query_params -- query parameters object after generate_sql_query,
+                        for which uses_closed_periods holds
+        fetch (function) -- runs the query of query_params from the start
+                            string it is given instead of sql_start, and
+                            returns its results
+        now (datetime) -- current time
+    Output:
+        DataFrame of the query results
+    '''
+    # The query returns every period its range touches, whole
+    start = pd.Timestamp(period_start(pd.Timestamp(query_params.sql_start),
+                                      query_params.sql_period))
+    stop = pd.Timestamp(query_params.sql_stop)
+    stop_hi = pd.Timestamp(next_period_start(stop, query_params.sql_period))
+    # Periods are treated as ended a grace period after they end, as
+    # playlogs arrive late
+    if now is None:
+        now = datetime.now()
+    boundary = pd.Timestamp(period_start(now - timedelta(seconds=CLOSED_PERIOD_GRACE),
+                                         query_params.sql_period))
+    key = (query_params.database_name, query_params.sql_metric,
+           tuple(query_params.sql_factors), query_params.sql_period,
+           query_params.sql_club_level)
+    # The query only returns periods up to the one containing stop, so an
+    # entry can only be known to hold every row before the earlier of the
+    # next period and the boundary
+    fetched_hi = min(boundary, stop_hi)
+
+    entry = closed_cache.get(key)
+    if entry is None or entry[0] > start or entry[1] <= start:
+        # Nothing cached covers the start of the range
+        df = fetch(query_params.sql_start)
+        if fetched_hi > start:
+            closed_cache.put(key, start, fetched_hi, df[df.tmstmp < fetched_hi])
+        return df
+
+    lo, hi, closed = entry
+    cached = closed[(closed.tmstmp >= start) & (closed.tmstmp <= stop)]
+    if stop_hi <= hi:
+        return cached.copy()
+    # The live query runs from hi, so the entry can be extended with it
+    live = fetch(hi.strftime('%Y-%m-%d %H:%M:%S.%f'))
+    if fetched_hi > hi:
+        closed_cache.put(key, lo, fetched_hi,
+                         pd.concat([closed, live[live.tmstmp < fetched_hi]], ignore_index=True))
+    return pd.concat([cached, live], ignore_index=True)
+
+
+# Cache shared by the app
+cache = result_cache()
+closed_cache = closed_period_cache()
+
+
+def invalidate_view(view):
+    '''
+    Drops the results read from view from the shared caches
+    '''
+    return cache.invalidate_view(view) + closed_cache.invalidate_view(view)
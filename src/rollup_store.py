@@ -0,0 +1,127 @@
+'''
+Module for keeping rollup views resident in memory, so queries are answered
+in process by helper.get_sql_data(..., in_memory=True) without a round trip
+to postgres.
+
+Rollups are loaded once, at startup with load or on first use, into
+DataFrames with categorical factor columns and a datetime64 period column,
+and queries are answered from the smallest resident rollup covering them
+with cube.aggregate_frame. Only the coarse periods are kept resident: for a
+192 machine floor the day, week and month rollups take a few MB each, while
+the hour and minute ones do not belong in a web worker.
+'''
+
+import threading
+import time
+import pandas as pd
+import cube
+import rollup_views
+from rollup_views import view_name, parse_view_name, route_view
+
+# Periods of the rollups kept in memory
+RESIDENT_PERIODS = ['day', 'week', 'month', 'quarter', 'year']
+
+# Seconds a resident rollup is used before it is read again, in case a
+# refresh was missed
+DEFAULT_MAX_AGE = 3600
+
+
+def read_rollup(engine, name):
+    '''
+    Reads a rollup into a DataFrame laid out for in memory queries
+    Input:
+        engine -- sqlalchemy engine
+        name (string) -- name of the rollup
+    Output:
+        DataFrame of the rollup with categorical factor columns
+    '''
+    time_period, factors = parse_view_name(name)
+    df = pd.read_sql_query("""SELECT * FROM {};""".format(name), con=engine)
+    df[time_period] = pd.to_datetime(df[time_period])
+    for factor in factors:
+        df[factor] = df[factor].astype('category')
+    return df
+
+
+class rollup_store(object):
+    '''
+    Rollups held in memory, by name
+    '''
+    def __init__(self, periods=RESIDENT_PERIODS, max_age=DEFAULT_MAX_AGE):
+        self.periods = periods
+        self.max_age = max_age
+
+        # Name to (DataFrame, time loaded)
+        self.frames = {}
+        self.lock = threading.Lock()
+
+    def get_frame(self, engine, name):
+        '''
+        Returns a resident rollup, reading it first if it is missing or stale
+        '''
+        with self.lock:
+            entry = self.frames.get(name)
+        if entry is None or time.time() - entry[1] > self.max_age:
+            entry = (read_rollup(engine, name), time.time())
+            with self.lock:
+                self.frames[name] = entry
+        return entry[0]
+
+    def load(self, engine):
+        '''
+        Reads every rollup with a resident period, e.g. at startup
+        Output:
+            dictionary of the number of rows of each rollup read
+        '''
+        loaded = {}
+        for time_period, factors in rollup_views.get_view_catalog(engine):
+            if time_period in self.periods:
+                name = view_name(time_period, factors)
+                loaded[name] = len(self.get_frame(engine, name))
+        return loaded
+
+    def invalidate_view(self, name):
+        '''
+        Drops a resident rollup, so it is read again on next use
+        '''
+        with self.lock:
+            self.frames.pop(name, None)
+
+    def memory_usage(self):
+        '''
+        Number of bytes taken by the resident rollups
+        '''
+        with self.lock:
+            frames = [entry[0] for entry in self.frames.values()]
+        return sum(int(df.memory_usage(index=True, deep=True).sum()) for df in frames)
+
+    def route(self, query_params, engine):
+        '''
+        Output:
+            (time_period, factors) tuple of the smallest rollup with a
+            resident period that covers the query, or None if there is none
+        '''
+        catalog = dict((view, rows) for view, rows in rollup_views.get_view_catalog(engine).items()
+                       if view[0] in self.periods)
+        return route_view(query_params.sql_period, query_params.sql_factors, catalog)
+
+    def query(self, query_params, engine):
+        '''
+        Answers a query from the smallest rollup with a resident period that
+        covers it
+        Input:
+            query_params -- query parameters object after generate_sql_query
+            engine -- sqlalchemy engine to read missing rollups with
+        Output:
+            DataFrame shaped like the result of query_params.sql_string, or
+            None if no rollup with a resident period covers the query
+        '''
+        routed_view = self.route(query_params, engine)
+        if routed_view is None:
+            return None
+        df = self.get_frame(engine, view_name(*routed_view))
+        return cube.aggregate_frame(df, routed_view[0], query_params)
+
+
+# Store shared by the app
+store = rollup_store()
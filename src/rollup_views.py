@@ -0,0 +1,248 @@
+'''
+Module for naming the rollup views and tables built by database_building,
+and for routing queries to the smallest rollup that can answer them.
+
+Every rollup is named <period>_factored_by_<factor>_<factor>... with the
+factors in alphabetical order, e.g. month_factored_by_assetnumber_assettitle.
+'''
+
+import time
+from datetime import timedelta
+
+ROLLUP_NAME_SEPARATOR = '_factored_by'
+
+
+def view_name(time_period, factors):
+    '''
+    Builds the name of the rollup for a time period and list of factors
+    Input:
+        time_period (string) -- period the rollup is aggregated on
+        factors (list) -- list of strings of factors the rollup is grouped by
+    Output:
+        string of the rollup name
+    '''
+    title_string = time_period + ROLLUP_NAME_SEPARATOR
+    for factor in sorted(factors):
+        title_string += '_'
+        title_string += factor
+    return title_string
+
+
+def parse_view_name(name):
+    '''
+    Inverse of view_name
+    Input:
+        name (string) -- name of a rollup
+    Output:
+        tuple of the time period string and the sorted list of factors, or
+        None if name is not the name of a rollup
+    '''
+    if ROLLUP_NAME_SEPARATOR not in name:
+        return None
+    time_period, factor_string = name.split(ROLLUP_NAME_SEPARATOR, 1)
+    factors = [factor for factor in factor_string.split('_') if factor]
+    return time_period, factors
+
+
+# Rows of a rollup per page, to size rollups that were never analyzed
+ROWS_PER_PAGE = 80
+
+# Time periods from finest to coarsest
+PERIOD_ORDER = ['minute', 'hour', 'day', 'week', 'month', 'quarter', 'year']
+
+# Length of each time period as a postgres interval
+PERIOD_INTERVALS = {'minute': '1 minute', 'hour': '1 hour', 'day': '1 day',
+                    'week': '1 week', 'month': '1 month', 'quarter': '3 months',
+                    'year': '1 year'}
+
+
+def period_start(timestamp, time_period):
+    '''
+    Python equivalent of date_trunc
+    Input:
+        timestamp (datetime) -- time to truncate
+        time_period (string) -- period to truncate to
+    Output:
+        datetime of the start of the period containing timestamp
+    '''
+    if time_period == 'minute':
+        return timestamp.replace(second=0, microsecond=0)
+    if time_period == 'hour':
+        return timestamp.replace(minute=0, second=0, microsecond=0)
+    day = timestamp.replace(hour=0, minute=0, second=0, microsecond=0)
+    if time_period == 'day':
+        return day
+    if time_period == 'week':
+        # Weeks start on Monday, as in postgres
+        return day - timedelta(days=day.weekday())
+    if time_period == 'month':
+        return day.replace(day=1)
+    if time_period == 'quarter':
+        return day.replace(month=(day.month - 1) // 3 * 3 + 1, day=1)
+    if time_period == 'year':
+        return day.replace(month=1, day=1)
+    raise ValueError('Unknown time period {}'.format(time_period))
+
+
+def next_period_start(timestamp, time_period):
+    '''
+    Input:
+        timestamp (datetime) -- time in the period
+        time_period (string) -- period timestamp falls in
+    Output:
+        datetime of the start of the period after the one containing timestamp
+    '''
+    start = period_start(timestamp, time_period)
+    if time_period in ['month', 'quarter', 'year']:
+        months = {'month': 1, 'quarter': 3, 'year': 12}[time_period]
+        month = start.month - 1 + months
+        return start.replace(year=start.year + month // 12, month=month % 12 + 1)
+    days = {'minute': 1.0 / 1440, 'hour': 1.0 / 24, 'day': 1, 'week': 7}[time_period]
+    return start + timedelta(days=days)
+
+
+def can_roll_up(from_period, to_period):
+    '''
+    Checks whether buckets of to_period can be built by summing buckets of
+    from_period. Weeks straddle months, so months, quarters and years cannot
+    be built from weeks.
+    Input:
+        from_period (string) -- period of the finer rollup
+        to_period (string) -- period of the coarser rollup
+    Output:
+        boolean
+    '''
+    if from_period == to_period:
+        return True
+    if PERIOD_ORDER.index(from_period) > PERIOD_ORDER.index(to_period):
+        return False
+    return not (from_period == 'week' and to_period in ['month', 'quarter', 'year'])
+
+
+def covers(source, target):
+    '''
+    Checks whether the rollup source can answer everything the rollup target
+    can, i.e. its period rolls up to target's and it has all of its factors
+    Input:
+        source (tuple) -- time period string and list of factors
+        target (tuple) -- time period string and list of factors
+    Output:
+        boolean
+    '''
+    return can_roll_up(source[0], target[0]) and \
+        set(target[1]).issubset(set(source[1]))
+
+
+def load_view_catalog(engine):
+    '''
+    Finds the rollups that exist in the database and their estimated sizes
+    Input:
+        engine -- sqlalchemy engine
+    Output:
+        dictionary mapping (time_period, factors) tuples, with factors as a
+        tuple, to the estimated number of rows of the rollup, or None if it
+        is not known
+    '''
+    connection = engine.connect()
+    try:
+        # Monthly partitions only hold part of a rollup, which is sized as
+        # the sum of its partitions
+        rows = connection.execute("""SELECT relname,
+                                            CASE WHEN relkind = 'p' THEN
+                                                (SELECT CASE WHEN bool_and(child.reltuples > 0)
+                                                        THEN sum(child.reltuples) ELSE -1 END
+                                                 FROM pg_inherits
+                                                 JOIN pg_class child ON child.oid = inhrelid
+                                                 WHERE inhparent = pg_class.oid)
+                                            ELSE reltuples END,
+                                            CASE WHEN relkind = 'p' THEN
+                                                (SELECT coalesce(sum(child.relpages), 0)
+                                                 FROM pg_inherits
+                                                 JOIN pg_class child ON child.oid = inhrelid
+                                                 WHERE inhparent = pg_class.oid)
+                                            ELSE relpages END
+                                     FROM pg_class
+                                     WHERE relkind IN ('r', 'm', 'p')
+                                     AND NOT relispartition
+                                     AND relname LIKE '%%factored_by%%';""").fetchall()
+    finally:
+        connection.close()
+    catalog = {}
+    for name, n_rows, n_pages in rows:
+        parsed = parse_view_name(name)
+        if parsed:
+            catalog[(parsed[0], tuple(parsed[1]))] = estimate_rows(n_rows, n_pages)
+    return catalog
+
+
+def estimate_rows(n_rows, n_pages):
+    '''
+    Input:
+        n_rows (float) -- reltuples of a rollup, 0 or -1 if it was never
+                          analyzed
+        n_pages (int) -- relpages of the rollup
+    Output:
+        estimated number of rows of the rollup, or None if it is not known
+    '''
+    if n_rows > 0:
+        return n_rows
+    if n_pages > 0:
+        return n_pages * ROWS_PER_PAGE
+    return None
+
+
+# Catalog cached between requests, with the time it was loaded
+cached_catalog = {'catalog': None, 'loaded': 0}
+
+
+def get_view_catalog(engine, max_age=300):
+    '''
+    Same as load_view_catalog, but reuses the catalog loaded by an earlier
+    call for up to max_age seconds
+    '''
+    if cached_catalog['catalog'] is None or \
+       time.time() - cached_catalog['loaded'] > max_age:
+        cached_catalog['catalog'] = load_view_catalog(engine)
+        cached_catalog['loaded'] = time.time()
+    return cached_catalog['catalog']
+
+
+def view_rows_bound(view, catalog):
+    '''
+    Input:
+        view (tuple) -- (time_period, factors) tuple of a rollup in catalog
+        catalog (dict) -- output of load_view_catalog
+    Output:
+        estimated number of rows of the rollup, or if it is not known the
+        fewest rows of a known rollup covering it, which it cannot have more
+        rows than, or infinity
+    '''
+    if catalog[view] is not None:
+        return catalog[view]
+    bounds = [n_rows for other, n_rows in catalog.items()
+              if n_rows is not None and covers(other, view)]
+    return min(bounds) if bounds else float('inf')
+
+
+def route_view(time_period, factors, catalog):
+    '''
+    Picks the smallest existing rollup that can answer a query for a time
+    period and factors, i.e. the exact rollup or one with a finer period or
+    more factors that can be aggregated up to the query
+    Input:
+        time_period (string) -- period of the query
+        factors (list) -- list of strings of factors of the query
+        catalog (dict) -- output of load_view_catalog
+    Output:
+        (time_period, factors) tuple of the rollup, or None if no rollup
+        covers the query
+    '''
+    target = (time_period, factors)
+    candidates = [view for view in catalog if covers(view, target)]
+    if not candidates:
+        return None
+    # Ties go to the exact rollup, then the coarsest period and fewest factors
+    return min(candidates, key=lambda view: (view_rows_bound(view, catalog),
+                                             view != (time_period, tuple(sorted(factors))),
+                                             -PERIOD_ORDER.index(view[0]),
+                                             len(view[1])))
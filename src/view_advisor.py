@@ -0,0 +1,275 @@
+'''
+Module for choosing which rollup views to build from the queries the app
+actually receives.
+
+helper.get_sql_data records the view (query_params.database_name) every query
+asks for, how long it took and whether it succeeded. advise_views ranks
+candidate period and factor combinations by how many rows they save the
+recorded queries against how many rows they cost to store, and prints or
+builds the best set within a storage budget.
+
+Run with "python view_advisor.py [storage budget in rows] [--apply]"
+'''
+
+import atexit
+import csv
+import os
+import threading
+import time
+from collections import defaultdict
+from rollup_views import view_name, parse_view_name, can_roll_up, covers, \
+                         PERIOD_ORDER
+
+# File the view requests are appended to
+VIEW_REQUEST_LOG = 'view_requests.csv'
+
+# Default number of rollup rows we are willing to store
+DEFAULT_STORAGE_BUDGET = 50000000
+
+# Requests held in memory before they are appended to the log, and seconds
+# after which they are appended regardless
+LOG_FLUSH_ROWS = 500
+LOG_FLUSH_INTERVAL = 60
+
+# Requests not yet appended, by log path, and when each log was last
+# appended to
+pending_requests = defaultdict(list)
+last_flush = defaultdict(time.time)
+log_lock = threading.Lock()
+file_lock = threading.Lock()
+
+
+def record_view_request(database_name, latency, found, log_path=VIEW_REQUEST_LOG):
+    '''
+    Records a view request, appending the requests recorded so far to the
+    request log once there are LOG_FLUSH_ROWS of them or LOG_FLUSH_INTERVAL
+    seconds have passed, so queries rarely wait on the file
+    Input:
+        database_name (string) -- name of the view the query asked for
+        latency (float) -- seconds the query took
+        found (bool) -- whether the query succeeded
+        log_path (string) -- path of the request log
+    Output:
+        None
+    '''
+    now = time.time()
+    with log_lock:
+        pending = pending_requests[log_path]
+        pending.append([now, database_name, round(latency, 4), int(found)])
+        due = len(pending) >= LOG_FLUSH_ROWS or \
+            now - last_flush[log_path] >= LOG_FLUSH_INTERVAL
+    if due:
+        flush_view_requests(log_path)
+
+
+def flush_view_requests(log_path=VIEW_REQUEST_LOG):
+    '''
+    Appends the requests held in memory to the request log
+    Input:
+        log_path (string) -- path of the request log
+    Output:
+        None
+    '''
+    # Rows are taken and written under the file lock, so they are appended
+    # in the order they were recorded
+    with file_lock:
+        with log_lock:
+            rows = pending_requests.pop(log_path, [])
+            last_flush[log_path] = time.time()
+        if rows:
+            with open(log_path, 'ab') as log_file:
+                csv.writer(log_file).writerows(rows)
+
+
+@atexit.register
+def flush_all_view_requests():
+    for log_path in list(pending_requests):
+        flush_view_requests(log_path)
+
+
+def load_view_requests(log_path=VIEW_REQUEST_LOG):
+    '''
+    Summarizes the request log
+    Input:
+        log_path (string) -- path of the request log
+    Output:
+        dictionary mapping (time_period, factors) tuples, with factors as a
+        tuple, to a dictionary of the number of requests, the total latency
+        and the number of failed requests
+    '''
+    flush_view_requests(log_path)
+    requests = defaultdict(lambda: {'count': 0, 'latency': 0.0, 'failed': 0})
+    if not os.path.exists(log_path):
+        return requests
+    with open(log_path, 'rb') as log_file:
+        for row in csv.reader(log_file):
+            parsed = parse_view_name(row[1])
+            if not parsed:
+                continue
+            key = (parsed[0], tuple(parsed[1]))
+            requests[key]['count'] += 1
+            requests[key]['latency'] += float(row[2])
+            requests[key]['failed'] += 1 - int(row[3])
+    return requests
+
+
+def get_column_statistics(engine, table_name='current_logs'):
+    '''
+    Reads the planner statistics of the raw playlogs table
+    Input:
+        engine -- sqlalchemy engine
+        table_name (string) -- string of the raw playlogs table
+    Output:
+        tuple of the estimated number of rows, the first and last tmstmp, and
+        a dictionary of estimated distinct values per column
+    '''
+    connection = engine.connect()
+    try:
+        n_rows = connection.execute("""SELECT reltuples FROM pg_class
+                                       WHERE oid = to_regclass('{}');""".format(table_name)).scalar()
+        start, stop = connection.execute("""SELECT min(tmstmp), max(tmstmp)
+                                            FROM {};""".format(table_name)).fetchone()
+        rows = connection.execute("""SELECT attname, n_distinct FROM pg_stats
+                                     WHERE tablename = '{}';""".format(table_name)).fetchall()
+    finally:
+        connection.close()
+    # Negative n_distinct is a fraction of the number of rows
+    n_distinct = dict((row[0], row[1] if row[1] >= 0 else -row[1] * n_rows)
+                      for row in rows)
+    return n_rows, start, stop, n_distinct
+
+
+def estimate_view_rows(time_period, factors, n_rows, start, stop, n_distinct):
+    '''
+    Estimates the number of rows of a rollup as the number of time buckets
+    times the number of factor combinations, which is at most the number of
+    raw rows, and at least one so it can be divided by
+    Input:
+        time_period (string) -- period of the rollup
+        factors (list) -- list of strings of factors of the rollup
+        n_rows, start, stop, n_distinct -- output of get_column_statistics
+    Output:
+        float of the estimated number of rows
+    '''
+    bucket_days = {'minute': 1.0 / 1440, 'hour': 1.0 / 24, 'day': 1, 'week': 7,
+                   'month': 31, 'quarter': 92, 'year': 365}
+    span_days = (stop - start).total_seconds() / 86400
+    estimate = max(1, span_days / bucket_days[time_period])
+    for factor in factors:
+        estimate *= max(1, n_distinct.get(factor, 1))
+    # reltuples is 0, or -1, for tables never analyzed
+    return max(1, min(estimate, n_rows))
+
+
+def candidate_views(requested):
+    '''
+    Lists the rollups worth considering for a set of requested rollups: the
+    requested ones, and for each pair of them the finest common period with
+    the union of their factors, which can answer both
+    Input:
+        requested (list) -- list of (time_period, factors) tuples
+    Output:
+        list of (time_period, factors) tuples with factors as tuples
+    '''
+    candidates = set((time_period, tuple(sorted(factors)))
+                     for time_period, factors in requested)
+    for first in list(candidates):
+        for second in list(candidates):
+            for time_period in reversed(PERIOD_ORDER):
+                if can_roll_up(time_period, first[0]) and \
+                   can_roll_up(time_period, second[0]):
+                    break
+            candidates.add((time_period,
+                            tuple(sorted(set(first[1]) | set(second[1])))))
+    return sorted(candidates)
+
+
+def rank_candidate_views(requests, view_rows, raw_rows, storage_budget):
+    '''
+    Greedily picks the rollups that save the most rows scanned by the
+    recorded requests per row stored, until the storage budget is used up.
+    Each request is assumed to cost the rows of the smallest chosen rollup
+    that covers it, or all raw rows if none does, weighted by how often and
+    how slowly it was requested.
+    Input:
+        requests (dict) -- output of load_view_requests
+        view_rows (dict) -- estimated rows of each candidate rollup
+        raw_rows (float) -- number of rows of the raw playlogs
+        storage_budget (float) -- number of rollup rows we can store
+    Output:
+        list of (time_period, factors, rows, benefit) tuples in the order
+        chosen
+    '''
+    weights = dict((key, stats['count'] * (1 + stats['latency'] / stats['count']))
+                   for key, stats in requests.items())
+    cost = dict((key, raw_rows) for key in requests)
+    chosen = []
+    remaining = storage_budget
+    candidates = set(view_rows)
+    while candidates:
+        best, best_benefit = None, 0
+        for candidate in candidates:
+            if view_rows[candidate] > remaining:
+                continue
+            benefit = sum(weights[key] * max(0, cost[key] - view_rows[candidate])
+                          for key in requests if covers(candidate, key))
+            if benefit / view_rows[candidate] > best_benefit:
+                best, best_benefit = candidate, benefit / view_rows[candidate]
+        if best is None:
+            break
+        candidates.remove(best)
+        remaining -= view_rows[best]
+        benefit = 0
+        for key in requests:
+            if covers(best, key) and view_rows[best] < cost[key]:
+                benefit += weights[key] * (cost[key] - view_rows[best])
+                cost[key] = view_rows[best]
+        chosen.append((best[0], list(best[1]), view_rows[best], benefit))
+    return chosen
+
+
+def advise_views(engine, storage_budget=DEFAULT_STORAGE_BUDGET,
+                 log_path=VIEW_REQUEST_LOG, apply=False):
+    '''
+    Recommends, and optionally builds, the rollups to keep
+    Input:
+        engine -- sqlalchemy engine
+        storage_budget (float) -- number of rollup rows we can store
+        log_path (string) -- path of the request log
+        apply (bool) -- whether to build the recommended rollups
+    Output:
+        list of (time_period, factors, rows, benefit) tuples
+    '''
+    requests = load_view_requests(log_path)
+    if not requests:
+        print 'No view requests recorded in {}'.format(log_path)
+        return []
+
+    n_rows, start, stop, n_distinct = get_column_statistics(engine)
+    view_rows = dict((candidate, estimate_view_rows(candidate[0], candidate[1],
+                                                    n_rows, start, stop,
+                                                    n_distinct))
+                     for candidate in candidate_views(requests.keys()))
+    chosen = rank_candidate_views(requests, view_rows, n_rows, storage_budget)
+
+    for time_period, factors, rows, benefit in chosen:
+        print '{}: ~{:.0f} rows, saves ~{:.0f} weighted rows scanned'.format(
+            view_name(time_period, factors), rows, benefit)
+
+    if apply:
+        # Imported here as database_building depends on helper, which
+        # records requests through this module
+        import database_building
+        # Only the chosen rollups, a base covering them was not budgeted for
+        database_building.refresh_rollup_lattice(
+            engine, [(time_period, factors) for time_period, factors, _, _ in chosen],
+            add_base=False)
+    return chosen
+
+
+if __name__ == "__main__":
+    import sys
+    import database
+    budget = float(sys.argv[1]) if len(sys.argv) > 1 else DEFAULT_STORAGE_BUDGET
+    advise_views(database.get_engine(statement_timeout=0), budget,
+                 apply='--apply' in sys.argv)
@@ -72,6 +72,11 @@ def line_plot(df, query_params, text):
         min_y = ax.get_ylim()[0]
         plt.fill_between(df.tmstmp.values, df.metric.values, min_y, alpha=0.5)
 
+        # Shade the confidence interval of approximate answers
+        if 'metric_error' in df.columns:
+            plt.fill_between(df.tmstmp.values, (df.metric - df.metric_error).values,
+                             (df.metric + df.metric_error).values, alpha=0.3)
+
         # Add text box
         ctr = 1
         for key, value in text.iteritems():
@@ -99,6 +104,11 @@ def line_plot(df, query_params, text):
             df_subgroup = df[df['factor'] == unique_item]
             # Make plot
             plt.plot(df_subgroup.tmstmp, df_subgroup.metric, label=unique_item)
+            if 'metric_error' in df.columns:
+                plt.fill_between(df_subgroup.tmstmp.values,
+                                 (df_subgroup.metric - df_subgroup.metric_error).values,
+                                 (df_subgroup.metric + df_subgroup.metric_error).values,
+                                 alpha=0.3)
             plt.legend()
             # Make interactive legend
             # handles, labels = ax.get_legend_handles_labels()
@@ -123,12 +133,19 @@ def hbar_plot(df, query_params, text):
 
     y_pos = range(df.shape[0])
     # ax.barh(y_pos, df.metric, align="center", tick_label=df.factor)
-    ax.barh(y_pos, df.metric)
+    if 'metric_error' in df.columns:
+        # Approximate answers get error bars of their confidence intervals
+        ax.barh(y_pos, df.metric, xerr=df.metric_error.values)
+        labels = ['{} +/- {}'.format(metric, error)
+                  for metric, error in zip(df.metric, df.metric_error)]
+    else:
+        ax.barh(y_pos, df.metric)
+        labels = list(df.metric)
 
     label_locations = [x + 0.4 for x in xrange(len(df))]
     plt.yticks(label_locations, df.factor)
     for i, bar in enumerate(ax.get_children()[:df.shape[0]]):
-        tooltip = mpld3.plugins.LineLabelTooltip(bar, label=df.metric[i])
+        tooltip = mpld3.plugins.LineLabelTooltip(bar, label=labels[i])
         mpld3.plugins.connect(fig, tooltip)
     return fig
 
@@ -0,0 +1,131 @@
+'''
+Tests of the in-process cube builder, checked against pandas groupby of the
+same playlogs.
+'''
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import cube
+from query_parameters import query_parameters
+
+
+def make_playlogs(n_rows=5000, seed=0):
+    '''
+    Output:
+        DataFrame laid out like processed playlogs, over three months
+    '''
+    random = np.random.RandomState(seed)
+    start = pd.Timestamp('2015-01-01').value
+    stop = pd.Timestamp('2015-04-01').value
+    df = pd.DataFrame({
+        'tmstmp': pd.to_datetime(np.sort(random.randint(start, stop, n_rows))),
+        'amountbet': random.randint(0, 500, n_rows).astype(np.float64),
+        'amountwon': random.randint(0, 500, n_rows).astype(np.float64),
+        'gamesplayed': random.randint(1, 20, n_rows),
+        'bank': random.choice(['B1', 'B2', 'B3', 'B4'], n_rows),
+        'zone': random.choice(['Z1', 'Z2'], n_rows)})
+    # SUM ignores NULLs, which the cube counts as zero
+    df.loc[df.index[::97], 'amountwon'] = np.nan
+    return df
+
+
+def expected_rollup(df, time_period, factors):
+    grouped = df.assign(netwins=(df.amountbet - df.amountwon).fillna(0),
+                        handlepulls=df.gamesplayed,
+                        amountwon=df.amountwon.fillna(0))
+    grouped[time_period] = cube.truncate_period(grouped.tmstmp.values, time_period)
+    return grouped.groupby([time_period] + factors, as_index=False)[
+        ['netwins', 'handlepulls', 'amountwon', 'amountbet']].sum()
+
+
+def build(df, cuboids, n_chunks=7):
+    builder = cube.cube_builder(cuboids)
+    bounds = np.linspace(0, len(df), n_chunks + 1).astype(int)
+    for start, stop in zip(bounds[:-1], bounds[1:]):
+        builder.add_chunk(df.iloc[start:stop])
+    return builder
+
+
+def sort_frame(df, columns):
+    return df.sort_values(columns).reset_index(drop=True)
+
+
+@pytest.mark.parametrize('time_period,factors', [('day', ['bank']),
+                                                 ('week', ['bank', 'zone']),
+                                                 ('month', ['zone', 'bank']),
+                                                 ('hour', [])])
+def test_cuboid_matches_groupby(time_period, factors):
+    df = make_playlogs()
+    builder = build(df, [(time_period, factors)])
+    factors = sorted(factors)
+    result = builder.result(time_period, factors)
+    for factor in factors:
+        result[factor] = result[factor].astype(str)
+    expected = expected_rollup(df, time_period, factors)
+
+    result = sort_frame(result, [time_period] + factors)
+    expected = sort_frame(expected, [time_period] + factors)
+    assert len(result) == len(expected)
+    assert (result[time_period].values == expected[time_period].values).all()
+    for factor in factors:
+        assert (result[factor].values == expected[factor].values).all()
+    for measure in cube.MEASURES:
+        np.testing.assert_allclose(result[measure].values, expected[measure].values)
+
+
+def test_merging_partials_does_not_change_result(monkeypatch):
+    df = make_playlogs()
+    merged = build(df, [('day', ['bank'])], n_chunks=9)
+    monkeypatch.setattr(cube, 'MAX_PARTIALS', 2)
+    merged_often = build(df, [('day', ['bank'])], n_chunks=9)
+    first = sort_frame(merged.result('day', ['bank']), ['day', 'bank'])
+    second = sort_frame(merged_often.result('day', ['bank']), ['day', 'bank'])
+    np.testing.assert_allclose(first.netwins.values, second.netwins.values)
+
+
+def test_write_and_query_round_trip(tmpdir):
+    df = make_playlogs()
+    directory = str(tmpdir.join('cube'))
+    build(df, [('day', ['bank', 'zone'])]).write(directory)
+
+    # A month by bank query is answered by re-aggregating the day cuboid,
+    # reading every month the range touches whole
+    query_params = query_parameters()
+    query_params.sql_metric = 'netwins'
+    query_params.sql_period = 'month'
+    query_params.sql_factors = ['bank']
+    query_params.sql_start = '2015-01-15 00:00:00.000'
+    query_params.sql_stop = '2015-02-10 23:59:59.999'
+    query_params.database_name = 'day_factored_by_bank_zone'
+    result = cube.query_cube(query_params, directory)
+
+    in_range = df[(df.tmstmp >= '2015-01-01') & (df.tmstmp < '2015-03-01')]
+    expected = expected_rollup(in_range, 'month', ['bank'])
+    result = sort_frame(result.assign(bank=result.bank.astype(str)), ['tmstmp', 'bank'])
+    expected = sort_frame(expected, ['month', 'bank'])
+    assert list(result.columns) == ['metric', 'tmstmp', 'bank']
+    assert (result.tmstmp.values == expected.month.values).all()
+    assert (result.bank.values == expected.bank.values).all()
+    np.testing.assert_allclose(result.metric.values, expected.netwins.values)
+
+
+def test_query_statistic(tmpdir):
+    df = make_playlogs()
+    directory = str(tmpdir.join('cube'))
+    build(df, [('day', ['bank'])]).write(directory)
+
+    query_params = query_parameters()
+    query_params.sql_metric = 'netwins'
+    query_params.sql_period = 'day'
+    query_params.sql_factors = []
+    query_params.statistic = 'average'
+    query_params.sql_start = '2015-01-01 00:00:00.000'
+    query_params.sql_stop = '2015-03-31 23:59:59.999'
+    query_params.database_name = 'day_factored_by_bank'
+    result = cube.query_cube(query_params, directory)
+
+    expected = expected_rollup(df, 'day', []).netwins.mean()
+    assert result.columns.tolist() == ['avg']
+    assert result['avg'].iloc[0] == pytest.approx(expected)
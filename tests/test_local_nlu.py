@@ -0,0 +1,92 @@
+'''
+Tests of the local intent and entity parser, read the way
+query_parameters reads Watson's responses.
+'''
+
+from datetime import datetime
+
+import pytest
+
+import local_nlu
+from translation_dictionaries import translation_dictionary
+
+# Time questions are asked at, a Wednesday
+NOW = datetime(2017, 3, 15, 10, 30)
+
+
+def parse(query):
+    mapping = local_nlu.parse_query(query, now=NOW)['intent_entity_mapping']
+    entities = [(entity['entity'], entity['value']) for entity in mapping['entities']]
+    return mapping['intents'][0]['intent'], entities
+
+
+def dates(query):
+    return [value for entity, value in parse(query)[1] if entity == 'sys-date']
+
+
+def test_phrases_name_translation_dictionary_values():
+    values = set(value for phrases in local_nlu.ENTITY_PHRASES.values() for value in phrases)
+    for value in ['club level', 'game title', 'wager', 'daily', 'by_minute', 'best',
+                  'worst', 'gold', 'average', 'median', 'top day', 'top week']:
+        assert value in translation_dictionary
+        assert value in values
+    assert 'date' not in values
+    assert 'payout rate' not in values
+
+
+@pytest.mark.parametrize('query, intent', [
+    ('What is revenue today?', local_nlu.DEFAULT_INTENT),
+    ('net win analysis', 'netwin_analysis'),
+    ('how are my machines doing january', 'machine_performance')])
+def test_intent(query, intent):
+    assert parse(query)[0] == intent
+
+
+def test_default_intent_confidence():
+    mapping = local_nlu.parse_query('revenue today', now=NOW)['intent_entity_mapping']
+    assert mapping['intents'][0]['confidence'] == local_nlu.DEFAULT_CONFIDENCE
+
+
+def test_entities():
+    _, entities = parse('What is the average daily revenue by bank for gold members?')
+    assert ('statistics', 'average') in entities
+    assert ('time_period', 'daily') in entities
+    assert ('both_metrics', 'netwins') in entities
+    assert ('machine_factors', 'bank') in entities
+    assert ('club_level', 'gold') in entities
+
+
+def test_longest_phrase_wins():
+    _, entities = parse('best day last month by club level')
+    assert ('time_factors', 'top day') in entities
+    assert ('top', 'best') not in entities
+    assert ('player_factors', 'club level') in entities
+
+
+@pytest.mark.parametrize('query, expected', [
+    ('revenue today', ['2017-03-15']),
+    ('revenue yesterday', ['2017-03-14']),
+    ('revenue this week', ['2017-03-13', '2017-03-15']),
+    ('revenue last month', ['2017-02-01', '2017-02-28']),
+    ('revenue past 7 days', ['2017-03-08', '2017-03-15']),
+    ('revenue in january', ['2017-01-01', '2017-01-31']),
+    ('revenue in may', ['2016-05-01', '2016-05-31']),
+    ('revenue january 2nd 2015 to 2015-01-05', ['2015-01-02', '2015-01-05']),
+    ('revenue on 1/2/15', ['2015-01-02']),
+    ('revenue in 2015', ['2015-01-01', '2015-12-31'])])
+def test_dates(query, expected):
+    assert dates(query) == expected
+
+
+@pytest.mark.parametrize('query', [
+    'revenue on 2017-02-30',
+    'revenue on 13/45/17',
+    'revenue on 2/29/2017'])
+def test_impossible_dates_are_skipped(query):
+    intent, entities = parse(query)
+    assert dates(query) == []
+    assert ('both_metrics', 'netwins') in entities
+
+
+def test_impossible_date_keeps_the_others():
+    assert dates('revenue 2017-02-30 to 2017-03-02') == ['2017-03-02']
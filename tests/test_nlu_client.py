@@ -0,0 +1,169 @@
+'''
+Tests of the NLU client's retries, timeouts and hedging against a local
+stand-in of the service that answers as it is scripted to.
+'''
+
+import BaseHTTPServer
+import json
+import threading
+import time
+from SocketServer import ThreadingMixIn
+
+import pytest
+
+import nlu_client
+from nlu_client import NLUError
+
+ANSWER = {'intent_entity_mapping': {
+    'intents': [{'intent': 'metric_by_factor_by_time_period', 'confidence': 1}],
+    'entities': [{'entity': 'both_metrics', 'value': 'netwins', 'confidence': 1}]}}
+
+
+class stand_in_handler(BaseHTTPServer.BaseHTTPRequestHandler):
+    '''
+    Answers each request with the next (delay, status) of the server's
+    script, then promptly and successfully once it runs out
+    '''
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        delay, status = self.server.next_answer()
+        time.sleep(delay)
+        body = json.dumps(ANSWER) if status == 200 else ''
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class stand_in_server(ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+    def __init__(self):
+        BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', 0), stand_in_handler)
+        self.script = []
+        self.requests = 0
+        self.lock = threading.Lock()
+
+    def next_answer(self):
+        with self.lock:
+            self.requests += 1
+            return self.script.pop(0) if self.script else (0, 200)
+
+
+@pytest.fixture
+def server():
+    server = stand_in_server()
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def make_client(server, **kwargs):
+    kwargs.setdefault('backoff', 0.001)
+    return nlu_client.nlu_client('http://127.0.0.1:{}/'.format(server.server_port), **kwargs)
+
+
+def test_answer(server):
+    client = make_client(server)
+    assert client.get('revenue+today') == ANSWER
+    stats = client.stats()
+    assert stats['requests'] == 1
+    assert stats['retries'] == stats['failures'] == 0
+    assert sum(stats['histogram'].values()) == 1
+
+
+def test_retries_unavailable(server):
+    server.script = [(0, 503), (0, 503)]
+    client = make_client(server)
+    assert client.get('revenue+today') == ANSWER
+    assert server.requests == 3
+    assert client.stats()['retries'] == 2
+
+
+def test_gives_up_after_retries(server):
+    server.script = [(0, 503)] * 3
+    client = make_client(server, retries=2)
+    with pytest.raises(NLUError) as error:
+        client.get('revenue+today')
+    assert error.value.status_code == 503
+    assert server.requests == 3
+    assert client.stats()['failures'] == 1
+
+
+def test_does_not_retry_client_errors(server):
+    server.script = [(0, 404)]
+    client = make_client(server)
+    with pytest.raises(NLUError) as error:
+        client.get('revenue+today')
+    assert error.value.status_code == 404
+    assert server.requests == 1
+
+
+def test_read_timeout(server):
+    server.script = [(1.0, 200)]
+    client = make_client(server, read_timeout=0.1, retries=0)
+    ts = time.time()
+    with pytest.raises(NLUError):
+        client.get('revenue+today')
+    assert time.time() - ts < 0.9
+
+
+def test_retries_after_timeout(server):
+    server.script = [(1.0, 200)]
+    client = make_client(server, read_timeout=0.1, retries=1)
+    assert client.get('revenue+today') == ANSWER
+    assert client.stats()['retries'] == 1
+
+
+def test_budget_bounds_retries(server):
+    # Each answer is slow and unavailable, the second outlasts the budget
+    server.script = [(0.3, 503)] * 10
+    client = make_client(server, read_timeout=1.0, retries=5)
+    ts = time.time()
+    with pytest.raises(NLUError):
+        client.get('revenue+today', budget=0.5)
+    assert time.time() - ts < 0.9
+    assert server.requests == 2
+
+
+def test_no_hedge_before_enough_samples(server):
+    server.script = [(0.2, 200)]
+    client = make_client(server)
+    for _ in xrange(nlu_client.HEDGE_MIN_SAMPLES - 1):
+        client.histogram.record(0.01)
+    assert client.get('revenue+today') == ANSWER
+    assert client.stats()['hedges'] == 0
+
+
+def test_hedges_slow_request(server):
+    # The first request stalls, the hedge is answered at once
+    server.script = [(1.0, 200)]
+    client = make_client(server)
+    for _ in xrange(nlu_client.HEDGE_MIN_SAMPLES):
+        client.histogram.record(0.01)
+    ts = time.time()
+    assert client.get('revenue+today') == ANSWER
+    assert time.time() - ts < 0.9
+    stats = client.stats()
+    assert stats['hedges'] == 1
+    assert stats['hedge_wins'] == 1
+
+
+def test_hedge_waits_for_the_other_request(server):
+    # The first request is slow but answers, the hedge fails
+    server.script = [(0.2, 200), (0, 500)]
+    client = make_client(server, retries=0)
+    for _ in xrange(nlu_client.HEDGE_MIN_SAMPLES):
+        client.histogram.record(0.01)
+    assert client.get('revenue+today') == ANSWER
+    stats = client.stats()
+    assert stats['hedges'] == 1
+    assert stats['hedge_wins'] == 0